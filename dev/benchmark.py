@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Micro-benchmarks of the per-event functions against FakeTelldusCore, for
+# inventories of 10, 100 and 1000 entities and raw strings from common
+# protocols. Results are operations per second on one core, compared with
+# the baseline in dev/benchmark_baseline.json, which is updated with
+# --save. Absolute numbers depend on the machine, so each run also times a
+# fixed calibration workload and the comparison is scaled by its speed
+# relative to the baseline run. For a reliable gate regenerate the
+# baseline on the machine doing the comparison first.
+#
+#   $ python dev/benchmark.py
+#   $ python dev/benchmark.py --save
+#   $ python dev/benchmark.py --filter raw
+
+import argparse
+import asyncio
+import json
+import logging.config
+import os
+import platform
+import sys
+import timeit
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'dev'))
+# src.telldus reads logging.yaml and config_default.yaml relative to the
+# working directory
+os.chdir(ROOT)
+
+# pylint: disable=wrong-import-position
+import simulator  # noqa: E402
+from src.bridge import Bridge  # noqa: E402
+from src.config import load_config  # noqa: E402
+from src.publisher import Publisher  # noqa: E402
+from src.raw import parse_raw  # noqa: E402
+from src.telldus import const  # noqa: E402
+
+BASELINE = os.path.join(ROOT, 'dev', 'benchmark_baseline.json')
+
+SIZES = (10, 100, 1000)
+
+RAW_EVENTS = {
+    'arctech': 'class:command;protocol:arctech;model:selflearning;'
+               'house:15892538;unit:1;group:0;method:turnon;',
+    'everflourish': 'class:command;protocol:everflourish;'
+                    'model:selflearning;house:7343;unit:3;method:turnoff;',
+    'sartano': 'class:command;protocol:sartano;model:codeswitch;'
+               'code:0101010101;method:turnon;',
+    'fineoffset': 'class:sensor;protocol:fineoffset;id:135;'
+                  'model:temperaturehumidity;humidity:45;temp:21.3;',
+    'mandolyn': 'class:sensor;protocol:mandolyn;id:11;'
+                'model:temperaturehumidity;temp:19.8;humidity:52;',
+}
+
+
+class Message:
+    # Stand-in for paho.mqtt.client.MQTTMessage
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+LOOP = asyncio.new_event_loop()
+
+
+def make_config():
+    config = load_config()
+    config['snapshot']['enabled'] = False
+    return config
+
+
+def make_bridge(size):
+    config = make_config()
+    # Measure the full path, repeated events would be dropped early
+    config['dedup']['sensor']['window'] = 0
+    config['dedup']['raw']['window'] = 0
+    config['groups'] = {'living_room': [1, 2, 3]}
+    config['state_table']['enabled'] = True
+
+    core = simulator.FakeTelldusCore(size, size)
+    bridge = Bridge(config, core, LOOP)
+    # Never connected, so publishes only go to the queue and nothing is
+    # sent. keep_latest keeps the queue bounded by the number of topics.
+    bridge.publisher = Publisher(
+        types.SimpleNamespace(is_connected=lambda: False))
+    return bridge, core
+
+
+def startup(size):
+    # Everything from reading the config to having all discovery configs
+    # and states to publish, except connecting to telldusd and MQTT
+    core = simulator.FakeTelldusCore(size, size)
+
+    def run():
+        bridge = Bridge(make_config(), core, LOOP)
+        bridge.collect()
+        bridge.executor.shutdown()
+
+    return run
+
+
+def benchmarks(size):
+    # Yields (name, function, operations per call)
+    yield ('startup[{}]'.format(size), startup(size), 1)
+
+    bridge, core = make_bridge(size)
+    s, d, raw = bridge.s, bridge.d, bridge.raw
+
+    sensors = s.get()
+    devices = d.get()
+    yield ('create_topics.sensors[{}]'.format(size),
+           lambda: s.create_topics(sensors), len(sensors))
+    yield ('create_topics.devices[{}]'.format(size),
+           lambda: d.create_topics(devices), len(devices))
+
+    # The combined state of every sensor and device
+    bridge.load()
+    snapshot = Message('{}/snapshot/get'.format(
+        bridge.config['home_assistant']['state_topic']), b'')
+    yield ('on_state_request[{}]'.format(size),
+           lambda: bridge.on_state_request(None, None, snapshot), 1)
+
+    if size != SIZES[0]:
+        return
+
+    # The remaining functions do not depend on the inventory size
+    sensor = sensors[0]
+    state_topic = '{}/{}/{}/state'.format(
+        bridge.config['home_assistant']['state_topic'],
+        sensor['sensor'].id, sensor['type'])
+    yield ('create_config_data.sensor',
+           lambda: s._create_config_data(  # pylint: disable=W0212
+               sensor['sensor'], state_topic, sensor), 1)
+    yield ('create_topic', lambda: s.create_topic(1, 'temperature'), 1)
+    yield ('create_topic_data',
+           lambda: s.create_topic_data('temperature', '21.3'), 1)
+
+    for protocol, data in RAW_EVENTS.items():
+        yield ('parse_raw.{}'.format(protocol),
+               lambda data=data: parse_raw(data), 1)
+        if 'command' in data:
+            yield ('command.serialize.{}'.format(protocol),
+                   lambda data=data: raw.serialize(data), 1)
+            yield ('command.get.{}'.format(protocol),
+                   lambda data=data: raw.get(data), 1)
+        yield ('raw_event.{}'.format(protocol),
+               lambda data=data: bridge.raw_event(data, 1, 1), 1)
+
+    sensor_entry = core.sensors()[0]
+    values = iter(range(1 << 62))
+    yield ('sensor_event',
+           lambda: bridge.sensor_event(
+               sensor_entry.protocol, sensor_entry.model, sensor_entry.id,
+               const.TELLSTICK_TEMPERATURE, str(next(values)), 0, 1), 1)
+
+    # Commands on the topics the bridge subscribes, as Home Assistant
+    # sends them
+    state_topic = bridge.config['home_assistant']['state_topic']
+    switch = Message('{}/1/switch/set'.format(state_topic), b'1')
+    light = Message('{}/2/light/set'.format(state_topic), b'1')
+    brightness = Message('{}/2/brightness/set'.format(state_topic), b'128')
+    group = Message('{}/group/living_room/set'.format(state_topic), b'1')
+    yield ('on_message.switch',
+           lambda: bridge.on_message(None, None, switch), 1)
+    yield ('on_message.light',
+           lambda: bridge.on_message(None, None, light), 1)
+    yield ('on_message.brightness',
+           lambda: bridge.on_message(None, None, brightness), 1)
+    yield ('on_group_message',
+           lambda: bridge.on_group_message(None, None, group), 1)
+
+
+def calibration():
+    # Plain Python work of the same kind as the event path, dict lookups,
+    # string formatting and JSON encoding, independent of the bridge code
+    data = {'sensor_{}'.format(i): i for i in range(20)}
+
+    def run():
+        for key in data:
+            '{}/{}/temperature/state'.format('telldus', data[key])
+        json.dumps(data)
+    return run
+
+
+def measure(function, operations, repeat):
+    timer = timeit.Timer(function)
+    number, _time = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return number * operations / best
+
+
+def load_baseline():
+    try:
+        with open(BASELINE, 'r', encoding='utf-8') as stream:
+            return json.load(stream)
+    except FileNotFoundError:
+        return {'calibration': None, 'results': {}}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks of the bridge event path')
+    parser.add_argument('--filter', default='',
+                        help='only run benchmarks containing this string')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='report benchmarks slower than the baseline '
+                             'by more than this fraction')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    saved = load_baseline()
+    baseline = saved['results']
+    results = {}
+    regressions = []
+
+    speed = measure(calibration(), 1, args.repeat)
+    scale = 1.0
+    if saved.get('calibration'):
+        scale = speed / saved['calibration']
+        print('Machine speed {:.0%} of the baseline run, baseline scaled '
+              'to match'.format(scale))
+
+    print('{:<36} {:>14} {:>10}'.format('benchmark', 'ops/s', 'baseline'))
+    for size in SIZES:
+        for name, function, operations in benchmarks(size):
+            if args.filter not in name:
+                continue
+
+            ops = measure(function, operations, args.repeat)
+            results[name] = round(ops, 1)
+
+            change = ''
+            if name in baseline:
+                ratio = ops / (baseline[name] * scale)
+                change = '{:+.0%}'.format(ratio - 1)
+                if ratio < 1 - args.threshold:
+                    regressions.append(name)
+            print('{:<36} {:>14,.0f} {:>10}'.format(name, ops, change))
+
+    if args.save:
+        # Benchmarks left out with --filter keep their baseline, scaled to
+        # this machine
+        baseline = {name: round(ops * scale, 1)
+                    for name, ops in baseline.items()}
+        baseline.update(results)
+        data = {'python': platform.python_version(),
+                'machine': platform.machine(),
+                'calibration': round(speed, 1),
+                'results': dict(sorted(baseline.items()))}
+        with open(BASELINE, 'w', encoding='utf-8') as stream:
+            json.dump(data, stream, indent=2)
+            stream.write('\n')
+        print('Baseline saved to {}'.format(os.path.relpath(BASELINE)))
+    elif regressions:
+        print('Slower than baseline: {}'.format(', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
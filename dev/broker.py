@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Minimal MQTT 3.1.1 and 5 broker stand-in for load tests, not for
+# production. Supports CONNECT, PUBLISH with QoS 0 and 1 and MQTT 5 topic
+# aliases, SUBSCRIBE with + and # wildcards, retained messages, PINGREQ and
+# DISCONNECT. Every received PUBLISH is recorded with its arrival time
+# (time.monotonic) so latency can be measured against the time an event
+# was generated, and the bytes of all received PUBLISH packets are counted.
+
+import argparse
+import asyncio
+import struct
+import time
+
+CONNECT = 1
+PUBLISH = 3
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+PINGREQ = 12
+DISCONNECT = 14
+
+MQTT5 = 5
+TOPIC_ALIAS = 0x23
+TOPIC_ALIAS_MAXIMUM = 0x22
+# Size of MQTT 5 PUBLISH properties the bridge may send, 0 for strings
+PROPERTY_SIZES = {0x01: 1, 0x02: 4, 0x03: 0, 0x08: 0, 0x09: 0,
+                  TOPIC_ALIAS: 2}
+
+
+def topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+
+    for i, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels):
+            return False
+        if level not in ('+', topic_levels[i]):
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def decode_length(data, pos):
+    length = 0
+    multiplier = 1
+    while True:
+        byte = data[pos]
+        pos += 1
+        length += (byte & 0x7f) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            return length, pos
+
+
+def topic_alias(properties):
+    pos = 0
+    while pos < len(properties):
+        identifier = properties[pos]
+        pos += 1
+        if identifier == TOPIC_ALIAS:
+            return struct.unpack('!H', properties[pos:pos + 2])[0]
+        size = PROPERTY_SIZES.get(identifier)
+        if size is None:
+            return None
+        if size == 0:
+            size = 2 + struct.unpack('!H', properties[pos:pos + 2])[0]
+        pos += size
+    return None
+
+
+def encode_publish(topic, payload, retain=False, version=4):
+    topic_bytes = topic.encode('utf-8')
+    body = struct.pack('!H', len(topic_bytes)) + topic_bytes
+    if version >= MQTT5:
+        body += b'\x00'
+    body += payload
+    return bytes([(PUBLISH << 4) | int(retain)]) + \
+        encode_length(len(body)) + body
+
+
+class Broker:
+    def __init__(self, record=True, topic_alias_maximum=10):
+        self.record = record
+        self.topic_alias_maximum = topic_alias_maximum
+        self.received = []
+        self.publish_bytes = 0
+        self.retained = {}
+        self.sessions = []
+
+    async def handle(self, reader, writer):
+        session = {'writer': writer, 'filters': [], 'version': 4,
+                   'aliases': {}}
+        self.sessions.append(session)
+
+        try:
+            while True:
+                header = await reader.readexactly(1)
+                length = 0
+                multiplier = 1
+                size = 1
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    size += 1
+                    length += (byte & 0x7f) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length) if length else b''
+                if header[0] >> 4 == PUBLISH:
+                    self.publish_bytes += size + length
+
+                if not self._packet(session, header[0], body):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.remove(session)
+            writer.close()
+
+    def _packet(self, session, header, body):
+        packet_type = header >> 4
+        writer = session['writer']
+
+        if packet_type == CONNECT:
+            # Protocol name "MQTT" is followed by the level
+            session['version'] = body[6]
+            if session['version'] >= MQTT5:
+                properties = bytes([TOPIC_ALIAS_MAXIMUM]) + \
+                    struct.pack('!H', self.topic_alias_maximum)
+                body = b'\x00\x00' + encode_length(len(properties)) + \
+                    properties
+                writer.write(b'\x20' + encode_length(len(body)) + body)
+            else:
+                writer.write(b'\x20\x02\x00\x00')
+        elif packet_type == PUBLISH:
+            self._publish(session, header, body)
+        elif packet_type == SUBSCRIBE:
+            self._subscribe(session, body)
+        elif packet_type == UNSUBSCRIBE:
+            if session['version'] >= MQTT5:
+                writer.write(b'\xb0\x04' + body[:2] + b'\x00\x00')
+            else:
+                writer.write(b'\xb0\x02' + body[:2])
+        elif packet_type == PINGREQ:
+            writer.write(b'\xd0\x00')
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+    def _subscribe(self, session, body):
+        writer = session['writer']
+        packet_id = body[:2]
+        pos = 2
+        if session['version'] >= MQTT5:
+            length, pos = decode_length(body, pos)
+            pos += length
+            packet_id += b'\x00'
+        granted = bytearray()
+
+        while pos < len(body):
+            (size,) = struct.unpack('!H', body[pos:pos + 2])
+            topic_filter = body[pos + 2:pos + 2 + size].decode('utf-8')
+            pos += 3 + size
+            session['filters'].append(topic_filter)
+            granted.append(0)
+
+        writer.write(bytes([SUBACK << 4])
+                     + encode_length(len(packet_id) + len(granted))
+                     + packet_id + bytes(granted))
+
+        for topic, payload in self.retained.items():
+            if any(topic_matches(topic_filter, topic)
+                   for topic_filter in session['filters']):
+                writer.write(encode_publish(topic, payload, True,
+                                            session['version']))
+
+    def _publish(self, session, header, body):
+        writer = session['writer']
+        qos = (header >> 1) & 0x03
+        retain = header & 0x01
+        (size,) = struct.unpack('!H', body[:2])
+        topic = body[2:2 + size].decode('utf-8')
+        pos = 2 + size
+        if qos:
+            writer.write(b'\x40\x02' + body[pos:pos + 2])
+            pos += 2
+        if session['version'] >= MQTT5:
+            length, pos = decode_length(body, pos)
+            alias = topic_alias(body[pos:pos + length])
+            pos += length
+            if alias is not None:
+                if topic:
+                    session['aliases'][alias] = topic
+                else:
+                    topic = session['aliases'][alias]
+        payload = body[pos:]
+
+        if self.record:
+            self.received.append((time.monotonic(), topic, payload))
+
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+
+        for session in self.sessions:
+            if any(topic_matches(topic_filter, topic)
+                   for topic_filter in session['filters']):
+                session['writer'].write(encode_publish(
+                    topic, payload, version=session['version']))
+
+
+async def serve(host, port, broker, started=None, stop=None):
+    server = await asyncio.start_server(broker.handle, host, port)
+    if started is not None:
+        started.set()
+    async with server:
+        if stop is None:
+            await server.serve_forever()
+        else:
+            while not stop.is_set():
+                await asyncio.sleep(0.1)
+
+
+def run_process(port, started, stop, results):
+    # Entry point when run in a multiprocessing.Process, the received
+    # messages and PUBLISH bytes are sent back through results when stop
+    # is set
+    broker = Broker()
+    asyncio.run(serve('127.0.0.1', port, broker, started, stop))
+    results.send((broker.received, broker.publish_bytes))
+    results.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    args = parser.parse_args()
+
+    broker = Broker(record=False)
+    try:
+        asyncio.run(serve(args.host, args.port, broker))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
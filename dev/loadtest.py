@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Load test of the bridge without a TellStick or an MQTT server. Runs the
+# bridge from src/bridge.py against FakeTelldusCore and the broker
+# stand-in in dev/broker.py, then reports events/s, end-to-end latency
+# percentiles from sensor event to state received by the broker and CPU
+# time per event of the bridge process.
+#
+#   $ python dev/loadtest.py --sensors 1000 --sensor-rate 2000 --duration 10
+
+import argparse
+import asyncio
+import json
+import logging.config
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'dev'))
+# src.telldus reads logging.yaml and config_default.yaml relative to the
+# working directory
+os.chdir(ROOT)
+
+# pylint: disable=wrong-import-position
+import broker  # noqa: E402
+import simulator  # noqa: E402
+from src.bridge import Bridge  # noqa: E402
+from src.config import load_config  # noqa: E402
+from src.telldus import TimedCallbackDispatcher  # noqa: E402
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    index = min(int(round(pct / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def latencies(received, sent_at, state_topic):
+    # Sensor states carry the unique value the load generator emitted
+    result = []
+    prefix = state_topic + '/'
+    for arrived, topic, payload in received:
+        if not topic.startswith(prefix) or not topic.endswith('/state'):
+            continue
+        text = payload.decode('utf-8')
+        try:
+            value = json.loads(text)
+        except ValueError:
+            value = text
+        if isinstance(value, dict):
+            if len(value) != 1:
+                continue
+            value = next(iter(value.values()))
+        else:
+            # Compact payloads are the value as sent
+            value = text
+        sent = sent_at.get(str(value))
+        if sent is not None:
+            result.append(arrived - sent)
+    result.sort()
+    return result
+
+
+def run(args):
+    logging.getLogger().setLevel(logging.WARNING)
+
+    port = free_port()
+    started = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    results, results_child = multiprocessing.Pipe(duplex=False)
+    broker_process = multiprocessing.Process(
+        target=broker.run_process, args=(port, started, stop, results_child),
+        daemon=True)
+    broker_process.start()
+    if not started.wait(10):
+        sys.exit('Broker did not start')
+
+    startup_start = time.monotonic()
+    config = load_config()
+    config['mqtt']['broker'] = '127.0.0.1'
+    config['mqtt']['port'] = port
+    config['mqtt']['asyncio'] = args.asyncio
+    config['mqtt']['queue_policy'] = args.queue_policy
+    config['snapshot']['enabled'] = False
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    dispatcher = TimedCallbackDispatcher(loop)
+    core = simulator.FakeTelldusCore(args.sensors, args.devices,
+                                     args.transmit_time, dispatcher)
+
+    bridge = Bridge(config, core, loop)
+    bridge.connect_and_load('telldus-core-mqtt-loadtest')
+    bridge.register(core)
+    bridge.start()
+
+    generator = simulator.LoadGenerator(core, args.sensor_rate,
+                                        args.device_rate, args.raw_rate,
+                                        args.raw_entities)
+
+    def drain():
+        # Run until every event is dispatched and the queue is empty
+        generator.join()
+        while True:
+            time.sleep(0.05)
+            done = asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop)
+            done.result()
+            if not bridge.publisher.depth():
+                break
+        time.sleep(args.settle)
+        loop.call_soon_threadsafe(loop.stop)
+
+    # Wait for the initial discovery configs to be sent
+    loop.run_until_complete(asyncio.sleep(1))
+
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    generator.start(args.duration)
+    threading.Thread(target=drain, daemon=True).start()
+    loop.run_forever()
+    wall = time.monotonic() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    bridge.stop()
+    stop.set()
+    received, publish_bytes = results.recv()
+    broker_process.join(10)
+
+    total = generator.total()
+    state_topic = config['home_assistant']['state_topic']
+    result = latencies(received, generator.sent_at, state_topic)
+    published = bridge.publisher.sent
+    startup = received[0][0] - startup_start if received else 0
+
+    print('Startup:    {:.1f} ms to first message received by broker'
+          .format(startup * 1e3))
+    print('Events:     {} in {:.2f}s ({:.0f}/s), {}'.format(
+        total, wall, total / wall if wall else 0,
+        ', '.join('{} {}'.format(count, kind)
+                  for kind, count in generator.emitted.items())))
+    print('Published:  {} ({:.0f}/s), {} received by broker'.format(
+        published, published / wall if wall else 0, len(received)))
+    print('Wire:       {:.1f} bytes per PUBLISH received by broker'.format(
+        publish_bytes / len(received) if received else 0))
+    print('Queue:      {}'.format(bridge.publisher.queue.stats()))
+    print('CPU:        {:.2f}s, {:.1f} us per event'.format(
+        cpu, cpu / total * 1e6 if total else 0))
+    if result:
+        print('Latency:    p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms, '
+              'max {:.2f} ms ({} sensor states)'.format(
+                  percentile(result, 50) * 1e3, percentile(result, 90) * 1e3,
+                  percentile(result, 99) * 1e3, result[-1] * 1e3,
+                  len(result)))
+    transmissions = sum(len(device.transmissions)
+                        for device in core.devices())
+    if transmissions:
+        print('Devices:    {} transmissions'.format(transmissions))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the bridge with a simulated telldusd')
+    parser.add_argument('--sensors', type=int, default=100)
+    parser.add_argument('--devices', type=int, default=10)
+    parser.add_argument('--sensor-rate', type=float, default=500,
+                        help='sensor events per second')
+    parser.add_argument('--device-rate', type=float, default=10,
+                        help='device events per second')
+    parser.add_argument('--raw-rate', type=float, default=50,
+                        help='raw command events per second')
+    parser.add_argument('--raw-entities', type=int, default=20,
+                        help='distinct remotes in the raw events')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds to generate events')
+    parser.add_argument('--transmit-time', type=float, default=0.0,
+                        help='seconds a simulated transmission takes')
+    parser.add_argument('--queue-policy', default='keep_latest')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='drive the MQTT connection from asyncio')
+    parser.add_argument('--settle', type=float, default=0.5,
+                        help='seconds to wait for the broker after the '
+                             'queue is empty')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
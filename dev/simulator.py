@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Stand-in for telldusd and the tellcore-py TelldusCore, for running the
+# bridge without a TellStick. FakeTelldusCore can be passed anywhere a
+# tellcore.telldus.TelldusCore is used, e.g. telldus.Telldus(core=...) or
+# Bridge(config, core, loop), and generates sensor, device and raw events
+# through the same callback dispatcher as the real library.
+
+import heapq
+import itertools
+import threading
+import time
+
+import tellcore.constants as const
+
+SENSOR_MODELS = [
+    ('fineoffset', 'temperaturehumidity',
+     const.TELLSTICK_TEMPERATURE | const.TELLSTICK_HUMIDITY),
+    ('mandolyn', 'temperaturehumidity',
+     const.TELLSTICK_TEMPERATURE | const.TELLSTICK_HUMIDITY),
+    ('fineoffset', 'temperature', const.TELLSTICK_TEMPERATURE),
+    ('oregon', '1984',
+     const.TELLSTICK_WINDDIRECTION | const.TELLSTICK_WINDAVERAGE
+     | const.TELLSTICK_WINDGUST),
+    ('oregon', '2914', const.TELLSTICK_RAINRATE | const.TELLSTICK_RAINTOTAL),
+]
+
+DEVICE_MODELS = ['selflearning-switch', 'selflearning-dimmer',
+                 'codeswitch']
+
+RAW_COMMANDS = [
+    'class:command;protocol:arctech;model:selflearning;house:{id};unit:1;'
+    'group:0;method:{method};',
+    'class:command;protocol:arctech;model:codeswitch;house:{id};unit:1;'
+    'method:{method};',
+    'class:command;protocol:everflourish;model:selflearning;house:{id};'
+    'unit:1;method:{method};',
+    'class:command;protocol:sartano;model:codeswitch;code:{id};'
+    'method:{method};',
+]
+
+SENSOR_RAW = ('class:sensor;protocol:fineoffset;id:{id};model:temperature'
+              'humidity;humidity:{humidity};temp:{temp};')
+
+
+class SensorValue:
+    __slots__ = ('datatype', 'value', 'timestamp')
+
+    def __init__(self, datatype, value, timestamp):
+        self.datatype = datatype
+        self.value = value
+        self.timestamp = timestamp
+
+
+class FakeSensor:
+    def __init__(self, protocol, model, id_, datatypes):
+        self.protocol = protocol
+        self.model = model
+        self.id = id_
+        self.datatypes = datatypes
+        self.values = {}
+
+    def has_value(self, datatype):
+        return (self.datatypes & datatype) != 0
+
+    def value(self, datatype):
+        return SensorValue(datatype, self.values.get(datatype, '0.0'),
+                           int(time.time()))
+
+
+class FakeDevice:
+    # Transmissions are recorded with their time, transmit_time emulates
+    # the time the TellStick needs to send a frame.
+    def __init__(self, id_, model, transmit_time=0.0):
+        self.id = id_
+        self.name = 'device_{}'.format(id_)
+        self.model = model
+        self.protocol = 'arctech'
+        self.transmit_time = transmit_time
+        self.last_command = const.TELLSTICK_TURNOFF
+        self.last_value = None
+        self.transmissions = []
+
+    def _transmit(self, method, value=None):
+        if self.transmit_time:
+            time.sleep(self.transmit_time)
+        self.last_command = method
+        self.last_value = value
+        self.transmissions.append((time.monotonic(), method, value))
+
+    def turn_on(self):
+        self._transmit(const.TELLSTICK_TURNON)
+
+    def turn_off(self):
+        self._transmit(const.TELLSTICK_TURNOFF)
+
+    def dim(self, level):
+        self._transmit(const.TELLSTICK_DIM, level)
+
+    def last_sent_command(self, methods_supported):
+        # pylint: disable=unused-argument
+        return self.last_command
+
+    def last_sent_value(self):
+        return self.last_value
+
+    def parameters(self):
+        return {'house': str(1000 + self.id), 'unit': '1'}
+
+
+class FakeController:
+    __slots__ = ('id', 'type')
+
+    def __init__(self, id_):
+        self.id = id_
+        self.type = const.TELLSTICK_CONTROLLER_TELLSTICK_DUO
+
+
+class FakeTelldusCore:
+    def __init__(self, sensors=10, devices=10, transmit_time=0.0,
+                 callback_dispatcher=None, controllers=1):
+        self.callback_dispatcher = callback_dispatcher
+        self.calls = 0
+        self._sensors = []
+        self._devices = []
+        self._controllers = [FakeController(i + 1)
+                             for i in range(controllers)]
+        self._callbacks = {}
+        self._callback_ids = itertools.count(1)
+
+        for i in range(sensors):
+            protocol, model, datatypes = SENSOR_MODELS[i % len(SENSOR_MODELS)]
+            self._sensors.append(FakeSensor(protocol, model, i + 1,
+                                            datatypes))
+
+        for i in range(devices):
+            model = DEVICE_MODELS[i % len(DEVICE_MODELS)]
+            self._devices.append(FakeDevice(i + 1, model, transmit_time))
+
+    def sensors(self):
+        self.calls += 1
+        return list(self._sensors)
+
+    def devices(self):
+        self.calls += 1
+        return list(self._devices)
+
+    def controllers(self):
+        self.calls += 1
+        return list(self._controllers)
+
+    def _register(self, kind, callback):
+        cid = next(self._callback_ids)
+        self._callbacks[cid] = (kind, callback)
+        return cid
+
+    def register_device_event(self, callback):
+        return self._register('device', callback)
+
+    def register_device_change_event(self, callback):
+        return self._register('device_change', callback)
+
+    def register_raw_device_event(self, callback):
+        return self._register('raw', callback)
+
+    def register_sensor_event(self, callback):
+        return self._register('sensor', callback)
+
+    def register_controller_event(self, callback):
+        return self._register('controller', callback)
+
+    def unregister_callback(self, cid):
+        self._callbacks.pop(cid, None)
+
+    def _dispatch(self, kind, *args):
+        for cid, (callback_kind, callback) in list(self._callbacks.items()):
+            if callback_kind != kind:
+                continue
+            if self.callback_dispatcher is None:
+                callback(*args, cid)
+            else:
+                self.callback_dispatcher.on_callback(callback, *args, cid)
+
+    def emit_sensor(self, sensor, datatype, value):
+        sensor.values[datatype] = value
+        self._dispatch('sensor', sensor.protocol, sensor.model, sensor.id,
+                       datatype, value, int(time.time()))
+
+    def emit_device(self, device, method, data=''):
+        self._dispatch('device', device.id, method, data)
+
+    def emit_raw(self, data, controller_id=1):
+        self._dispatch('raw', data, controller_id)
+
+    def emit_device_change(self, device, event=const.TELLSTICK_DEVICE_CHANGED,
+                           change_type=const.TELLSTICK_CHANGE_NAME):
+        self._dispatch('device_change', device.id, event, change_type)
+
+
+class LoadGenerator:
+    # Emits events at fixed rates (events per second) from its own thread,
+    # like the telldus-core callback thread does. Sensor values are unique
+    # sequence numbers so the broker side can match each published state
+    # to the time its event was emitted.
+    def __init__(self, core, sensor_rate=0, device_rate=0, raw_rate=0,
+                 raw_entities=20):
+        self.core = core
+        self.rates = {'sensor': sensor_rate, 'device': device_rate,
+                      'raw': raw_rate}
+        self.raw_entities = raw_entities
+        self.emitted = {'sensor': 0, 'device': 0, 'raw': 0}
+        self.sent_at = {}
+        self._sequence = itertools.count(1)
+        self._running = False
+        self._thread = None
+
+    def start(self, duration):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, args=(duration,),
+                                        name='telldus-load-generator',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def total(self):
+        return sum(self.emitted.values())
+
+    def _run(self, duration):
+        start = time.monotonic()
+        end = start + duration
+        schedule = [(start, kind) for kind, rate in self.rates.items()
+                    if rate > 0]
+        heapq.heapify(schedule)
+
+        while self._running and schedule:
+            due, kind = schedule[0]
+            if due >= end:
+                break
+
+            now = time.monotonic()
+            if due > now:
+                time.sleep(due - now)
+
+            heapq.heapreplace(schedule, (due + 1.0 / self.rates[kind], kind))
+            getattr(self, '_emit_{}'.format(kind))()
+            self.emitted[kind] += 1
+
+    def _emit_sensor(self):
+        sequence = next(self._sequence)
+        sensors = self.core._sensors  # pylint: disable=protected-access
+        sensor = sensors[sequence % len(sensors)]
+        datatype = const.TELLSTICK_TEMPERATURE
+        if not sensor.has_value(datatype):
+            datatype = sensor.datatypes & -sensor.datatypes
+        value = str(sequence)
+        self.sent_at[value] = time.monotonic()
+        self.core.emit_sensor(sensor, datatype, value)
+
+    def _emit_device(self):
+        sequence = next(self._sequence)
+        devices = self.core._devices  # pylint: disable=protected-access
+        device = devices[sequence % len(devices)]
+        method = const.TELLSTICK_TURNON if sequence % 2 \
+            else const.TELLSTICK_TURNOFF
+        self.core.emit_device(device, method)
+
+    def _emit_raw(self):
+        sequence = next(self._sequence)
+        template = RAW_COMMANDS[sequence % len(RAW_COMMANDS)]
+        method = 'turnon' if (sequence // self.raw_entities) % 2 \
+            else 'turnoff'
+        self.core.emit_raw(template.format(
+            id=1000 + sequence % self.raw_entities, method=method))
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import math
+import threading
+import time
+
+from src.config import as_bool
+
+STATISTICS = ('mean', 'min', 'max', 'last')
+
+# Statistic published as the state when not configured, gusts keep their
+# peak and rain totals are counters
+DEFAULT_STATISTICS = {'windgust': 'max',
+                      'raintotal': 'last'}
+
+
+class Accumulator:
+    # Running statistics of one window, constant time and memory per
+    # reading. Directions in degrees are averaged on the circle.
+    __slots__ = ('started', 'count', 'total', 'minimum', 'maximum', 'last',
+                 'sin_total', 'cos_total')
+
+    def __init__(self, started):
+        self.started = started
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.last = None
+        self.sin_total = 0.0
+        self.cos_total = 0.0
+
+    def add(self, value, circular=False):
+        self.count += 1
+        self.total += value
+        self.last = value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        if circular:
+            radians = math.radians(value)
+            self.sin_total += math.sin(radians)
+            self.cos_total += math.cos(radians)
+
+    def mean(self, circular=False):
+        if not circular:
+            return self.total / self.count
+        if abs(self.sin_total) < 1e-9 and abs(self.cos_total) < 1e-9:
+            # Opposite directions cancel out, there is no mean
+            return self.last
+        return math.degrees(math.atan2(self.sin_total,
+                                       self.cos_total)) % 360
+
+    def summary(self, circular=False):
+        return {'mean': round(self.mean(circular), 2),
+                'min': self.minimum,
+                'max': self.maximum,
+                'last': self.last,
+                'count': self.count}
+
+
+class Aggregator:
+    # Downsampling of high rate sensors. Readings of configured data types
+    # are accumulated per sensor and one summary is published per window
+    # instead of every reading. Settings are per data type with optional
+    # per sensor overrides, like PublishFilter.
+    #   window: seconds per summary
+    #   statistic: mean, min, max or last, published as the state
+    #   attributes: also publish all statistics to an attributes topic
+    def __init__(self, types=None, sensors=None):
+        self.types = types or {}
+        self.sensors = sensors or {}
+        self.aggregated = 0
+        self.summaries = 0
+        self._lock = threading.Lock()
+        self._windows = {}
+        self._settings = {}
+
+    @property
+    def active(self):
+        return bool(self.types or self.sensors)
+
+    def settings_for(self, entity_id, type_string):
+        key = (str(entity_id), type_string)
+        settings = self._settings.get(key)
+        if settings is None:
+            type_settings = self.types.get(type_string)
+            sensor_settings = self.sensors.get(str(entity_id), {}) \
+                .get(type_string)
+
+            if type_settings is None and sensor_settings is None:
+                settings = False
+            else:
+                settings = {'window': 60.0,
+                            'statistic': DEFAULT_STATISTICS.get(type_string,
+                                                                'mean'),
+                            'attributes': False}
+                for overrides in (type_settings, sensor_settings):
+                    settings.update(overrides or {})
+                settings['window'] = float(settings['window'])
+                settings['attributes'] = as_bool(settings['attributes'])
+                if settings['statistic'] not in STATISTICS:
+                    raise ValueError(
+                        'Unknown statistic "{}" for {}, use one of {}'
+                        .format(settings['statistic'], type_string,
+                                ', '.join(STATISTICS)))
+            self._settings[key] = settings
+        return settings
+
+    def add(self, entity_id, type_string, value, now=None):
+        # Returns True if the reading was taken into a window, False if it
+        # should be published as is
+        settings = self.settings_for(entity_id, type_string)
+        if not settings:
+            return False
+
+        try:
+            number = float(value)
+        except (TypeError, ValueError):
+            return False
+
+        if now is None:
+            now = time.monotonic()
+
+        key = (str(entity_id), type_string)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                window = Accumulator(now)
+                self._windows[key] = window
+            window.add(number, type_string == 'winddirection')
+        self.aggregated += 1
+        return True
+
+    def expired(self, now=None):
+        # Removes and returns the windows that have ended as a list of
+        # (entity_id, type_string, state value, summary, settings)
+        if now is None:
+            now = time.monotonic()
+
+        ended = []
+        with self._lock:
+            for key, window in list(self._windows.items()):
+                settings = self.settings_for(*key)
+                if now - window.started < settings['window']:
+                    continue
+                del self._windows[key]
+                ended.append((key, window, settings))
+
+        result = []
+        for (entity_id, type_string), window, settings in ended:
+            summary = window.summary(type_string == 'winddirection')
+            result.append((entity_id, type_string,
+                           summary[settings['statistic']], summary,
+                           settings))
+        self.summaries += len(result)
+        return result
+
+    def stats(self):
+        return {'aggregated': self.aggregated, 'summaries': self.summaries,
+                'windows': len(self._windows)}
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import logging
+import socket
+
+from paho.mqtt import client as mqtt_client
+
+
+class MqttAsyncioHelper:
+    # Drive a paho client from an asyncio loop instead of paho's network
+    # thread, using the external event loop socket callbacks. Reading,
+    # writing, keepalive and reconnect all happen on the loop thread.
+    def __init__(self, loop, client, reconnect_delay=1,
+                 max_reconnect_delay=60):
+        self.loop = loop
+        self.client = client
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.misc = None
+
+        self.client.on_socket_open = self.on_socket_open
+        self.client.on_socket_close = self.on_socket_close
+        self.client.on_socket_register_write = self.on_socket_register_write
+        self.client.on_socket_unregister_write = \
+            self.on_socket_unregister_write
+
+    def start(self):
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def stop(self):
+        if self.misc is not None:
+            self.misc.cancel()
+
+    async def disconnect(self, timeout=5):
+        # Sends DISCONNECT and waits until paho wrote it and closed the
+        # socket, call stop() first so there is no reconnect meanwhile
+        self.client.disconnect()
+        deadline = self.loop.time() + timeout
+        while self.client.socket() is not None and \
+                self.loop.time() < deadline:
+            await asyncio.sleep(0.01)
+
+    def on_socket_open(self, client, userdata, sock):
+        # pylint: disable=unused-argument
+        self.loop.add_reader(sock, client.loop_read)
+
+    def on_socket_close(self, client, userdata, sock):
+        # pylint: disable=unused-argument
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        # pylint: disable=unused-argument
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        # pylint: disable=unused-argument
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        delay = self.reconnect_delay
+        while True:
+            if self.client.loop_misc() == mqtt_client.MQTT_ERR_SUCCESS:
+                delay = self.reconnect_delay
+                await asyncio.sleep(1)
+                continue
+
+            logging.warning('MQTT connection lost, reconnecting in %ds',
+                            delay)
+            await asyncio.sleep(delay)
+            try:
+                self.client.reconnect()
+            except (socket.error, OSError) as err:
+                logging.error('Failed to reconnect to MQTT Broker: %s', err)
+                delay = min(delay * 2, self.max_reconnect_delay)
@@ -0,0 +1,949 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import concurrent.futures
+import json
+import logging
+import time
+
+from paho.mqtt import client as mqtt_client
+
+import src.telldus as telldus
+from src.aggregate import Aggregator
+from src.aio import MqttAsyncioHelper
+from src.config import as_bool
+from src.discovery import DiscoveryCache
+from src.filters import Deduplicator, PublishFilter
+from src.journal import Journal
+from src.metrics import Metrics, MetricsServer
+from src.pipeline import BLOCK, DROP_OLDEST, EventQueue
+from src.profiling import Profiler
+from src.publisher import AsyncioPublisher, Publisher, TopicAliases
+from src.registry import RawRegistry
+from src.scheduler import CommandScheduler, ControllerSchedulers
+from src.states import DeviceStates, StateTable
+from src.telldus import const
+
+TYPES = {const.TELLSTICK_TEMPERATURE: 'temperature',
+         const.TELLSTICK_HUMIDITY: 'humidity',
+         const.TELLSTICK_RAINRATE: 'rainrate',
+         const.TELLSTICK_RAINTOTAL: 'raintotal',
+         const.TELLSTICK_WINDDIRECTION: 'winddirection',
+         const.TELLSTICK_WINDAVERAGE: 'windaverage',
+         const.TELLSTICK_WINDGUST: 'windgust'}
+
+sensor_log = logging.getLogger('telldus-core-mqtt.sensor')
+device_log = logging.getLogger('telldus-core-mqtt.device')
+command_log = logging.getLogger('telldus-core-mqtt.command')
+
+METHODS = {const.TELLSTICK_TURNON: 'turn on',
+           const.TELLSTICK_TURNOFF: 'turn off',
+           const.TELLSTICK_BELL: 'bell',
+           const.TELLSTICK_TOGGLE: 'toggle',
+           const.TELLSTICK_DIM: 'dim',
+           const.TELLSTICK_LEARN: 'learn',
+           const.TELLSTICK_EXECUTE: 'execute',
+           const.TELLSTICK_UP: 'up',
+           const.TELLSTICK_DOWN: 'down',
+           const.TELLSTICK_STOP: 'stop'}
+
+# CommandScheduler actions as telldus-core methods
+ACTIONS = {'turn_on': const.TELLSTICK_TURNON,
+           'turn_off': const.TELLSTICK_TURNOFF,
+           'dim': const.TELLSTICK_DIM}
+
+
+def connect_mqtt(config, client_id, on_connected=None,
+                 loop=None) -> mqtt_client:
+    def on_connect(client, userdata, flags, return_code, properties=None):
+        # pylint: disable=unused-argument
+        if return_code == 0:
+            reconnected = getattr(client, 'connected_flag', False)
+            client.connected_flag = True
+            # Topic aliases the broker accepts, MQTT 5 only
+            client.topic_alias_maximum = getattr(
+                properties, 'TopicAliasMaximum', 0)
+            logging.info('Connected to MQTT Broker as %s.', client_id)
+            if on_connected is not None:
+                on_connected(client, reconnected)
+        else:
+            logging.critical('Failed to connect, return code %s', return_code)
+
+    if as_bool(config['mqtt']['v5']):
+        client = mqtt_client.Client(client_id, protocol=mqtt_client.MQTTv5)
+    else:
+        client = mqtt_client.Client(client_id)
+    client.username_pw_set(config['mqtt']['user'], config['mqtt']['pass'])
+    client.on_connect = on_connect
+
+    # The socket callbacks must be in place before connecting
+    if loop is not None:
+        client.asyncio_helper = MqttAsyncioHelper(loop, client)
+
+    client.connect(config['mqtt']['broker'], int(config['mqtt']['port']))
+
+    return client
+
+
+class Bridge:
+    # Connects telldus-core events to MQTT and MQTT commands to
+    # telldus-core. core is used for sensor and device lookups, loop is
+    # the event loop the telldus-core callbacks are dispatched on.
+    def __init__(self, config, core, loop):
+        self.config = config
+        self.loop = loop
+        self.asyncio_mode = as_bool(config['mqtt']['asyncio'])
+        self.status_topic = '{}/status'.format(
+            config['home_assistant']['config_topic'])
+        self.set_topic = '{}/+/+/set'.format(
+            config['home_assistant']['state_topic'])
+        self.state_snapshot_topic = '{}/snapshot'.format(
+            config['home_assistant']['state_topic'])
+        self.state_request_topic = '{}/get'.format(self.state_snapshot_topic)
+        self.group_topic = '{}/group/+/set'.format(
+            config['home_assistant']['state_topic'])
+        self.profile_topic = '{}/profile/set'.format(
+            config['home_assistant']['state_topic'])
+        self.groups = {str(name): [int(device_id) for device_id in ids]
+                       for name, ids in (config['groups'] or {}).items()}
+
+        # Blocking telldus-core calls outside of the event handlers are
+        # run in a bounded executor
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='telldus-core')
+
+        self.snapshot_path = None
+        self.snapshot_interval = int(config['snapshot']['interval'])
+        if as_bool(config['snapshot']['enabled']):
+            self.snapshot_path = config['snapshot']['path']
+        self.discovery = DiscoveryCache(self.snapshot_path)
+        self.discovery.load()
+
+        self.dedup_sensor = Deduplicator(
+            config['dedup']['sensor']['window'],
+            config['dedup']['sensor']['entities'])
+        self.dedup_raw = Deduplicator(config['dedup']['raw']['window'],
+                                      config['dedup']['raw']['entities'])
+        self.publish_filter = PublishFilter(config['publish']['types'],
+                                            config['publish']['sensors'])
+        self.aggregator = Aggregator(config['aggregate']['types'],
+                                     config['aggregate']['sensors'])
+
+        self.states = None
+        self.states_interval = int(config['state_table']['interval'])
+        if as_bool(config['state_table']['enabled']):
+            self.states = StateTable(config['home_assistant']['state_topic'])
+
+        self.profiler = None
+        self.profile_duration = float(config['profiling']['duration'])
+        self._profile_timer = None
+        if as_bool(config['profiling']['enabled']):
+            self.profiler = Profiler(
+                config['profiling']['path'],
+                (self.sensor_event, self.device_event, self.raw_event,
+                 self.device_change_event, self.on_message,
+                 self.on_group_message))
+
+        self.metrics = None
+        self.metrics_server = None
+        if as_bool(config['metrics']['enabled']):
+            self.metrics = Metrics()
+
+        self.s = telldus.Sensor(core, config)
+        self.s.aggregator = self.aggregator
+        self.device_states = DeviceStates(config['telldus']['device_state'])
+        self.d = telldus.Device(core, config)
+        self.d.states = self.device_states
+        controller_devices = config['controllers']['devices']
+        if controller_devices:
+            self.d.scheduler = ControllerSchedulers(
+                self.d.transmit, config['telldus']['repeat_cmd'],
+                controller_devices, self.on_command_complete)
+        else:
+            self.d.scheduler = CommandScheduler(
+                self.d.transmit, config['telldus']['repeat_cmd'],
+                self.on_command_complete)
+        self.raw = telldus.Command(core, config)
+        # Binary sensors learned from raw events are kept per receiving
+        # controller
+        self.controller_topics = as_bool(config['controllers']['topics'])
+        raw_entities = config['raw_entities']
+        self.raw_registry = RawRegistry(
+            raw_entities['max_entities'], raw_entities['expire'],
+            raw_entities['sightings'], raw_entities['window'],
+            raw_entities['allow'], raw_entities['deny'])
+
+        self.mqtt = None
+        self.publisher = None
+        self.callbacks = []
+        self.dispatcher = None
+
+    def connect(self, client_id):
+        # Setting up MQTT connection, shared by sensors, devices, raw
+        # commands and the device subscription
+        queue_policy = self.config['mqtt']['queue_policy']
+        if self.asyncio_mode and queue_policy == BLOCK:
+            # Blocking would stall the event loop that empties the queue
+            logging.warning('Queue policy "%s" not supported in asyncio '
+                            'mode, using "%s"', BLOCK, DROP_OLDEST)
+            queue_policy = DROP_OLDEST
+        queue = EventQueue(self.config['mqtt']['queue_size'], queue_policy)
+
+        journal = None
+        if as_bool(self.config['journal']['enabled']):
+            journal = Journal(self.config['journal']['path'],
+                              self.config['journal']['size'])
+        replay_rate = self.config['journal']['rate']
+
+        if self.asyncio_mode:
+            self.mqtt = connect_mqtt(self.config, client_id,
+                                     self.on_mqtt_connected, self.loop)
+            self.publisher = AsyncioPublisher(
+                self.mqtt, self.loop, self.config['mqtt']['max_inflight'],
+                self.config['mqtt']['batch_size'], queue=queue,
+                journal=journal, replay_rate=replay_rate)
+        else:
+            self.mqtt = connect_mqtt(self.config, client_id,
+                                     self.on_mqtt_connected)
+            self.publisher = Publisher(
+                self.mqtt, self.config['mqtt']['max_inflight'],
+                self.config['mqtt']['batch_size'], queue=queue,
+                journal=journal, replay_rate=replay_rate)
+        if as_bool(self.config['mqtt']['v5']):
+            self.publisher.aliases = TopicAliases()
+        self.publisher.start()
+
+        if self.metrics is not None:
+            self.publisher.latency = self.metrics.publish_latency
+            self.register_metrics()
+
+    def register_metrics(self):
+        # Counters and gauges the bridge already keeps, read on scrape
+        metrics = self.metrics
+        queue = self.publisher.queue
+        scheduler = self.d.scheduler
+
+        metrics.callback('telldus_mqtt_publish_total',
+                         'Messages handed to the MQTT connection',
+                         lambda: {('success',): self.publisher.sent,
+                                  ('failure',): self.publisher.failed},
+                         ('result',), 'counter')
+        metrics.callback('telldus_mqtt_connected',
+                         'Connected to the MQTT server',
+                         lambda: int(self.mqtt.is_connected()))
+        metrics.callback('telldus_mqtt_queue_depth',
+                         'Messages waiting to be published',
+                         self.publisher.depth)
+        metrics.callback('telldus_mqtt_queue_high_water',
+                         'Highest number of messages waiting',
+                         lambda: queue.high_water)
+        metrics.callback('telldus_mqtt_queue_dropped_total',
+                         'Messages dropped because the queue was full',
+                         lambda: queue.dropped, type_='counter')
+        if self.publisher.journal is not None:
+            journal = self.publisher.journal
+            metrics.callback('telldus_mqtt_journal_depth',
+                             'Messages in the journal waiting for replay',
+                             lambda: len(journal))
+            metrics.callback('telldus_mqtt_journal_dropped_total',
+                             'Messages dropped because the journal was full',
+                             lambda: journal.dropped, type_='counter')
+        metrics.callback('telldus_mqtt_inflight',
+                         'Messages handed to the MQTT connection not yet '
+                         'sent', self.publisher.inflight)
+        metrics.callback('telldus_command_queue_depth',
+                         'Commands waiting for transmission',
+                         scheduler.pending)
+        if isinstance(scheduler, ControllerSchedulers):
+            metrics.callback('telldus_controller_command_queue_depth',
+                             'Commands waiting for transmission per '
+                             'controller', scheduler.pending_by_controller,
+                             ('controller',))
+        metrics.callback('telldus_commands_coalesced_total',
+                         'Commands replaced by a newer one for the device',
+                         lambda: scheduler.coalesced, type_='counter')
+        metrics.callback('telldus_command_failures_total',
+                         'Failed transmissions',
+                         lambda: scheduler.failed, type_='counter')
+        metrics.callback('telldus_events_forwarded_total',
+                         'Events passed on after duplicate suppression',
+                         lambda: {('sensor',): self.dedup_sensor.forwarded,
+                                  ('raw',): self.dedup_raw.forwarded},
+                         ('kind',), 'counter')
+        metrics.callback('telldus_events_suppressed_total',
+                         'Events not published',
+                         lambda: {
+                             ('sensor', 'duplicate'):
+                                 self.dedup_sensor.suppressed,
+                             ('raw', 'duplicate'): self.dedup_raw.suppressed,
+                             ('sensor', 'filtered'):
+                                 self.publish_filter.filtered,
+                             ('sensor', 'aggregated'):
+                                 self.aggregator.aggregated,
+                             ('raw', 'rejected'):
+                                 self.raw_registry.rejected},
+                         ('kind', 'reason'), 'counter')
+        metrics.callback('telldus_raw_entities',
+                         'Binary sensors learned from raw events',
+                         lambda: len(self.raw_registry))
+        metrics.callback('telldus_raw_entities_evicted_total',
+                         'Binary sensors removed when full or idle',
+                         lambda: self.raw_registry.evicted, type_='counter')
+
+    def log_stats(self):
+        # Counters of the event path, logged on shutdown so they are also
+        # seen without the metrics endpoint
+        stats = {'Sensor events': self.dedup_sensor.stats(),
+                 'Raw events': self.dedup_raw.stats(),
+                 'Publish filter': self.publish_filter.stats(),
+                 'Aggregation': self.aggregator.stats(),
+                 'Raw entities': self.raw_registry.stats()}
+        if self.publisher.journal is not None:
+            stats['MQTT journal'] = self.publisher.journal.stats()
+        for name, counters in stats.items():
+            logging.info('%s: %s', name, ', '.join(
+                '{} {}'.format(key, value)
+                for key, value in counters.items()))
+
+    def collect(self):
+        # Topics of all sensors and devices in telldus-core
+        devices = self.d.get()
+        topics = self.s.create_topics(self.s.get()) + \
+            self.d.create_topics(devices)
+        self.check_controllers([device['device'].id for device in devices])
+        # Group commands need the RF addresses, read them here so a group
+        # message does not have to
+        for device_ids in self.groups.values():
+            self.d.load_addresses(device_ids)
+        return topics
+
+    def check_controllers(self, device_ids):
+        # telldus-core has no call for the controller that sends a device,
+        # the map under controllers devices is written by hand. Check it
+        # against the controllers telldusd reports.
+        scheduler = self.d.scheduler
+        if not isinstance(scheduler, ControllerSchedulers):
+            return
+        connected = self.d.controller_ids()
+        if connected is not None:
+            for controller_id in scheduler.schedulers:
+                if controller_id not in connected:
+                    logging.warning('Controller %s in controllers devices '
+                                    'is not connected to telldusd',
+                                    controller_id)
+        unrouted = scheduler.unrouted(device_ids)
+        if unrouted:
+            logging.warning('Devices %s are not listed under controllers '
+                            'devices, their commands share the default '
+                            'queue', ', '.join(str(id_) for id_ in unrouted))
+
+    def load(self):
+        # On program start, collect sensors and devices to publish to
+        # MQTT server
+        self.load_raw_registry()
+        self.initial_publish(self.collect())
+
+    def connect_and_load(self, client_id):
+        # Reading sensors and devices from telldus-core and connecting to
+        # the MQTT server both wait on IO, do them at the same time. The
+        # initial messages are queued until the connection is up.
+        topics = self.executor.submit(self.collect)
+        self.connect(client_id)
+        self.load_raw_registry()
+        self.initial_publish(topics.result())
+
+    def register(self, core):
+        # Events to listen for from telldus-core, core must have been
+        # created with a callback dispatcher for self.loop
+        self.dispatcher = core.callback_dispatcher
+        self.callbacks.append(core.register_raw_device_event(self.raw_event))
+        self.callbacks.append(core.register_device_event(self.device_event))
+        self.callbacks.append(core.register_device_change_event(
+            self.device_change_event))
+        self.callbacks.append(core.register_sensor_event(self.sensor_event))
+
+    def start(self):
+        self.d.scheduler.start()
+        self.subscribe_device(self.mqtt)
+
+        if self.snapshot_path is not None:
+            self.loop.call_later(self.snapshot_interval, self.save_snapshot)
+
+        if self.aggregator.active:
+            self.loop.call_later(1, self.publish_aggregates)
+
+        if self.raw_registry.expire > 0:
+            self.loop.call_later(min(self.raw_registry.expire, 60),
+                                 self.expire_raw)
+
+        if self.states is not None and self.states_interval > 0:
+            self.loop.call_later(self.states_interval,
+                                 self.publish_states_periodic)
+
+        if self.metrics is not None:
+            try:
+                self.metrics_server = MetricsServer(
+                    self.metrics, self.config['metrics']['host'],
+                    self.config['metrics']['port'])
+                self.metrics_server.start()
+            except OSError as err:
+                logging.error('Failed to start metrics endpoint: %s', err)
+
+        if self.asyncio_mode:
+            self.mqtt.asyncio_helper.start()
+        else:
+            self.mqtt.loop_start()
+
+    def stop(self):
+        # Called after the event loop stopped
+        self.discovery.save()
+        self.log_stats()
+
+        self.mqtt.unsubscribe(self.set_topic)
+        if self.states is not None:
+            self.mqtt.unsubscribe(self.state_request_topic)
+        if self.groups:
+            self.mqtt.unsubscribe(self.group_topic)
+        if self.profiler is not None:
+            self.mqtt.unsubscribe(self.profile_topic)
+
+        self.publisher.stop(timeout=5)
+        if self.asyncio_mode:
+            # run_forever has returned, the loop is run again until the
+            # DISCONNECT is written
+            self.mqtt.asyncio_helper.stop()
+            self.loop.run_until_complete(
+                self.mqtt.asyncio_helper.disconnect(timeout=5))
+        else:
+            self.mqtt.disconnect()
+            self.mqtt.loop_stop()
+
+        self.d.scheduler.stop(timeout=5)
+        self.executor.shutdown(wait=False)
+
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+        # Last, the profile covers the shutdown and writing it cannot hold
+        # up the rest
+        self.stop_profiling()
+
+    def received_at(self):
+        # Arrival of the telldus-core event being handled, before it waited
+        # in the event loop, if the dispatcher records it
+        received_at = getattr(self.dispatcher, 'received_at', None)
+        return received_at if received_at is not None else time.monotonic()
+
+    def publish_mqtt(self, topic, msg, received_at=None):
+        self.publisher.publish(topic, msg, received_at=received_at)
+
+    def publish_state(self, topic, msg, received_at=None):
+        self.discovery.record_state(topic, msg)
+        if self.states is not None:
+            self.states.update(topic, msg)
+        self.publish_mqtt(topic, msg, received_at)
+
+    def publish_config(self, topics):
+        # Only publish discovery configs that changed since last sent
+        for topic in topics:
+            if 'config' not in topic:
+                continue
+            if self.discovery.changed(topic['config']['topic'],
+                                      topic['config']['data']):
+                self.publish_mqtt(topic['config']['topic'],
+                                  topic['config']['data'])
+
+    def initial_publish(self, topics):
+        # Both configs and states are skipped if unchanged since the last
+        # run when a snapshot is used
+        self.publish_config(topics)
+        for topic in topics:
+            if 'state' not in topic:
+                continue
+            if self.states is not None:
+                self.states.update(topic['state']['topic'],
+                                   topic['state']['data'])
+            if self.discovery.state_changed(topic['state']['topic'],
+                                            topic['state']['data']):
+                self.publish_mqtt(topic['state']['topic'],
+                                  topic['state']['data'])
+
+    def save_snapshot(self):
+        self.discovery.save()
+        self.loop.call_later(self.snapshot_interval, self.save_snapshot)
+
+    def load_raw_registry(self):
+        # Binary sensors published in earlier runs are in the snapshot, add
+        # them so they are bounded and expire like new ones
+        evicted = []
+        for topic, _payload in self.discovery.configs():
+            command_id = self.raw.command_id(topic)
+            if command_id is None:
+                continue
+            if self.raw_registry.accepts(command_id):
+                evicted.extend(self.raw_registry.add(command_id))
+            else:
+                evicted.append(command_id)
+        self.remove_raw(evicted)
+
+    def remove_raw(self, command_ids):
+        # An empty retained config removes the entity from Home Assistant,
+        # the empty state removes the retained state from the broker
+        raw = self.raw
+        for command_id in command_ids:
+            for topic in (raw.config_topic(command_id),
+                          raw.create_topic(command_id, 'binary_sensor')):
+                self.discovery.forget(topic)
+                if self.states is not None:
+                    self.states.remove(topic)
+                self.publish_mqtt(topic, '')
+            raw.forget(command_id)
+            command_log.info('Removed binary sensor %s', command_id)
+
+    def expire_raw(self):
+        self.remove_raw(self.raw_registry.expired())
+        self.loop.call_later(min(self.raw_registry.expire, 60),
+                             self.expire_raw)
+
+    def publish_aggregates(self):
+        # One state per ended window, and the window statistics when
+        # attributes are enabled for the sensor
+        s = self.s
+        for id_, type_string, value, summary, settings in \
+                self.aggregator.expired():
+            self.publish_state(s.create_topic(id_, type_string),
+                               s.create_topic_data(type_string, value))
+            if settings['attributes']:
+                self.publish_state(s.attributes_topic(id_, type_string),
+                                   json.dumps(summary))
+        self.loop.call_later(1, self.publish_aggregates)
+
+    def publish_states(self):
+        # All latest states combined in one message
+        self.publish_mqtt(self.state_snapshot_topic, self.states.snapshot())
+
+    def publish_states_periodic(self):
+        self.publish_states()
+        self.loop.call_later(self.states_interval,
+                             self.publish_states_periodic)
+
+    def set_device_state(self, device_id, method, value=None,
+                         received_at=None):
+        # Publishes the device state when it differs from the known one
+        state = self.device_states.set(device_id, method, value)
+        if state is None:
+            return
+
+        d = self.d
+        if method == const.TELLSTICK_DIM:
+            topic = d.create_topic(device_id, 'light')
+            topic_data = d.create_topic_data('light', state[1])
+        else:
+            topic = d.create_topic(device_id, 'switch')
+            topic_data = d.create_topic_data('switch', method)
+        self.publish_state(topic, topic_data, received_at)
+
+    def subscribe_device(self, client: mqtt_client):
+        logging.debug('Subscribing to MQTT device events')
+
+        client.subscribe(self.set_topic)
+        client.subscribe(self.status_topic)
+        client.on_message = self.on_message
+        client.message_callback_add(self.status_topic, self.on_status)
+        if self.states is not None:
+            client.subscribe(self.state_request_topic)
+            client.message_callback_add(self.state_request_topic,
+                                        self.on_state_request)
+        if self.groups:
+            # Also matches the device set topic, the callback takes
+            # precedence over on_message
+            client.subscribe(self.group_topic)
+            client.message_callback_add(self.group_topic,
+                                        self.on_group_message)
+        if self.profiler is not None:
+            client.subscribe(self.profile_topic)
+            client.message_callback_add(self.profile_topic,
+                                        self.on_profile_request)
+
+    def run_blocking(self, function, *args):
+        # Handlers that call telldus-core are run in the executor in
+        # asyncio mode, the event loop must not wait on its IPC
+        future = self.loop.run_in_executor(self.executor, function, *args)
+        future.add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.error('Handling an MQTT message failed',
+                          exc_info=future.exception())
+
+    def on_message(self, client, userdata, msg):
+        # pylint: disable=unused-argument
+        # Command latency is measured from here
+        received_at = time.monotonic()
+        device_id = msg.topic.split('/')[1]
+        if not device_id.isdigit():
+            # e.g. a group command while no groups are configured
+            logging.warning('Ignoring "%s", not a device topic', msg.topic)
+            return
+        if self.asyncio_mode and not self.d.loaded([device_id]):
+            # A device not in the registry is looked up in telldus-core
+            self.run_blocking(self.handle_message, msg, received_at)
+            return
+        self.handle_message(msg, received_at)
+
+    def handle_message(self, msg, received_at=None):
+        d = self.d
+        optimistic = self.device_states.optimistic
+        payload = msg.payload.decode()
+        command_log.info('Received "%s" from "%s" topic', payload, msg.topic)
+        levels = msg.topic.split('/')
+        device_id = levels[1]
+        module = levels[2]
+        action = levels[3]
+        cmd_status = False
+
+        if module == 'light':
+            if action == 'dim':
+                command_log.debug('[DEVICE] Sending command DIM "%s" to '
+                                  'device id %s', payload, device_id)
+                level = int(payload)
+                cmd_status = d.dim(device_id, level, received_at)
+            else:
+                level = None
+                if int(payload) == int(const.TELLSTICK_TURNON):
+                    command_log.debug('[DEVICE] Sending command DIM 255 to '
+                                      'device id %s', device_id)
+                    level = 255
+                    cmd_status = d.dim(device_id, level, received_at)
+
+                if int(payload) == int(const.TELLSTICK_TURNOFF):
+                    command_log.debug('[DEVICE] Sending command DIM 0 to '
+                                      'device id %s', device_id)
+                    level = 0
+                    cmd_status = d.dim(device_id, level, received_at)
+
+            if cmd_status and optimistic:
+                self.set_device_state(device_id, const.TELLSTICK_DIM, level)
+
+        if action != 'dim' and module != 'light':
+            if int(payload) == int(const.TELLSTICK_TURNON):
+                command_log.debug('[DEVICE] Sending command ON to device '
+                                  'id %s', device_id)
+                cmd_status = d.turn_on(device_id, received_at)
+                if cmd_status and optimistic:
+                    self.set_device_state(device_id, const.TELLSTICK_TURNON)
+
+            if int(payload) == int(const.TELLSTICK_TURNOFF):
+                command_log.debug('[DEVICE] Sending command OFF to device '
+                                  'id %s', device_id)
+                cmd_status = d.turn_off(device_id, received_at)
+                if cmd_status and optimistic:
+                    self.set_device_state(device_id, const.TELLSTICK_TURNOFF)
+
+        # if int(msg.payload.decode()) == int(const.TELLSTICK_BELL):
+        #     logging.debug('[DEVICE] Sending command BELL to device '
+        #                 'id %s', device_id)
+        #     cmd_status = d.bell(device_id)
+
+        # if int(msg.payload.decode()) == int(const.TELLSTICK_EXECUTE):
+        #     logging.debug('[DEVICE] Sending command EXECUTE to device '
+        #                 'id %s', device_id)
+        #     cmd_status = d.execute(device_id)
+
+        # if int(msg.payload.decode()) == int(const.TELLSTICK_UP):
+        #     logging.debug('[DEVICE] Sending command UP to device id %s',
+        #                 device_id)
+        #     cmd_status = d.up(device_id)
+
+        # if int(msg.payload.decode()) == int(const.TELLSTICK_DOWN):
+        #     logging.debug('[DEVICE] Sending command DOWN to device id %s',
+        #                 device_id)
+        #     cmd_status = d.down(device_id)
+
+        # if int(msg.payload.decode()) == int(const.TELLSTICK_STOP):
+        #     logging.debug('[DEVICE] Sending command STOP to device id %s',
+        #                 device_id)
+        #     cmd_status = d.stop(device_id)
+
+        if not cmd_status:
+            logging.debug('[DEVICE] Command "%s" not supported, please open'
+                          ' a github issue with this message.', msg)
+
+    def on_group_message(self, client, userdata, msg):
+        # pylint: disable=unused-argument
+        received_at = time.monotonic()
+        device_ids = self.groups.get(msg.topic.split('/')[-2], ())
+        if self.asyncio_mode and not self.d.loaded(device_ids, address=True):
+            # Unknown devices and addresses are read from telldus-core
+            self.run_blocking(self.handle_group_message, msg, received_at)
+            return
+        self.handle_group_message(msg, received_at)
+
+    def handle_group_message(self, msg, received_at=None):
+        payload = msg.payload.decode()
+        command_log.info('Received "%s" from "%s" topic', payload, msg.topic)
+        name = msg.topic.split('/')[-2]
+        device_ids = self.groups.get(name)
+        if device_ids is None:
+            logging.warning('Unknown group "%s"', name)
+            return
+
+        try:
+            method = int(payload)
+        except ValueError:
+            method = None
+        if method not in (const.TELLSTICK_TURNON, const.TELLSTICK_TURNOFF):
+            logging.debug('[GROUP] Command "%s" not supported for group '
+                          '"%s"', payload, name)
+            return
+
+        turn_on = method == const.TELLSTICK_TURNON
+        command_log.debug('[GROUP] Sending command %s to group "%s"',
+                          'ON' if turn_on else 'OFF', name)
+        devices = self.d.send_group(device_ids, turn_on, name,
+                                    self.on_group_complete, received_at)
+
+        if self.device_states.optimistic:
+            for device in devices:
+                if device.type == 'light':
+                    self.set_device_state(device.id, const.TELLSTICK_DIM,
+                                          255 if turn_on else 0)
+                else:
+                    self.set_device_state(device.id, method)
+
+    def on_group_complete(self, batch):
+        # Called from the scheduler thread when the whole group is sent
+        logging.info('Group "%s" sent in %.2f s, %d commands', batch.name,
+                     batch.duration, batch.size)
+        if self.metrics is not None:
+            self.metrics.group_duration.observe(batch.duration)
+
+    def on_status(self, client, userdata, msg):
+        # pylint: disable=unused-argument
+        # Home Assistant birth message, it may have lost all discovery
+        # configs so send them again
+        if msg.payload.decode() == 'online':
+            logging.info('Home Assistant is online')
+            self.discovery.republish(self.publish_mqtt)
+
+    def on_state_request(self, client, userdata, msg):
+        # pylint: disable=unused-argument
+        logging.debug('Combined state requested on "%s"', msg.topic)
+        self.publish_states()
+
+    def on_profile_request(self, client, userdata, msg):
+        # pylint: disable=unused-argument
+        payload = msg.payload.decode().strip()
+        if payload.lower() == 'stop':
+            self.loop.call_soon_threadsafe(self.stop_profiling)
+            return
+
+        try:
+            duration = float(payload) if payload else None
+        except ValueError:
+            logging.warning('Profile duration "%s" is not a number', payload)
+            return
+        self.loop.call_soon_threadsafe(self.start_profiling, duration)
+
+    def toggle_profiling(self):
+        # Triggered with SIGUSR1
+        if self.profiler is None:
+            logging.warning('Profiling is not enabled')
+        elif self.profiler.running:
+            self.stop_profiling()
+        else:
+            self.start_profiling()
+
+    def start_profiling(self, duration=None):
+        # Runs on the event loop, the telldus-core callbacks are profiled
+        # there. In threaded mode the MQTT callbacks are swapped for
+        # profiled ones until stopped.
+        if not self.profiler.start():
+            logging.info('Profiling already running')
+            return
+
+        if not self.asyncio_mode:
+            self._set_message_callbacks(self.profiler.wrap)
+
+        if duration is None:
+            duration = self.profile_duration
+        if duration > 0:
+            self._profile_timer = self.loop.call_later(duration,
+                                                       self.stop_profiling)
+
+    def stop_profiling(self):
+        if self.profiler is None or not self.profiler.running:
+            return
+        if self._profile_timer is not None:
+            self._profile_timer.cancel()
+            self._profile_timer = None
+        if not self.asyncio_mode:
+            self._set_message_callbacks(lambda callback: callback)
+        self.profiler.stop()
+
+    def _set_message_callbacks(self, wrap):
+        self.mqtt.on_message = wrap(self.on_message)
+        if self.groups:
+            self.mqtt.message_callback_add(self.group_topic,
+                                           wrap(self.on_group_message))
+
+    def on_mqtt_connected(self, client, reconnected):
+        self.publisher.on_connected(reconnected)
+        if not reconnected:
+            return
+
+        if self.metrics is not None:
+            self.metrics.reconnects.inc()
+
+        # The broker may have restarted without persistence, resubscribe
+        # and send all discovery configs again
+        self.subscribe_device(client)
+        self.discovery.republish(self.publish_mqtt)
+
+    def on_command_complete(self, command):
+        # Called from the scheduler thread when all repeats are sent or
+        # failed, the failures are logged by the scheduler
+        if not command.sent:
+            return
+
+        if not self.device_states.optimistic:
+            for device in (command.device,) + command.shared:
+                self.loop.call_soon_threadsafe(
+                    self.set_device_state, device.id,
+                    ACTIONS[command.action], command.value)
+
+        if self.metrics is None:
+            return
+
+        self.metrics.commands.inc(command.action)
+        self.metrics.transmit_duration.observe(
+            time.monotonic() - command.first_sent_at)
+        self.metrics.command_latency.observe(
+            command.first_sent_at - command.queued_at)
+
+    def raw_event(self, data, controller_id, cid):
+        # pylint: disable=unused-argument
+        if self.metrics is not None:
+            self.metrics.events.inc('raw')
+        if 'command' not in data:
+            return
+        received_at = self.received_at()
+
+        raw = self.raw
+        command = raw.serialize(data)
+        if command is None:
+            return
+        if self.controller_topics:
+            command = command._replace(
+                id='{}_{}'.format(controller_id, command.id))
+
+        if self.dedup_raw.is_duplicate(
+                command.id,
+                (command.protocol, command.model, command.id, command.unit),
+                command.method):
+            return
+
+        accepted, evicted = self.raw_registry.sighting(command.id)
+        if evicted:
+            self.remove_raw(evicted)
+        if not accepted:
+            return
+
+        # Sensors can be added or discovered in telldus-core without
+        # a restart, ensure config topic for HASS
+        command_topics = raw.create_topics(raw.command_data(command))
+        self.publish_config(command_topics)
+
+        topic = raw.create_topic(command.id, 'binary_sensor')
+        topic_data = raw.create_topic_data('binary_sensor', command.method)
+
+        self.publish_state(topic, topic_data, received_at)
+
+    def device_event(self, id_, method, data, cid):
+        # pylint: disable=unused-argument
+        received_at = self.received_at()
+        if self.metrics is not None:
+            self.metrics.events.inc('device')
+        if method == const.TELLSTICK_DIM:
+            device_log.debug('[DEVICE EVENT LIGHT] [DEVICE] %s -> %s (%s) '
+                             '[%s]', id_, METHODS.get(method), method, data)
+        else:
+            device_log.debug('[DEVICE EVENT SWITCH] [DEVICE] %s -> %s (%s)',
+                             id_, METHODS.get(method, 'UNKNOWN METHOD'),
+                             method)
+        if not self.d.loaded([id_]):
+            # Devices can be added in telldus-core without a restart, it
+            # is read in the executor
+            self.loop.create_task(
+                self.add_device(id_, method, data, received_at))
+            return
+        # Unchanged when the event is the echo of a command already set
+        self.set_device_state(id_, method, data, received_at)
+
+    async def add_device(self, id_, method, data, received_at):
+        # Config topic for HASS and the state read from telldus-core go out
+        # before the state of the event
+        devices = await self.loop.run_in_executor(self.executor, self.d.get,
+                                                  id_)
+        self.initial_publish(self.d.create_topics(devices))
+        self.set_device_state(id_, method, data, received_at)
+
+    def device_change_event(self, id_, event, change_type, cid):
+        # pylint: disable=unused-argument
+        if self.metrics is not None:
+            self.metrics.events.inc('device_change')
+        logging.info('[DEVICE] %s changed in telldus-core, reloading '
+                     'devices', id_)
+        self.loop.create_task(self.reload_devices())
+
+    def sensor_event(self, protocol, model, id_, data_type, value,
+                     timestamp, cid):
+        # pylint: disable=unused-argument
+        received_at = self.received_at()
+        if self.metrics is not None:
+            self.metrics.events.inc('sensor')
+        s = self.s
+        type_string = TYPES.get(data_type)
+        if type_string is None:
+            type_string = 'UNKNOWN METHOD {0}'.format(data_type)
+        sensor_log.debug('[SENSOR] %s %s (%s) = %s', id_, model, type_string,
+                         value)
+
+        if self.dedup_sensor.is_duplicate(
+                id_, (protocol, model, id_, data_type), value):
+            return
+
+        # Sensors can be added or discovered in telldus-core without
+        # a restart, ensure config topic for HASS
+        sensor_topics, created = s.update(protocol, model, id_, data_type,
+                                          value)
+        if created:
+            self.publish_config(s.create_topics(sensor_topics))
+
+        if self.aggregator.add(id_, type_string, value):
+            return
+
+        if not self.publish_filter.should_publish(id_, type_string, value):
+            return
+
+        topic = s.create_topic(id_, type_string)
+        data = s.create_topic_data(type_string, value)
+        self.publish_state(topic, data, received_at)
+
+    async def reload_devices(self):
+        devices = await self.loop.run_in_executor(self.executor, self.d.get)
+        self.initial_publish(self.d.create_topics(devices))
+
+    async def reload_sensors(self):
+        sensors = await self.loop.run_in_executor(self.executor, self.s.get)
+        self.initial_publish(self.s.create_topics(sensors))
+
+    def refresh_registry(self):
+        # Reload sensors and devices after telldusd configuration changes,
+        # triggered with SIGHUP
+        logging.info('Refreshing sensor and device registry')
+        for telldus_object in (self.s, self.d, self.raw):
+            telldus_object.templates.clear()
+        self.loop.create_task(self.reload_sensors())
+        self.loop.create_task(self.reload_devices())
@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from pyaml_env import parse_config
+
+CONFIG_PATH = 'config_default.yaml'
+
+
+def load_config(path=CONFIG_PATH):
+    # Parsed once at startup and shared by everything that needs it
+    return parse_config(path)
+
+
+def as_bool(value):
+    # Values from environment variables are always strings
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
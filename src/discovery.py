@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+SNAPSHOT_VERSION = 1
+
+
+def config_hash(payload):
+    return hashlib.blake2b(payload.encode('utf-8'),
+                           digest_size=16).hexdigest()
+
+
+class DiscoveryCache:
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._hashes = {}
+        self._payloads = {}
+        self._states = {}
+        self._dirty = False
+
+    def changed(self, topic, payload):
+        # Returns True if the config differs from the last published one
+        # for the topic and records it as published.
+        if self._payloads.get(topic) is payload:
+            # Same cached config string as last time, skip hashing
+            return False
+        payload_hash = config_hash(payload)
+        with self._lock:
+            if self._hashes.get(topic) == payload_hash:
+                return False
+            self._hashes[topic] = payload_hash
+            self._payloads[topic] = payload
+            self._dirty = True
+        return True
+
+    def state_changed(self, topic, payload):
+        payload_hash = config_hash(payload)
+        with self._lock:
+            if self._states.get(topic) == payload_hash:
+                return False
+            self._states[topic] = payload_hash
+            self._dirty = True
+        return True
+
+    def record_state(self, topic, payload):
+        self.state_changed(topic, payload)
+
+    def forget(self, topic):
+        with self._lock:
+            self._hashes.pop(topic, None)
+            self._payloads.pop(topic, None)
+            self._states.pop(topic, None)
+            self._dirty = True
+
+    def configs(self):
+        with self._lock:
+            return list(self._payloads.items())
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def republish(self, publish):
+        # Resend every known config, used when the broker or Home
+        # Assistant has restarted and may have lost retained messages.
+        configs = self.configs()
+        logging.info('Republishing %d discovery configs', len(configs))
+        for topic, payload in configs:
+            publish(topic, payload)
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return False
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as stream:
+                snapshot = json.load(stream)
+        except (OSError, ValueError) as err:
+            logging.warning('Failed to read snapshot "%s": %s',
+                            self.path, err)
+            return False
+
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            logging.warning('Ignoring snapshot "%s" with unknown version',
+                            self.path)
+            return False
+
+        with self._lock:
+            for topic, config in snapshot.get('configs', {}).items():
+                self._hashes[topic] = config['hash']
+                self._payloads[topic] = config['payload']
+            self._states.update(snapshot.get('states', {}))
+            self._dirty = False
+
+        logging.info('Loaded %d discovery configs from snapshot "%s"',
+                     len(self._hashes), self.path)
+        return True
+
+    def save(self):
+        if self.path is None:
+            return False
+
+        with self._lock:
+            if not self._dirty:
+                return False
+            snapshot = {
+                'version': SNAPSHOT_VERSION,
+                'configs': {topic: {'hash': self._hashes[topic],
+                                    'payload': payload}
+                            for topic, payload in self._payloads.items()},
+                'states': dict(self._states)}
+            self._dirty = False
+
+        tmp_path = '{}.tmp'.format(self.path)
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as stream:
+                json.dump(snapshot, stream, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as err:
+            logging.error('Failed to write snapshot "%s": %s',
+                          self.path, err)
+            with self._lock:
+                self._dirty = True
+            return False
+
+        logging.debug('Saved snapshot "%s"', self.path)
+        return True
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import time
+
+
+class Deduplicator:
+    # 433 MHz senders repeat every frame several times, telldusd reports
+    # each copy as a separate event. An event with the same value as the
+    # previous one for the entity, seen within the window, is suppressed.
+    # The window starts at the last forwarded event, so a value repeated
+    # forever is still forwarded once per window.
+    MAX_ENTRIES = 10000
+
+    def __init__(self, window, windows=None):
+        self.window = float(window)
+        self.windows = {str(k): float(v) for k, v in (windows or {}).items()}
+        self.forwarded = 0
+        self.suppressed = 0
+        self._lock = threading.Lock()
+        # Ordered by the time the last event was forwarded
+        self._seen = collections.OrderedDict()
+        self._max_window = max([self.window] + list(self.windows.values()))
+
+    def window_for(self, entity_id):
+        return self.windows.get(str(entity_id), self.window)
+
+    def is_duplicate(self, entity_id, key, value, now=None):
+        window = self.window_for(entity_id)
+        if window <= 0:
+            with self._lock:
+                self.forwarded += 1
+            return False
+
+        if now is None:
+            now = time.monotonic()
+
+        with self._lock:
+            last = self._seen.get(key)
+            if last is not None and last[0] == value \
+                    and now - last[1] < window:
+                self.suppressed += 1
+                return True
+
+            self._seen[key] = (value, now)
+            self._seen.move_to_end(key)
+            self.forwarded += 1
+            self._prune(now)
+        return False
+
+    def _prune(self, now):
+        # Expired entries are popped from the front, past MAX_ENTRIES the
+        # oldest go even when still inside their window
+        seen = self._seen
+        while seen:
+            last = seen[next(iter(seen))]
+            if now - last[1] < self._max_window \
+                    and len(seen) <= self.MAX_ENTRIES:
+                break
+            seen.popitem(last=False)
+
+    def stats(self):
+        return {'forwarded': self.forwarded, 'suppressed': self.suppressed}
+
+
+class PublishFilter:
+    # Publish-on-change for sensor values. Settings are per data type with
+    # optional per sensor overrides, a reading is published when it moved
+    # outside the deadband of the last published value and min_interval
+    # has passed, or when max_interval has passed regardless of value.
+    DEFAULTS = {'deadband': 0.0,
+                'relative_deadband': 0.0,
+                'min_interval': 0.0,
+                'max_interval': 0.0}
+
+    def __init__(self, types=None, sensors=None):
+        self.types = types or {}
+        self.sensors = sensors or {}
+        self.published = 0
+        self.filtered = 0
+        self._lock = threading.Lock()
+        self._last = {}
+        self._settings = {}
+
+    def settings_for(self, entity_id, type_string):
+        key = (str(entity_id), type_string)
+        settings = self._settings.get(key)
+        if settings is None:
+            type_settings = self.types.get(type_string)
+            sensor_settings = self.sensors.get(str(entity_id), {}) \
+                .get(type_string)
+
+            if type_settings is None and sensor_settings is None:
+                settings = False
+            else:
+                settings = dict(self.DEFAULTS)
+                for overrides in (type_settings, sensor_settings):
+                    for name, value in (overrides or {}).items():
+                        settings[name] = float(value)
+            self._settings[key] = settings
+        return settings
+
+    def should_publish(self, entity_id, type_string, value, now=None):
+        settings = self.settings_for(entity_id, type_string)
+        if not settings:
+            self.published += 1
+            return True
+
+        if now is None:
+            now = time.monotonic()
+
+        key = (str(entity_id), type_string)
+        with self._lock:
+            last = self._last.get(key)
+            if last is None or self._changed(settings, last, value, now):
+                self._last[key] = (value, now)
+                self.published += 1
+                return True
+
+        self.filtered += 1
+        return False
+
+    @staticmethod
+    def _changed(settings, last, value, now):
+        last_value, last_time = last
+        elapsed = now - last_time
+
+        if settings['max_interval'] > 0 and \
+                elapsed >= settings['max_interval']:
+            return True
+
+        if elapsed < settings['min_interval']:
+            return False
+
+        try:
+            delta = abs(float(value) - float(last_value))
+            threshold = max(settings['deadband'],
+                            settings['relative_deadband']
+                            * abs(float(last_value)))
+        except (TypeError, ValueError):
+            return value != last_value
+
+        return delta > threshold
+
+    def stats(self):
+        return {'published': self.published, 'filtered': self.filtered}
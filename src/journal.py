@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL UNIQUE,
+    payload TEXT NOT NULL,
+    retain INTEGER NOT NULL,
+    created REAL NOT NULL
+)
+'''
+
+
+class Journal:
+    # Messages published while the MQTT server is unreachable, kept in an
+    # SQLite database so they also survive a restart. There is one row per
+    # topic, a newer message replaces the row and moves it last, so the
+    # journal is compacted to the latest message per topic and replays
+    # them in the order they were last published. At most maxsize rows are
+    # kept, the oldest are dropped when full.
+    def __init__(self, path, maxsize=100000):
+        self.path = path
+        self.maxsize = max(int(maxsize), 1)
+        self.dropped = 0
+        self.journaled = 0
+        self.replayed = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._db:
+            self._db.execute(SCHEMA)
+        self._count = self._db.execute(
+            'SELECT COUNT(*) FROM messages').fetchone()[0]
+
+        if self._count:
+            logging.info('Loaded %d unsent messages from journal "%s"',
+                         self._count, path)
+
+    def __len__(self):
+        return self._count
+
+    def __bool__(self):
+        return self._count > 0
+
+    def extend(self, items):
+        # items are (topic, msg, retain, ...) as popped from an EventQueue
+        now = time.time()
+        rows = [(item[0], item[1], int(item[2]), now) for item in items]
+        if not rows:
+            return
+
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO messages '
+                '(topic, payload, retain, created) VALUES (?, ?, ?, ?)',
+                rows)
+            count = self._db.execute(
+                'SELECT COUNT(*) FROM messages').fetchone()[0]
+            if count > self.maxsize:
+                self._db.execute(
+                    'DELETE FROM messages WHERE seq IN (SELECT seq FROM '
+                    'messages ORDER BY seq LIMIT ?)', (count - self.maxsize,))
+                self._drop(count - self.maxsize)
+                count = self.maxsize
+            self._count = count
+        self.journaled += len(rows)
+
+    def peek(self, limit):
+        # The oldest messages as (seq, topic, msg, retain)
+        with self._lock:
+            return [(seq, topic, payload, bool(retain))
+                    for seq, topic, payload, retain in self._db.execute(
+                        'SELECT seq, topic, payload, retain FROM messages '
+                        'ORDER BY seq LIMIT ?', (int(limit),))]
+
+    def remove(self, last_seq):
+        # Removes the messages up to and including last_seq once sent
+        with self._lock, self._db:
+            removed = self._db.execute(
+                'DELETE FROM messages WHERE seq <= ?', (last_seq,)).rowcount
+            self._count = max(self._count - removed, 0)
+        self.replayed += removed
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _drop(self, count):
+        self.dropped += count
+        logging.warning('MQTT journal full, dropped %d messages so far',
+                        self.dropped)
+
+    def stats(self):
+        return {'depth': self._count,
+                'journaled': self.journaled,
+                'replayed': self.replayed,
+                'dropped': self.dropped}
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import atexit
+import logging
+import logging.config
+import logging.handlers
+import queue
+import threading
+import time
+
+import yaml
+
+_LISTENER = None
+
+
+class RateLimitFilter(logging.Filter):
+    # Token bucket per logger name, lets through burst records at once and
+    # rate records per second after that. The next record let through
+    # reports how many were suppressed. Configured in logging.yaml for the
+    # loggers that log once per event or message.
+    def __init__(self, rate=10, burst=50):
+        super().__init__()
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def filter(self, record):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last, suppressed = self._buckets.get(
+                record.name, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            if tokens < 1:
+                self._buckets[record.name] = (tokens, now, suppressed + 1)
+                return False
+            self._buckets[record.name] = (tokens - 1, now, 0)
+
+        if suppressed and isinstance(record.args, tuple):
+            record.msg = '{} (%d similar suppressed)'.format(record.msg)
+            record.args = record.args + (suppressed,)
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Never blocks the caller, records are dropped when the queue is full.
+    # Records are formatted by the listener thread, not here.
+    def __init__(self, queue_):
+        super().__init__(queue_)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(path='./logging.yaml'):
+    # dictConfig with logging.yaml. When its queue section is enabled the
+    # root handlers are moved to a QueueListener thread and replaced by a
+    # QueueHandler, so log calls never wait for stdout. Python 3.12 can
+    # configure this in dictConfig itself, older versions can not.
+    global _LISTENER  # pylint: disable=global-statement
+    if _LISTENER is not None:
+        return
+
+    with open(path, 'r', encoding='utf-8') as stream:
+        config = yaml.load(stream, Loader=yaml.SafeLoader)
+
+    queue_config = config.pop('queue', {}) or {}
+    logging.config.dictConfig(config)
+
+    if not queue_config.get('enabled', False):
+        return
+
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    records = queue.Queue(int(queue_config.get('size', 10000)))
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(DroppingQueueHandler(records))
+
+    _LISTENER = logging.handlers.QueueListener(
+        records, *handlers, respect_handler_level=True)
+    _LISTENER.start()
+    atexit.register(_LISTENER.stop)
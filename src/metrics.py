@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import bisect
+import http.server
+import logging
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+TRANSMIT_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 30)
+
+
+def _format_labels(names, values, extra=''):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                              .replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.type = 'counter'
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = \
+                self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        if not values and not self.labels:
+            values = [((), 0)]
+        return [(self.name + _format_labels(self.labels, label_values),
+                 value) for label_values, value in values]
+
+
+class Callback:
+    # Value read when scraped, for counters and gauges the bridge already
+    # keeps. function returns a number, or a dict of label values to
+    # numbers when labels are given.
+    def __init__(self, name, help_, function, labels=(), type_='gauge'):
+        self.name = name
+        self.help = help_
+        self.type = type_
+        self.labels = tuple(labels)
+        self.function = function
+
+    def samples(self):
+        value = self.function()
+        if not self.labels:
+            return [(self.name, value)]
+        return [(self.name + _format_labels(self.labels, label_values),
+                 label_value)
+                for label_values, label_value in value.items()]
+
+
+class Histogram:
+    def __init__(self, name, help_, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_
+        self.type = 'histogram'
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def samples(self):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            samples.append((self.name + '_bucket' + _format_labels(
+                (), (), 'le="{}"'.format(_format_value(bound))), cumulative))
+        samples.append((self.name + '_sum', total))
+        samples.append((self.name + '_count', cumulative))
+        return samples
+
+
+class Metrics:
+    # Metrics of the bridge in the Prometheus text format. Hot path
+    # metrics are updated where they happen, everything the bridge already
+    # counts is added with callback() and read on scrape.
+    def __init__(self):
+        self.events = Counter('telldus_events_total',
+                              'Events received from telldus-core', ('kind',))
+        self.commands = Counter('telldus_commands_total',
+                                'Commands sent with all repeats',
+                                ('action',))
+        self.transmit_duration = Histogram(
+            'telldus_command_transmit_seconds',
+            'Time from first to last transmission of a command',
+            TRANSMIT_BUCKETS)
+        self.group_duration = Histogram(
+            'telldus_group_transmit_seconds',
+            'Time from group set message to last transmission',
+            TRANSMIT_BUCKETS)
+        self.command_latency = Histogram(
+            'telldus_command_latency_seconds',
+            'Time from MQTT set message to first transmission')
+        self.publish_latency = Histogram(
+            'telldus_publish_latency_seconds',
+            'Time from telldus-core event to MQTT publish')
+        self.reconnects = Counter('telldus_mqtt_reconnects_total',
+                                  'Reconnects to the MQTT server')
+        self._metrics = [self.events, self.commands, self.transmit_duration,
+                         self.group_duration, self.command_latency,
+                         self.publish_latency, self.reconnects]
+
+    def callback(self, name, help_, function, labels=(), type_='gauge'):
+        self._metrics.append(Callback(name, help_, function, labels, type_))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as err:  # pylint: disable=broad-except
+                logging.debug('Failed to collect metric %s: %s',
+                              metric.name, err)
+                continue
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, value in samples:
+                lines.append('{} {}'.format(name, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        # pylint: disable=invalid-name
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        logging.debug('[METRICS] ' + format, *args)
+
+
+class MetricsServer:
+    def __init__(self, metrics, host, port):
+        handler = type('Handler', (MetricsHandler,), {'metrics': metrics})
+        self.server = http.server.ThreadingHTTPServer((host, int(port)),
+                                                      handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name='telldus-metrics', daemon=True)
+        self._thread.start()
+        logging.info('Metrics available on http://%s:%d/metrics',
+                     *self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
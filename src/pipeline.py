@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import threading
+import time
+
+KEEP_LATEST = 'keep_latest'
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+POLICIES = (KEEP_LATEST, DROP_OLDEST, BLOCK)
+
+
+class EventQueue:
+    # Bounded queue between the telldus-core events and the MQTT
+    # connection. keep_latest holds one message per topic, a newer message
+    # replaces the queued one in place, which matches retained state
+    # semantics. drop_oldest and block keep every message, when full the
+    # oldest is dropped or the caller waits up to block_timeout for room.
+    # A put with block=False never waits, it drops like drop_oldest.
+    # Items are popped as (topic, msg, retain, queued_at), queued_at is the
+    # time.monotonic() of the put unless given, e.g. the arrival of the
+    # telldus-core event.
+    def __init__(self, maxsize=10000, policy=KEEP_LATEST, block_timeout=5):
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy "{}", use one of {}'
+                             .format(policy, ', '.join(POLICIES)))
+
+        self.maxsize = max(int(maxsize), 1)
+        self.policy = policy
+        self.block_timeout = float(block_timeout)
+        self.dropped = 0
+        self.replaced = 0
+        self.high_water = 0
+        self._condition = threading.Condition()
+
+        if policy == KEEP_LATEST:
+            self._items = collections.OrderedDict()
+        else:
+            self._items = collections.deque()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __bool__(self):
+        return len(self._items) > 0
+
+    def put(self, topic, msg, retain=True, queued_at=None, block=True):
+        if queued_at is None:
+            queued_at = time.monotonic()
+        with self._condition:
+            if self.policy == KEEP_LATEST:
+                if topic in self._items:
+                    self.replaced += 1
+                elif len(self._items) >= self.maxsize:
+                    self._drop()
+                self._items[topic] = (msg, retain, queued_at)
+            else:
+                if len(self._items) >= self.maxsize and \
+                        self.policy == BLOCK and block:
+                    self._condition.wait_for(
+                        lambda: len(self._items) < self.maxsize,
+                        timeout=self.block_timeout)
+                if len(self._items) >= self.maxsize:
+                    self._drop()
+                self._items.append((topic, msg, retain, queued_at))
+
+            if len(self._items) > self.high_water:
+                self.high_water = len(self._items)
+
+    def pop(self):
+        with self._condition:
+            if not self._items:
+                return None
+
+            if self.policy == KEEP_LATEST:
+                topic, (msg, retain, queued_at) = \
+                    self._items.popitem(last=False)
+                item = (topic, msg, retain, queued_at)
+            else:
+                item = self._items.popleft()
+
+            self._condition.notify()
+            return item
+
+    def requeue(self, topic, msg, retain=True, queued_at=None):
+        # Put back a message that could not be sent, first in line. A newer
+        # message for the topic queued meanwhile wins with keep_latest.
+        if queued_at is None:
+            queued_at = time.monotonic()
+        with self._condition:
+            if self.policy == KEEP_LATEST:
+                if topic in self._items:
+                    return
+                self._items[topic] = (msg, retain, queued_at)
+                self._items.move_to_end(topic, last=False)
+            else:
+                self._items.appendleft((topic, msg, retain, queued_at))
+
+    def compact(self):
+        # Only keep the latest message per topic, used before flushing a
+        # backlog after a reconnect
+        if self.policy == KEEP_LATEST:
+            return 0
+
+        with self._condition:
+            latest = collections.OrderedDict()
+            for topic, msg, retain, queued_at in self._items:
+                latest.pop(topic, None)
+                latest[topic] = (msg, retain, queued_at)
+
+            removed = len(self._items) - len(latest)
+            self._items = collections.deque(
+                (topic,) + item for topic, item in latest.items())
+            self.replaced += removed
+            self._condition.notify_all()
+
+        if removed:
+            logging.info('Discarded %d stale queued messages', removed)
+        return removed
+
+    def _drop(self):
+        if self.policy == KEEP_LATEST:
+            topic, _value = self._items.popitem(last=False)
+        else:
+            topic = self._items.popleft()[0]
+
+        self.dropped += 1
+        if self.dropped == 1 or self.dropped % 1000 == 0:
+            logging.warning('MQTT queue full, dropped %d messages so far, '
+                            'last to topic "%s"', self.dropped, topic)
+
+    def stats(self):
+        return {'depth': len(self._items),
+                'high_water': self.high_water,
+                'dropped': self.dropped,
+                'replaced': self.replaced}
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import time
+import tracemalloc
+
+# Before Python 3.12 cProfile only sees the thread it was enabled on,
+# callbacks run on other threads need a profile of their own
+PER_THREAD = sys.version_info < (3, 12)
+
+# Frames kept per allocation and lines written per memory report
+TRACEMALLOC_FRAMES = 10
+TRACEMALLOC_TOP = 50
+
+
+def _code_label(callback):
+    # pstats keys functions by (filename, first line, name)
+    code = getattr(callback, '__func__', callback).__code__
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+class Profiler:
+    # cProfile and tracemalloc capture, started and stopped at runtime.
+    # Nothing is installed while it is off. start() must be called on the
+    # thread running the callbacks, callbacks run on another thread are
+    # passed through wrap(). stop() writes the profile and the largest
+    # allocations to directory and logs the cumulative time of each of
+    # callbacks.
+    def __init__(self, directory, callbacks=()):
+        self.directory = directory
+        self.callbacks = {_code_label(callback): callback.__name__
+                          for callback in callbacks}
+        self.started_at = None
+        self._profile = None
+        self._thread_profile = None
+        self._tracemalloc = False
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def start(self):
+        if self.running:
+            return False
+
+        self.started_at = time.monotonic()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self._tracemalloc = True
+        if PER_THREAD:
+            self._thread_profile = cProfile.Profile()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        logging.info('Profiling started')
+        return True
+
+    def wrap(self, callback):
+        # Profiles callback on the thread it is called from, one thread only
+        if self._thread_profile is None:
+            return callback
+        profile = self._thread_profile
+
+        def profiled(*args):
+            return profile.runcall(callback, *args)
+        return profiled
+
+    def stop(self):
+        # Returns the path of the profile, None if nothing was recorded or
+        # it could not be written
+        if not self.running:
+            return None
+
+        self._profile.disable()
+        elapsed = time.monotonic() - self.started_at
+        profiles = [self._profile, self._thread_profile]
+        self._profile = None
+        self._thread_profile = None
+
+        snapshot = None
+        if self._tracemalloc:
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self._tracemalloc = False
+
+        stats = None
+        for profile in profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            except TypeError:
+                # A profile without any calls
+                continue
+
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        path = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            if stats is not None:
+                profile_path = os.path.join(
+                    self.directory, 'profile-{}.pstats'.format(stamp))
+                stats.dump_stats(profile_path)
+                path = profile_path
+            if snapshot is not None:
+                self._write_allocations(
+                    snapshot, os.path.join(
+                        self.directory, 'tracemalloc-{}.txt'.format(stamp)))
+        except OSError as err:
+            # Also called on shutdown, which must go on
+            logging.error('Writing the profile to %s failed: %s',
+                          self.directory, err)
+        else:
+            logging.info('Profiled %.1f s, written to %s', elapsed,
+                         path or self.directory)
+        self._log_callbacks(stats, elapsed)
+        return path
+
+    def _log_callbacks(self, stats, elapsed):
+        # Cumulative time includes everything called from the callback
+        found = {} if stats is None else stats.stats
+        for label, name in sorted(self.callbacks.items(),
+                                  key=lambda item: item[1]):
+            _cc, calls, _tt, cumulative, _callers = found.get(
+                label, (0, 0, 0.0, 0.0, None))
+            logging.info('  %s: %d calls, %.3f s cumulative, %.1f%% of the '
+                         'time, %.3f ms per call', name, calls, cumulative,
+                         100 * cumulative / elapsed if elapsed else 0.0,
+                         1000 * cumulative / calls if calls else 0.0)
+
+    @staticmethod
+    def _write_allocations(snapshot, path):
+        statistics = snapshot.statistics('lineno')
+        with open(path, 'w', encoding='utf-8') as output:
+            output.write('Total {:.1f} KiB in {} blocks\n'.format(
+                sum(stat.size for stat in statistics) / 1024,
+                sum(stat.count for stat in statistics)))
+            for stat in statistics[:TRACEMALLOC_TOP]:
+                output.write('{}\n'.format(stat))
@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import heapq
+import logging
+import threading
+import time
+
+from paho.mqtt import client as mqtt_client
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from src.pipeline import EventQueue
+
+publish_log = logging.getLogger('telldus-core-mqtt.publish')
+
+# Seconds between journal replay steps
+REPLAY_INTERVAL = 0.1
+
+
+class TopicAliases:
+    # MQTT 5 topic aliases, valid for one connection. The broker allows
+    # only a few, 10 in Mosquitto by default, so they go to the topics
+    # published most often. Publishes are counted per topic and a topic
+    # published a second time gets a free alias. Every REBALANCE publishes
+    # the aliases of topics no longer among the most published are taken
+    # back for those that are, which get them on their next publish, and
+    # the counts are halved to follow the current traffic. Setting an
+    # alias number again maps it to the new topic. The number of a publish
+    # that failed to set it is free again.
+    # Aliases are resolved and published under the lock reset() takes, and
+    # reset when the connection is lost. A publish from before that only
+    # reaches the old connection's packets, which paho drops on reconnect,
+    # so no alias is ever sent on a connection it was not set on.
+    MAX_SEEN = 10000
+    REBALANCE = 1000
+
+    def __init__(self):
+        self.maximum = 0
+        self._lock = threading.Lock()
+        self._aliases = {}
+        self._properties = {}
+        self._counts = {}
+        self._free = []
+        self._next = 1
+        self._wanted = set()
+        self._publishes = 0
+
+    def reset(self, maximum):
+        with self._lock:
+            self.maximum = int(maximum or 0)
+            self._aliases = {}
+            self._counts = {}
+            self._free = []
+            self._next = 1
+            self._wanted = set()
+            self._publishes = 0
+
+    def publish(self, client, topic, msg, qos=0, retain=False):
+        # Returns the result of client.publish
+        with self._lock:
+            wire_topic, properties = self._resolve(topic)
+            result = client.publish(wire_topic, msg, qos=qos, retain=retain,
+                                    properties=properties)
+            if result[0] != mqtt_client.MQTT_ERR_SUCCESS and \
+                    properties is not None and wire_topic:
+                # The publish setting the alias was not sent
+                self._free.append(self._aliases.pop(topic))
+            return result
+
+    def _resolve(self, topic):
+        # Returns the topic and properties to publish with
+        if self.maximum == 0:
+            return topic, None
+        count = self._count(topic)
+        alias = self._aliases.get(topic)
+        if alias is not None:
+            return '', self._properties[alias]
+        if self._wanted:
+            # Free aliases are kept for the most published topics
+            if topic not in self._wanted:
+                return topic, None
+        elif count < 2:
+            return topic, None
+
+        alias = self._take()
+        if alias is None:
+            return topic, None
+        self._wanted.discard(topic)
+        properties = self._properties.get(alias)
+        if properties is None:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.TopicAlias = alias
+            self._properties[alias] = properties
+        self._aliases[topic] = alias
+        return topic, properties
+
+    def _count(self, topic):
+        count = self._counts.get(topic, 0) + 1
+        if count > 1 or len(self._counts) < self.MAX_SEEN:
+            self._counts[topic] = count
+        self._publishes += 1
+        if self._publishes >= self.REBALANCE:
+            self._rebalance()
+        return count
+
+    def _take(self):
+        if self._free:
+            return self._free.pop()
+        if self._next > self.maximum:
+            return None
+        self._next += 1
+        return self._next - 1
+
+    def _rebalance(self):
+        # Ties go to the topic holding an alias, so equally busy topics do
+        # not swap aliases back and forth
+        counts = self._counts
+        aliases = self._aliases
+        top = heapq.nlargest(self.maximum, counts,
+                             key=lambda topic: (counts[topic],
+                                                topic in aliases))
+        wanted = [topic for topic in top if topic not in aliases]
+        available = len(self._free) + self.maximum + 1 - self._next
+        frequent = set(top)
+        idle = sorted((topic for topic in aliases if topic not in frequent),
+                      key=lambda topic: counts.get(topic, 0))
+        for topic in idle[:max(len(wanted) - available, 0)]:
+            self._free.append(aliases.pop(topic))
+        self._wanted = set(wanted)
+        self._counts = {topic: count // 2 for topic, count in counts.items()
+                        if count > 1}
+        self._publishes = 0
+
+    def __len__(self):
+        return len(self._aliases)
+
+
+class Publisher:
+    # All publishes share one MQTT connection. A message is handed to paho
+    # on the caller's thread when nothing is queued and fewer than
+    # max_inflight messages are not yet written to the socket or
+    # acknowledged by the broker. Otherwise it is put on a bounded
+    # EventQueue that a flush thread drains in batches as paho reports
+    # earlier messages as sent. While the broker is unreachable messages
+    # stay in the queue, never in paho.
+    # With a journal (src/journal.py) messages are moved from the queue to
+    # it during an outage and replayed at replay_rate messages per second
+    # after the reconnect. New messages are sent as usual meanwhile, a
+    # journaled message for a topic sent since is skipped as stale.
+    def __init__(self, client, max_inflight=1000, batch_size=100, qos=0,
+                 queue=None, journal=None, replay_rate=50):
+        self.client = client
+        self.max_inflight = max(int(max_inflight), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.qos = int(qos)
+        self.sent = 0
+        self.failed = 0
+        # Histogram of the time from the telldus-core event, or the publish
+        # call for other messages, until handed to paho. Set when metrics
+        # are enabled.
+        self.latency = None
+        # TopicAliases, set with MQTT 5
+        self.aliases = None
+        self._queue = queue if queue is not None else EventQueue()
+        self.journal = journal
+        self.replay_rate = max(float(replay_rate), 1.0)
+        self._replay_at = None
+        self._sent_live = set()
+        # The journal is only used for outages, not before the first
+        # connect. paho may not notice a lost connection before the next
+        # read or keepalive, a failed publish marks it offline at once.
+        self._connected_once = False
+        self._offline = False
+        # paho's network thread, it reports the messages as sent so it must
+        # never wait for room in the queue
+        self._network_thread = None
+        self._wakeup = threading.Event()
+        # Held while handing messages to paho to keep them in order, never
+        # while waiting. The in-flight count is the difference of two
+        # counters, each written by one thread at a time: _published under
+        # _send_lock, _acknowledged by paho's callbacks.
+        self._send_lock = threading.Lock()
+        self._published = 0
+        self._acknowledged = 0
+        self._running = False
+        self._thread = None
+
+        self.client.on_publish = self._on_publish
+        self.client.on_disconnect = self._on_disconnect
+
+    @property
+    def queue(self):
+        return self._queue
+
+    def publish(self, topic, msg, retain=True, received_at=None):
+        if received_at is None:
+            received_at = time.monotonic()
+        # A caller never waits for the flush thread, the message is queued
+        # behind it instead
+        if not self._queue and self._can_send() and \
+                self._send_lock.acquire(blocking=False):
+            try:
+                if not self._queue and self._can_send():
+                    self._send(topic, msg, retain, received_at)
+                    return
+            finally:
+                self._send_lock.release()
+
+        self._queue.put(topic, msg, retain, received_at,
+                        block=threading.get_ident() != self._network_thread)
+        if not self._wakeup.is_set():
+            self._wakeup.set()
+
+    def depth(self):
+        return len(self._queue)
+
+    def inflight(self):
+        return max(self._published - self._acknowledged, 0)
+
+    def on_connected(self, reconnected=False):
+        # Messages in flight when the connection was lost are never
+        # acknowledged, start counting from zero on every (re)connect.
+        # After an outage only the latest message per topic is sent.
+        # Called from paho's network thread.
+        self._network_thread = threading.get_ident()
+        self._connected_once = True
+        self._offline = False
+        self._reset_aliases()
+        self._acknowledged = self._published
+        if reconnected:
+            self._queue.compact()
+        self._wakeup.set()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run,
+                                        name='telldus-mqtt-publisher',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def flush(self):
+        # Sends queued messages while the in-flight window has room, they
+        # stay queued otherwise
+        sent = 0
+        with self._send_lock:
+            while sent < self.batch_size and self._can_send():
+                item = self._queue.pop()
+                if item is None:
+                    break
+                if not self._send(*item):
+                    break
+                sent += 1
+        return sent
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(
+                timeout=REPLAY_INTERVAL if self._replaying() else 1)
+            self._wakeup.clear()
+
+            if self._spooling():
+                self._spool()
+
+            while self._queue and self.client.is_connected():
+                if not self.flush():
+                    break
+
+            if self._replaying():
+                self._replay()
+
+            if not self._running:
+                self._close_journal()
+                return
+
+    def _reset_aliases(self):
+        if self.aliases is not None:
+            self.aliases.reset(getattr(self.client, 'topic_alias_maximum', 0))
+
+    def _on_disconnect(self, client, *args):
+        # pylint: disable=unused-argument
+        # No aliases until the next connect sets the new maximum
+        if self.aliases is not None:
+            self.aliases.reset(0)
+
+    def _online(self):
+        return not self._offline and self.client.is_connected()
+
+    def _can_send(self):
+        return self._published - self._acknowledged < self.max_inflight \
+            and self._online()
+
+    def _spooling(self):
+        return self.journal is not None and self._connected_once and \
+            not self._online()
+
+    def _replaying(self):
+        return self.journal is not None and bool(self.journal) and \
+            self._online()
+
+    def _spool(self):
+        items = []
+        while True:
+            item = self._queue.pop()
+            if item is None:
+                break
+            items.append(item)
+        if items:
+            self.journal.extend(items)
+            # Journaled messages are newer than any sent before
+            self._sent_live.clear()
+
+    def _replay(self):
+        # Sends the oldest journaled messages, at most replay_rate per
+        # second on average
+        now = time.monotonic()
+        if self._replay_at is None:
+            self._replay_at = now
+        # Credit is capped to one second of messages
+        self._replay_at = max(self._replay_at, now - 1)
+        budget = min(int((now - self._replay_at) * self.replay_rate),
+                     self.batch_size)
+        if budget < 1:
+            return
+
+        last_seq = None
+        sent = 0
+        with self._send_lock:
+            for seq, topic, msg, retain in self.journal.peek(budget):
+                if topic not in self._sent_live:
+                    if not self._can_send() or \
+                            not self._send(topic, msg, retain, now):
+                        break
+                    sent += 1
+                last_seq = seq
+        if last_seq is not None:
+            self.journal.remove(last_seq)
+        self._replay_at += sent / self.replay_rate
+
+        if not self.journal:
+            self._replay_at = None
+            self._sent_live.clear()
+            logging.info('MQTT journal replayed')
+
+    def _close_journal(self):
+        # Unsent messages are kept for the next start
+        if self.journal is not None:
+            self._spool()
+            self.journal.close()
+
+    def _send(self, topic, msg, retain, queued_at):
+        # Called with _send_lock held and room in the in-flight window. A
+        # message that could not be sent is queued again for the flush
+        # thread.
+        self._published += 1
+        if not self._publish(topic, msg, retain):
+            self._published -= 1
+            self._queue.requeue(topic, msg, retain, queued_at)
+            self._wakeup.set()
+            return False
+        if self.latency is not None:
+            self.latency.observe(time.monotonic() - queued_at)
+        return True
+
+    def _publish(self, topic, msg, retain):
+        if self.aliases is None:
+            result = self.client.publish(topic, msg, qos=self.qos,
+                                         retain=retain)
+        else:
+            result = self.aliases.publish(self.client, topic, msg, self.qos,
+                                          retain)
+
+        if result[0] == mqtt_client.MQTT_ERR_SUCCESS:
+            self.sent += 1
+            if self.journal:
+                self._sent_live.add(topic)
+            publish_log.info('Send "%s" to topic "%s"', msg, topic)
+            return True
+
+        self.failed += 1
+        if result[0] == mqtt_client.MQTT_ERR_NO_CONN:
+            self._offline = True
+        logging.error('Failed to send message to topic "%s"', topic)
+        return False
+
+    def _release(self):
+        # Messages in flight before a reconnect may still be reported
+        if self._acknowledged < self._published:
+            self._acknowledged += 1
+
+    def _on_publish(self, client, userdata, mid):
+        # pylint: disable=unused-argument
+        self._release()
+        if self._queue and not self._wakeup.is_set():
+            self._wakeup.set()
+
+
+class AsyncioPublisher(Publisher):
+    # Publisher for when the MQTT connection is driven by the asyncio
+    # loop, see src/aio.py. Everything runs on the loop thread so there is
+    # no flush thread, messages beyond the in-flight window or sent while
+    # disconnected wait in the queue until paho reports earlier ones as
+    # sent or the connection is back. The journal, when used, is written
+    # and replayed on the loop thread in steps of REPLAY_INTERVAL.
+    def __init__(self, client, loop, max_inflight=1000, batch_size=100,
+                 qos=0, queue=None, journal=None, replay_rate=50):
+        super().__init__(client, max_inflight, batch_size, qos, queue,
+                         journal, replay_rate)
+        self.loop = loop
+        self._loop_thread = None
+        self._journal_handle = None
+
+    def start(self):
+        self._running = True
+        self.loop.call_soon(self._set_loop_thread)
+
+    def stop(self, timeout=None):
+        # Called after the loop stopped, it is run again until the queued
+        # messages are written or timeout seconds passed
+        self._running = False
+        if self._journal_handle is not None:
+            self._journal_handle.cancel()
+            self._journal_handle = None
+        if not self.loop.is_running():
+            self.loop.run_until_complete(self.drain(timeout))
+        self._close_journal()
+
+    async def drain(self, timeout=None):
+        deadline = None if timeout is None else self.loop.time() + timeout
+        while (self._queue or self.inflight()) and self._online() and \
+                (deadline is None or self.loop.time() < deadline):
+            self.flush()
+            await asyncio.sleep(0.01)
+
+    def publish(self, topic, msg, retain=True, received_at=None):
+        if received_at is None:
+            received_at = time.monotonic()
+        if self._loop_thread is not None and \
+                threading.get_ident() != self._loop_thread:
+            self.loop.call_soon_threadsafe(self.publish, topic, msg, retain,
+                                           received_at)
+            return
+
+        if self._queue or not self._can_send():
+            self._queue.put(topic, msg, retain, received_at)
+            if self._spooling():
+                self._schedule_journal()
+            return
+
+        if not self._send(topic, msg, retain, received_at) and \
+                self._spooling():
+            self._schedule_journal()
+
+    def flush(self):
+        sent = 0
+        while sent < self.batch_size and self._can_send():
+            item = self._queue.pop()
+            if item is None:
+                break
+            if not self._send(*item):
+                break
+            sent += 1
+        return sent
+
+    def on_connected(self, reconnected=False):
+        self._connected_once = True
+        self._offline = False
+        self._reset_aliases()
+        self._acknowledged = self._published
+        if reconnected:
+            self._queue.compact()
+        self.flush()
+        if self._replaying():
+            self._schedule_journal()
+
+    def _set_loop_thread(self):
+        self._loop_thread = threading.get_ident()
+
+    def _schedule_journal(self):
+        if self._journal_handle is None and self._running:
+            self._journal_handle = self.loop.call_later(REPLAY_INTERVAL,
+                                                        self._journal_step)
+
+    def _journal_step(self):
+        self._journal_handle = None
+        if self._spooling():
+            self._spool()
+        elif self._replaying():
+            self._replay()
+            self._schedule_journal()
+
+    def _send(self, topic, msg, retain, queued_at):
+        self._published += 1
+        if not self._publish(topic, msg, retain):
+            self._published -= 1
+            self._queue.requeue(topic, msg, retain, queued_at)
+            return False
+        if self.latency is not None:
+            self.latency.observe(time.monotonic() - queued_at)
+        return True
+
+    def _on_publish(self, client, userdata, mid):
+        # pylint: disable=unused-argument
+        self._release()
+        if self._queue:
+            self.flush()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+
+import tellcore.constants as const
+
+METHODS = {'turnon': const.TELLSTICK_TURNON,
+           'turnoff': const.TELLSTICK_TURNOFF}
+
+# Field holding the remote address, protocols not listed use house and
+# fall back to code
+ID_FIELDS = {'arctech': 'house',
+             'everflourish': 'house',
+             'hasta': 'house',
+             'risingsun': 'house',
+             'sartano': 'code',
+             'waveman': 'house',
+             'x10': 'house'}
+
+
+class RawCommand(collections.namedtuple(
+        'RawCommand', ('protocol', 'model', 'id', 'unit', 'group',
+                       'method'))):
+    # Attribute names mirror tellcore.telldus.Device so records can be
+    # passed to Telldus.create_topics as the 'command' item.
+    __slots__ = ()
+
+
+class RawSensor(collections.namedtuple(
+        'RawSensor', ('protocol', 'model', 'id', 'temperature',
+                      'humidity'))):
+    __slots__ = ()
+
+
+def _fields(data):
+    fields = {}
+    for item in data.split(';'):
+        key, _sep, value = item.partition(':')
+        if key and value:
+            fields[key] = value
+    return fields
+
+
+def _command(fields):
+    protocol = fields.get('protocol')
+    id_ = fields.get(ID_FIELDS.get(protocol, 'house')) or fields.get('code')
+    method = fields.get('method')
+    if id_ is None or method is None:
+        return None
+
+    return RawCommand(protocol, fields.get('model'), id_,
+                      fields.get('unit'), fields.get('group'),
+                      METHODS.get(method,
+                                  const.TELLSTICK_ERROR_METHOD_NOT_SUPPORTED))
+
+
+def _sensor(fields):
+    # fineoffset, mandolyn and similar report decoded values, frames with
+    # only protocol specific data (e.g. oregon) are not decoded
+    temperature = fields.get('temp')
+    humidity = fields.get('humidity')
+    id_ = fields.get('id')
+    if id_ is None or (temperature is None and humidity is None):
+        return None
+
+    return RawSensor(fields.get('protocol'), fields.get('model'), id_,
+                     temperature, humidity)
+
+
+CLASSES = {'command': _command,
+           'sensor': _sensor}
+
+
+def parse_raw(data):
+    # Parses a telldus-core raw event string such as
+    # "class:command;protocol:arctech;model:selflearning;house:123;unit:1;
+    # group:0;method:turnon;" into a RawCommand or RawSensor, or None if
+    # the class is unknown or fields are missing. Safe to call from any
+    # thread.
+    fields = _fields(data)
+    parser = CLASSES.get(fields.get('class'))
+    if parser is None:
+        return None
+    return parser(fields)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import threading
+import time
+
+import tellcore.constants as const
+from tellcore.library import TelldusError
+
+SENSOR_TYPES = {const.TELLSTICK_TEMPERATURE: ('temperature', '°C'),
+                const.TELLSTICK_HUMIDITY: ('humidity', '%'),
+                const.TELLSTICK_RAINRATE: ('rainrate', 'mm/h'),
+                const.TELLSTICK_RAINTOTAL: ('raintotal', 'mm'),
+                const.TELLSTICK_WINDDIRECTION: ('winddirection', None),
+                const.TELLSTICK_WINDAVERAGE: ('windaverage', 'm/s'),
+                const.TELLSTICK_WINDGUST: ('windgust', 'm/s')}
+
+WIND_DIRECTIONS = ["N", "NNE", "NE", "ENE",
+                   "E", "ESE", "SE", "SSE",
+                   "S", "SSW", "SW", "WSW",
+                   "W", "WNW", "NW", "NNW"]
+
+
+class SensorEntry:
+    # Attribute names mirror tellcore.telldus.Sensor so entries can be
+    # passed to Telldus.create_topics as the 'sensor' item.
+    __slots__ = ('protocol', 'model', 'id', 'data_type', 'type', 'unit',
+                 'value')
+
+    def __init__(self, protocol, model, id_, data_type, value=None):
+        self.protocol = protocol
+        self.model = model
+        self.id = id_
+        self.data_type = data_type
+        self.type = SENSOR_TYPES[data_type][0]
+        self.unit = SENSOR_TYPES[data_type][1]
+        self.value = value
+
+        if data_type == const.TELLSTICK_WINDDIRECTION and value is not None:
+            self.unit = WIND_DIRECTIONS[int(float(value) / 22.5) % 16]
+
+    @property
+    def key(self):
+        return (self.protocol, self.model, int(self.id), self.data_type)
+
+
+class DeviceEntry:
+    # tellcore.telldus.Device resolves name, model and protocol over IPC
+    # on every attribute access, cache them once per device.
+    __slots__ = ('id', 'name', 'model', 'protocol', 'type', 'device',
+                 '_address')
+
+    def __init__(self, device):
+        self.id = device.id
+        self.name = device.name
+        self.model = device.model
+        self.protocol = device.protocol
+        self.device = device
+        self.type = None
+        self._address = None
+
+        if 'switch' in self.model:
+            self.type = 'switch'
+
+        if 'dimmer' in self.model:
+            self.type = 'light'
+
+    @property
+    def address_known(self):
+        return self._address is not None
+
+    @property
+    def address(self):
+        # Devices with the same address, e.g. the same house and unit code,
+        # receive the same RF frame. Read on first use only.
+        if self._address is None:
+            try:
+                parameters = tuple(sorted(self.device.parameters().items()))
+            except (AttributeError, TelldusError):
+                parameters = ()
+            if not parameters:
+                parameters = (('id', self.id),)
+            self._address = (self.protocol, self.model) + parameters
+        return self._address
+
+
+class SensorRegistry:
+    def __init__(self, core):
+        self.core = core
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._by_id = {}
+
+    def refresh(self):
+        entries = {}
+        by_id = {}
+
+        for sensor in self.core.sensors():
+            for data_type in SENSOR_TYPES:
+                if not sensor.has_value(data_type):
+                    continue
+                entry = SensorEntry(sensor.protocol, sensor.model, sensor.id,
+                                    data_type, sensor.value(data_type).value)
+                entries[entry.key] = entry
+                by_id.setdefault(int(sensor.id), []).append(entry)
+
+        with self._lock:
+            self._entries = entries
+            self._by_id = by_id
+
+        logging.info('Sensor registry loaded with %d entities', len(entries))
+        return list(entries.values())
+
+    def get(self, protocol, model, id_, data_type):
+        return self._entries.get((protocol, model, int(id_), data_type))
+
+    def get_by_id(self, id_):
+        return list(self._by_id.get(int(id_), []))
+
+    def update(self, protocol, model, id_, data_type, value):
+        # Returns (entry, created), created is True for unseen entities
+        entry = self.get(protocol, model, id_, data_type)
+        if entry is not None:
+            entry.value = value
+            return entry, False
+
+        if data_type not in SENSOR_TYPES:
+            return None, False
+
+        with self._lock:
+            entry = SensorEntry(protocol, model, id_, data_type, value)
+            self._entries[entry.key] = entry
+            self._by_id.setdefault(int(id_), []).append(entry)
+
+        logging.info('New sensor %s %s (%s) added to registry',
+                     id_, model, entry.type)
+        return entry, True
+
+
+class DeviceRegistry:
+    def __init__(self, core):
+        self.core = core
+        self._lock = threading.RLock()
+        self._entries = {}
+
+    def refresh(self):
+        entries = {}
+
+        for device in self.core.devices():
+            entries[int(device.id)] = DeviceEntry(device)
+
+        with self._lock:
+            self._entries = entries
+
+        logging.info('Device registry loaded with %d devices', len(entries))
+        return list(entries.values())
+
+    def get(self, id_):
+        return self._entries.get(int(id_))
+
+    def load(self, id_):
+        # Devices can be added to telldusd without a restart
+        for device in self.core.devices():
+            if int(device.id) == int(id_):
+                entry = DeviceEntry(device)
+                with self._lock:
+                    self._entries[int(id_)] = entry
+                return entry
+        return None
+
+
+class RawRegistry:
+    # Binary sensors learned from raw events. Every remote in range shows
+    # up, including passing cars and the neighbours, so the number kept is
+    # bounded. A remote becomes an entity once seen sightings times within
+    # window seconds, when full the least recently seen entity is evicted
+    # and entities not seen for expire seconds expire, 0 never. Only ids
+    # in allow are accepted when it is set, ids in deny never are.
+    def __init__(self, maxsize=1000, expire=0, sightings=1, window=60,
+                 allow=None, deny=None):
+        self.maxsize = max(int(maxsize), 1)
+        self.expire = float(expire)
+        self.sightings = max(int(sightings), 1)
+        self.window = float(window)
+        self.allow = {str(id_) for id_ in allow or ()}
+        self.deny = {str(id_) for id_ in deny or ()}
+        self.evicted = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+        # Ordered from least to most recently seen
+        self._entities = collections.OrderedDict()
+        self._candidates = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entities)
+
+    def __contains__(self, id_):
+        return str(id_) in self._entities
+
+    def accepts(self, id_):
+        id_ = str(id_)
+        if id_ in self.deny:
+            return False
+        return not self.allow or id_ in self.allow
+
+    def add(self, id_, now=None):
+        # Adds a known entity, e.g. from the snapshot, returns the evicted
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            return self._add(str(id_), now)
+
+    def sighting(self, id_, now=None):
+        # Returns (accepted, evicted), accepted is True when the event
+        # should be published, evicted lists the ids removed for room
+        id_ = str(id_)
+        if not self.accepts(id_):
+            self.rejected += 1
+            return False, []
+
+        if now is None:
+            now = time.monotonic()
+
+        with self._lock:
+            if id_ in self._entities:
+                self._entities[id_] = now
+                self._entities.move_to_end(id_)
+                return True, []
+
+            if self.sightings > 1:
+                seen = self._candidates.pop(id_, None)
+                if seen is None:
+                    seen = collections.deque(maxlen=self.sightings)
+                while seen and now - seen[0] > self.window:
+                    seen.popleft()
+                seen.append(now)
+                if len(seen) < self.sightings:
+                    self._candidates[id_] = seen
+                    if len(self._candidates) > self.maxsize:
+                        self._candidates.popitem(last=False)
+                    self.rejected += 1
+                    return False, []
+
+            logging.info('New binary sensor %s added to registry', id_)
+            return True, self._add(id_, now)
+
+    def _add(self, id_, now):
+        self._entities[id_] = now
+        self._entities.move_to_end(id_)
+        evicted = []
+        while len(self._entities) > self.maxsize:
+            evicted.append(self._entities.popitem(last=False)[0])
+        self.evicted += len(evicted)
+        return evicted
+
+    def expired(self, now=None):
+        # Removes and returns the ids of entities idle for expire seconds
+        if self.expire <= 0:
+            return []
+        if now is None:
+            now = time.monotonic()
+
+        expired = []
+        with self._lock:
+            while self._entities:
+                id_, last = next(iter(self._entities.items()))
+                if now - last < self.expire:
+                    break
+                del self._entities[id_]
+                expired.append(id_)
+        self.evicted += len(expired)
+        return expired
+
+    def stats(self):
+        return {'entities': len(self._entities),
+                'candidates': len(self._candidates),
+                'evicted': self.evicted,
+                'rejected': self.rejected}
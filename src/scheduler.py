@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import logging
+import threading
+import time
+
+from tellcore.telldus import TelldusError
+
+
+class ScheduledCommand:
+    # shared holds other devices with the same RF address, they react to
+    # the transmissions for device. sent counts the transmissions that
+    # succeeded, 0 when complete means the command never went out.
+    # batches are the batches waiting for this command, including those of
+    # the commands it replaced. queued_at is the arrival of the MQTT
+    # command when given.
+    __slots__ = ('device', 'action', 'value', 'remaining', 'queued_at',
+                 'first_sent_at', 'sent', 'shared', 'batches')
+
+    def __init__(self, device, action, value, repeat, shared=(),
+                 batch=None, queued_at=None):
+        self.device = device
+        self.action = action
+        self.value = value
+        self.remaining = repeat
+        self.queued_at = time.monotonic() if queued_at is None \
+            else queued_at
+        self.first_sent_at = None
+        self.sent = 0
+        self.shared = tuple(shared)
+        self.batches = () if batch is None else (batch,)
+
+    def replaces(self, previous):
+        # Takes over a pending command for the same device, its batches
+        # complete when this command has been sent. Devices sharing the
+        # address react to this command too.
+        self.batches = previous.batches + self.batches
+        shared = {int(device.id) for device in self.shared}
+        self.shared += tuple(device for device in previous.shared
+                             if int(device.id) not in shared)
+
+
+class CommandBatch:
+    # Commands submitted together, e.g. for a group. on_complete is called
+    # with the batch once all commands have been sent, a command replaced
+    # by a newer one for the same device counts when that one is sent.
+    def __init__(self, name, size, on_complete=None):
+        self.name = name
+        self.size = size
+        self.remaining = size
+        self.queued_at = time.monotonic()
+        self.completed_at = None
+        self.on_complete = on_complete
+        self._lock = threading.Lock()
+
+    @property
+    def duration(self):
+        if self.completed_at is None:
+            return None
+        return self.completed_at - self.queued_at
+
+    def done(self):
+        with self._lock:
+            self.remaining -= 1
+            if self.remaining != 0:
+                return
+            self.completed_at = time.monotonic()
+        if self.on_complete is not None:
+            self.on_complete(self)
+
+
+class CommandScheduler:
+    # There is only one radio, all transmissions are serialized through a
+    # single worker thread. A new command for a device replaces a pending
+    # one, so only the last of a burst of dim values is sent. Repeats are
+    # interleaved round robin so every device gets its first transmission
+    # before any device gets its second.
+    def __init__(self, transmit, repeat, on_complete=None,
+                 name='telldus-command-scheduler'):
+        self.transmit = transmit
+        self.repeat = max(int(repeat), 1)
+        self.on_complete = on_complete
+        self.name = name
+        self.coalesced = 0
+        self.failed = 0
+        self._condition = threading.Condition()
+        self._pending = {}
+        self._order = collections.deque()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name=self.name,
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submit(self, device, action, value=None, received_at=None):
+        self.submit_all([ScheduledCommand(device, action, value,
+                                          self.repeat,
+                                          queued_at=received_at)])
+
+    def submit_batch(self, members, name=None, on_complete=None,
+                     received_at=None):
+        # members are (device, action, value, shared devices), returns the
+        # batch
+        if not members:
+            return None
+        batch = CommandBatch(name, len(members), on_complete)
+        self.submit_all([ScheduledCommand(device, action, value,
+                                          self.repeat, shared, batch,
+                                          received_at)
+                         for device, action, value, shared in members])
+        return batch
+
+    def submit_all(self, commands):
+        # Queued at once, so every command gets its first transmission
+        # before any of them is repeated
+        with self._condition:
+            for command in commands:
+                key = int(command.device.id)
+                previous = self._pending.get(key)
+                if previous is not None:
+                    self.coalesced += 1
+                    logging.debug('[SCHEDULER] Replacing pending command '
+                                  'for device id %s', key)
+                    command.replaces(previous)
+                else:
+                    self._order.append(key)
+                self._pending[key] = command
+            self._condition.notify()
+
+    def pending(self):
+        with self._condition:
+            return len(self._pending)
+
+    def _next(self):
+        with self._condition:
+            while self._running and not self._order:
+                self._condition.wait()
+            if not self._running:
+                return None, None
+
+            key = self._order.popleft()
+            command = self._pending[key]
+            command.remaining -= 1
+            if command.remaining > 0:
+                self._order.append(key)
+            else:
+                del self._pending[key]
+            return key, command
+
+    def _run(self):
+        while True:
+            key, command = self._next()
+            if command is None:
+                return
+
+            if command.first_sent_at is None:
+                command.first_sent_at = time.monotonic()
+
+            # Any error is logged and the worker keeps running, a dead
+            # worker would leave every later command pending forever
+            try:
+                self.transmit(command.device, command.action, command.value)
+                command.sent += 1
+            except TelldusError as err:
+                self.failed += 1
+                logging.error('[SCHEDULER] Failed to send %s to device id '
+                              '%s: %s', command.action, key, err)
+            except Exception:  # pylint: disable=broad-except
+                self.failed += 1
+                logging.exception('[SCHEDULER] Failed to send %s to device '
+                                  'id %s', command.action, key)
+
+            if command.remaining == 0:
+                try:
+                    self._complete(command)
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception('[SCHEDULER] Completion of %s to '
+                                      'device id %s failed', command.action,
+                                      key)
+
+    def _complete(self, command):
+        if self.on_complete is not None:
+            self.on_complete(command)
+        for batch in command.batches:
+            batch.done()
+
+
+class ControllerSchedulers:
+    # With several controllers each has its own radio, commands are
+    # queued and transmitted per controller so a busy transmitter does not
+    # delay the others. devices maps controller ids to the ids of the
+    # devices it sends, devices not listed share the default scheduler.
+    # Same interface as CommandScheduler.
+    def __init__(self, transmit, repeat, devices, on_complete=None):
+        self.default = CommandScheduler(transmit, repeat, on_complete)
+        self.schedulers = {}
+        self._routes = {}
+
+        for controller_id, device_ids in devices.items():
+            scheduler = CommandScheduler(
+                transmit, repeat, on_complete,
+                'telldus-command-scheduler-{}'.format(controller_id))
+            self.schedulers[str(controller_id)] = scheduler
+            for device_id in device_ids or ():
+                self._routes[int(device_id)] = scheduler
+
+    @property
+    def coalesced(self):
+        return sum(scheduler.coalesced for scheduler in self._all())
+
+    @property
+    def failed(self):
+        return sum(scheduler.failed for scheduler in self._all())
+
+    def _all(self):
+        return [self.default] + list(self.schedulers.values())
+
+    def start(self):
+        for scheduler in self._all():
+            scheduler.start()
+
+    def stop(self, timeout=None):
+        for scheduler in self._all():
+            scheduler.stop(timeout)
+
+    def submit(self, device, action, value=None, received_at=None):
+        self._routes.get(int(device.id), self.default).submit(
+            device, action, value, received_at)
+
+    def submit_batch(self, members, name=None, on_complete=None,
+                     received_at=None):
+        if not members:
+            return None
+        batch = CommandBatch(name, len(members), on_complete)
+        commands = {}
+        for device, action, value, shared in members:
+            scheduler = self._routes.get(int(device.id), self.default)
+            commands.setdefault(scheduler, []).append(ScheduledCommand(
+                device, action, value, scheduler.repeat, shared, batch,
+                received_at))
+        for scheduler, scheduled in commands.items():
+            scheduler.submit_all(scheduled)
+        return batch
+
+    def pending(self):
+        return sum(scheduler.pending() for scheduler in self._all())
+
+    def unrouted(self, device_ids):
+        # Devices not listed for any controller, sent by the default
+        # scheduler
+        return [device_id for device_id in device_ids
+                if int(device_id) not in self._routes]
+
+    def pending_by_controller(self):
+        pending = {('default',): self.default.pending()}
+        for controller_id, scheduler in self.schedulers.items():
+            pending[(controller_id,)] = scheduler.pending()
+        return pending
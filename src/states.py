@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+import time
+
+import tellcore.constants as const
+
+OPTIMISTIC = 'optimistic'
+CONFIRMED = 'confirmed'
+MODES = (OPTIMISTIC, CONFIRMED)
+
+# State topics end in one of these, attributes and other topics are left
+# out of the table
+STATE_SUFFIXES = ('/state', '/dim')
+
+
+class StateTable:
+    # Latest state of every sensor and device, kept from the messages
+    # published to the state topics. snapshot() combines them into one
+    # compact message keyed by "<id>/<type>", the state topic without the
+    # base and suffix, e.g. {"time": 1650000000, "states":
+    # {"135/temperature": "21.3", "3/switch": 1, "4/brightness": 128}}
+    def __init__(self, base_topic):
+        self.prefix = base_topic + '/'
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def __len__(self):
+        return len(self._states)
+
+    def update(self, topic, payload):
+        if not topic.startswith(self.prefix) or \
+                not topic.endswith(STATE_SUFFIXES):
+            return
+        with self._lock:
+            self._states[topic] = payload
+
+    def remove(self, topic):
+        with self._lock:
+            self._states.pop(topic, None)
+
+    def snapshot(self, now=None):
+        with self._lock:
+            states = list(self._states.items())
+
+        combined = {}
+        for topic, payload in states:
+            key = topic[len(self.prefix):topic.rindex('/')]
+            try:
+                value = json.loads(payload)
+            except ValueError:
+                value = payload
+            # Payloads are {"<type>": value}, only keep the value
+            if isinstance(value, dict) and len(value) == 1:
+                value = next(iter(value.values()))
+            combined[key] = value
+
+        return json.dumps({'time': int(now if now is not None
+                                       else time.time()),
+                           'states': combined},
+                          ensure_ascii=False, separators=(',', ':'))
+
+
+class DeviceStates:
+    # Last known command of every device as (method, value), value is the
+    # dim level for TELLSTICK_DIM and None otherwise. Seeded from
+    # telldus-core when a device is first loaded, then kept from device
+    # events and sent commands, so state publishes need no telldus-core
+    # calls and a command echoed back as an event is not published twice.
+    #   optimistic: the state is set when a command is received over MQTT
+    #   confirmed: the state is set when all repeats have been sent
+    def __init__(self, mode=OPTIMISTIC):
+        if mode not in MODES:
+            raise ValueError('Unknown device state mode "{}", use one of {}'
+                             .format(mode, ', '.join(MODES)))
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._states = {}
+
+    @property
+    def optimistic(self):
+        return self.mode == OPTIMISTIC
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, device_id):
+        return self._states.get(int(device_id))
+
+    def set(self, device_id, method, value=None):
+        # Returns the new state if it changed, otherwise None
+        if method == const.TELLSTICK_DIM:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                pass
+        else:
+            value = None
+
+        state = (method, value)
+        with self._lock:
+            if self._states.get(int(device_id)) == state:
+                return None
+            self._states[int(device_id)] = state
+        return state
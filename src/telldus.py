@@ -3,26 +3,77 @@
 
 import json
 import logging
+import socket
 import threading
+import time
 
 import tellcore.constants as const
 import tellcore.telldus as td
-import yaml
-from dotmap import DotMap
-from pyaml_env import parse_config
+from tellcore.library import TelldusError
 
-with open('./logging.yaml', 'r', encoding='utf-8') as stream:
-    logging_config = yaml.load(stream, Loader=yaml.SafeLoader)
+from src.config import load_config
+from src.raw import RawCommand, parse_raw
+from src.registry import DeviceRegistry, SensorRegistry
+from src.templates import EntityTemplates, TemplateCache
 
-logging.config.dictConfig(logging_config)
 logger = logging.getLogger('telldus-core-mqtt')
 
 THREADING_RLOCK = threading.RLock()
 
+TELLDUS_SOCKET = '/tmp/TelldusClient'  # nosec
+
+
+def wait_for_telldusd(path=TELLDUS_SOCKET, timeout=30, delay=0.05,
+                      max_delay=1.0):
+    # telldusd accepts client connections on a unix socket once it is
+    # running, poll it with backoff instead of sleeping a fixed time
+    start = time.monotonic()
+    deadline = start + float(timeout)
+    while True:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(path)
+            logging.info('telldus-core ready after %.2fs',
+                         time.monotonic() - start)
+            return True
+        except OSError as err:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.warning('telldus-core not ready after %ss (%s), '
+                                'starting anyway', timeout, err)
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
+
+
+class TimedCallbackDispatcher(td.AsyncioCallbackDispatcher):
+    # Dispatches telldus-core callbacks on the event loop like
+    # AsyncioCallbackDispatcher. While a callback runs, received_at is the
+    # time.monotonic() it arrived from telldus-core, before it waited in
+    # the loop behind other callbacks.
+    def __init__(self, loop):
+        super().__init__(loop)
+        self.loop = loop
+        self.received_at = None
+
+    def on_callback(self, callback, *args):
+        self.loop.call_soon_threadsafe(self._dispatch, callback,
+                                       time.monotonic(), args)
+
+    def _dispatch(self, callback, received_at, args):
+        self.received_at = received_at
+        try:
+            callback(*args)
+        finally:
+            self.received_at = None
+
 
 class Telldus:
-    def __init__(self, core=None):
-        self.config = parse_config('config_default.yaml')
+    def __init__(self, core=None, config=None):
+        if config is None:
+            config = load_config()
+        self.config = config
+        self.templates = TemplateCache(self.config)
 
         if core is None:
             self.core = td.TelldusCore()
@@ -38,65 +89,76 @@ class Telldus:
         return self.core
 
     def create_topics(self, data):
-        config_topic = self.config['home_assistant']['config_topic']
         topics_to_create = []
 
         # pylint: disable=invalid-name
         for d in data:
-            topics = {}
-            topics['config'] = {}
-            topics['state'] = {}
             if 'sensor' in d:
-                topics['config']['topic'] = ('{}/sensor/{}_telldus/{}/config'
-                                             .format(
-                                                 config_topic,
-                                                 d['sensor'].id, d['type']))
-                topics['state']['topic'] = '{}/{}/{}/state'.format(
-                    self.config['home_assistant']['state_topic'],
-                    d['sensor'].id, d['type'])
-                config_data = self._create_config_data(
-                    d['sensor'], topics['state']['topic'], d)
+                kind = 'sensor'
             elif 'device' in d:
-                topics['config']['topic'] = ('{}/{}/{}_telldus/{}/config'
-                                             .format(
-                                                 config_topic, d['type'],
-                                                 d['device'].id, d['type']))
-                topics['state']['topic'] = '{}/{}/{}/state'.format(
-                    self.config['home_assistant']['state_topic'],
-                    d['device'].id, d['type'])
-                topics['command'] = {}
-                topics['command']['topic'] = '{}/{}/{}/set'.format(
-                    self.config['home_assistant']['state_topic'],
-                    d['device'].id, d['type'])
-                topics['brightness'] = {}
-                topics['brightness']['command'] = '{}/{}/{}/set'.format(
-                    self.config['home_assistant']['state_topic'],
-                    d['device'].id, 'brightness')
-                topics['brightness']['state'] = '{}/{}/{}/dim'.format(
-                    self.config['home_assistant']['state_topic'],
-                    d['device'].id, 'brightness')
-                config_data = self._create_config_data(
-                    d['device'], topics['state']['topic'], d,
-                    topics['command']['topic'], topics['brightness'])
+                kind = 'device'
             elif 'command' in d:
-                topics['config']['topic'] = ('{}/{}/{}_telldus/{}/config'
-                                             .format(
-                                                 config_topic, d['type'],
-                                                 d['command'].id, d['type']))
-                topics['state']['topic'] = '{}/{}/{}/state'.format(
-                    self.config['home_assistant']['state_topic'],
-                    d['command'].id, d['type'])
-                config_data = self._create_config_data(
-                    d['command'], topics['state']['topic'], d)
-
-            topics['config']['data'] = json.dumps(
-                config_data, ensure_ascii=False)
-            topics['state']['data'] = json.dumps(
-                d['state_data'], ensure_ascii=False)
+                kind = 'command'
+            else:
+                continue
+
+            templates = self._entity_templates(kind, d[kind], d)
+            topics = templates.topics(self.templates.state(d['state_data']))
             topics_to_create.append(topics)
 
         return topics_to_create
 
+    def _entity_templates(self, kind, entity, extra):
+        name = None
+        if hasattr(entity, 'name') and entity.name != {}:
+            name = entity.name
+        signature = (name, entity.model, entity.protocol, extra.get('unit'))
+
+        return self.templates.entity(
+            (kind, str(entity.id), extra['type']), signature,
+            lambda: self._create_templates(kind, entity, extra))
+
+    def _create_templates(self, kind, entity, extra):
+        config_topic = self.templates.config_topic
+        state_topic = self.templates.state_topic
+
+        if kind == 'sensor':
+            templates = EntityTemplates(
+                '{}/sensor/{}_telldus/{}/config'.format(
+                    config_topic, entity.id, extra['type']),
+                '{}/{}/{}/state'.format(state_topic, entity.id,
+                                        extra['type']))
+            config_data = self._create_config_data(
+                entity, templates.state_topic, extra)
+        elif kind == 'device':
+            brightness = {}
+            brightness['command'] = '{}/{}/{}/set'.format(
+                state_topic, entity.id, 'brightness')
+            brightness['state'] = '{}/{}/{}/dim'.format(
+                state_topic, entity.id, 'brightness')
+            templates = EntityTemplates(
+                '{}/{}/{}_telldus/{}/config'.format(
+                    config_topic, extra['type'], entity.id, extra['type']),
+                '{}/{}/{}/state'.format(state_topic, entity.id,
+                                        extra['type']),
+                '{}/{}/{}/set'.format(state_topic, entity.id,
+                                      extra['type']),
+                brightness)
+            config_data = self._create_config_data(
+                entity, templates.state_topic, extra,
+                templates.command_topic, templates.brightness)
+        else:
+            templates = EntityTemplates(
+                '{}/{}/{}_telldus/{}/config'.format(
+                    config_topic, extra['type'], entity.id, extra['type']),
+                '{}/{}/{}/state'.format(state_topic, entity.id,
+                                        extra['type']))
+            config_data = self._create_config_data(
+                entity, templates.state_topic, extra)
+
+        templates.config_data = json.dumps(config_data, ensure_ascii=False)
+        return templates
+
     def _create_config_data(self, device, state_topic, extra,
                             command_topic=None, bt_command=None):
         # common
@@ -115,13 +177,14 @@ class Telldus:
                 device.id, device.model)
 
         if extra['type'] == 'light':
-            bt_value_template = '{{ value_json.%s }}' % 'brightness'
+            bt_value_template = self.templates.value_template('brightness')
             config_data['brightness_state_topic'] = bt_command['state']
             config_data['brightness_value_template'] = bt_value_template
             config_data['brightness_command_topic'] = bt_command['command']
 
         config_data['state_topic'] = state_topic
-        config_data['state_value_template'] = '{{ value_json.%s }}' % extra['type']
+        config_data['state_value_template'] = \
+            self.templates.value_template(extra['type'])
         config_data['device']['identifiers'] = []
         config_data['device']['identifiers'].append('{}_{}'.format(
             device.id, device.model))
@@ -159,147 +222,95 @@ class Telldus:
         return config_data
 
     def create_topic(self, type_id, model):
-        if model == 'light':
-            topic = '{}/{}/brightness/dim'.format(
-                self.config['home_assistant']['state_topic'], type_id)
-        else:
-            topic = '{}/{}/{}/state'.format(
-                self.config['home_assistant']['state_topic'], type_id, model)
-        return topic
+        return self.templates.topic(type_id, model)
 
     def create_topic_data(self, type_string, value):
-        data = {type_string: value}
-        return json.dumps(data, ensure_ascii=False)
+        return self.templates.data(type_string, value)
 
 
 class Sensor(Telldus):
-    def get(self, sensor_id=None):
-        sensors_data = []
-        wind_directions = ["N", "NNE", "NE", "ENE",
-                           "E", "ESE", "SE", "SSE",
-                           "S", "SSW", "SW", "WSW",
-                           "W", "WNW", "NW", "NNW"]
+    def __init__(self, core=None, config=None):
+        super().__init__(core=core, config=config)
+        self.registry = SensorRegistry(self.core)
+        self.aggregator = None
+
+    def attributes_topic(self, sensor_id, type_string):
+        return '{}/{}/{}/attributes'.format(self.templates.state_topic,
+                                            sensor_id, type_string)
 
+    def _create_config_data(self, device, state_topic, extra,
+                            command_topic=None, bt_command=None):
+        config_data = super()._create_config_data(
+            device, state_topic, extra, command_topic, bt_command)
+
+        # Aggregated sensors can publish all window statistics
+        if self.aggregator is not None:
+            settings = self.aggregator.settings_for(device.id, extra['type'])
+            if settings and settings['attributes']:
+                config_data['json_attributes_topic'] = \
+                    self.attributes_topic(device.id, extra['type'])
+        return config_data
+
+    def get(self, sensor_id=None):
         if sensor_id is not None:
-            sensors = [self._find_sensor(sensor_id)]
+            entries = self.registry.get_by_id(sensor_id)
+            if not entries:
+                logging.warning('Sensor id "%d" not found', int(sensor_id))
         else:
-            sensors = self.core.sensors()
-
-        for sensor in sensors:
-            if sensor.has_temperature():
-                sensor_data = {}
-                state_data = {}
-                state_data['temperature'] = sensor.temperature().value
-                sensor_data['type'] = 'temperature'
-                sensor_data['unit'] = '°C'
-                sensor_data['sensor'] = sensor
-                sensor_data['state_data'] = state_data
-                sensors_data.append(dict(sensor_data))
-
-            if sensor.has_humidity():
-                sensor_data = {}
-                state_data = {}
-                state_data['humidity'] = sensor.humidity().value
-                sensor_data['type'] = 'humidity'
-                sensor_data['unit'] = '%'
-                sensor_data['sensor'] = sensor
-                sensor_data['state_data'] = state_data
-                sensors_data.append(dict(sensor_data))
-
-            if sensor.has_rainrate():
-                sensor_data = {}
-                state_data = {}
-                state_data['rainrate'] = sensor.rainrate().value
-                sensor_data['type'] = 'rainrate'
-                sensor_data['unit'] = 'mm/h'
-                sensor_data['sensor'] = sensor
-                sensor_data['state_data'] = state_data
-                sensors_data.append(dict(sensor_data))
-
-            if sensor.has_raintotal():
-                sensor_data = {}
-                state_data = {}
-                state_data['raintotal'] = sensor.raintotal().value
-                sensor_data['type'] = 'raintotal'
-                sensor_data['unit'] = 'mm'
-                sensor_data['sensor'] = sensor
-                sensor_data['state_data'] = state_data
-                sensors_data.append(dict(sensor_data))
-
-            if sensor.has_winddirection():
-                sensor_data = {}
-                state_data = {}
-                state_data['winddirection'] = int(float(
-                    sensor.winddirection().value / 22.5))
-                sensor_data['type'] = 'winddirection'
-                sensor_data['unit'] = wind_directions[int(float(
-                    sensor.winddirection().value) / 22.5)]
-                sensor_data['sensor'] = sensor
-                sensor_data['state_data'] = state_data
-                sensors_data.append(dict(sensor_data))
-
-            if sensor.has_windaverage():
-                sensor_data = {}
-                state_data = {}
-                state_data['windaverage'] = sensor.windaverage().value
-                sensor_data['type'] = 'windaverage'
-                sensor_data['unit'] = 'm/s'
-                sensor_data['sensor'] = sensor
-                sensor_data['state_data'] = state_data
-                sensors_data.append(dict(sensor_data))
-
-            if sensor.has_windgust():
-                sensor_data = {}
-                state_data = {}
-                state_data['windgust'] = sensor.windgust().value
-                sensor_data['type'] = 'windgust'
-                sensor_data['unit'] = 'm/s'
-                sensor_data['sensor'] = sensor
-                sensor_data['state_data'] = state_data
-                sensors_data.append(dict(sensor_data))
-
-        return sensors_data
-
-    def _find_sensor(self, sensor_id):
-        for sensor in self.core.sensors():
-            if int(sensor.id) == int(sensor_id):
-                return sensor
-        logging.warning('Sensor id "%d" not found', int(sensor_id))
-        return None
+            entries = self.registry.refresh()
+
+        return [self._sensor_data(entry) for entry in entries]
+
+    def update(self, protocol, model, sensor_id, data_type, value):
+        entry, created = self.registry.update(
+            protocol, model, sensor_id, data_type, value)
+        if entry is None:
+            return [], False
+        return [self._sensor_data(entry)], created
+
+    def _sensor_data(self, entry):
+        # Wind direction in degrees, as published for sensor events
+        state_data = {}
+        state_data[entry.type] = entry.value
+
+        sensor_data = {}
+        sensor_data['type'] = entry.type
+        sensor_data['unit'] = entry.unit
+        sensor_data['sensor'] = entry
+        sensor_data['state_data'] = state_data
+        return sensor_data
 
 
 class Device(Telldus):
+    def __init__(self, core=None, config=None):
+        super().__init__(core=core, config=config)
+        self.registry = DeviceRegistry(self.core)
+        self.scheduler = None
+        self.states = None
+
     def get(self, device_id=None):
         devices_data = []
 
         if device_id is not None:
             devices = [self._find_device(device_id)]
         else:
-            devices = self.core.devices()
+            devices = self.registry.refresh()
 
         for device in devices:
-            device_data = {}
-            device_model = ''
-
-            if 'switch' in device.model:
-                device_model = 'switch'
+            if device is None:
+                continue
 
-            if 'dimmer' in device.model:
-                device_model = 'light'
+            device_data = {}
 
-            if device_model == '':
+            if device.type is None:
                 logging.info('Device "%s" not yet supported, please raise '
                              'an github issue.', device.model)
                 continue
 
             state_data = {}
+            state_data[device.type] = self._last_command(device)
 
-            state_data[device_model] = device.last_sent_command(
-                const.TELLSTICK_TURNON
-                | const.TELLSTICK_TURNOFF
-                | const.TELLSTICK_DIM)
-
-            device_data['type'] = device_model
+            device_data['type'] = device.type
             device_data['device'] = device
             device_data['state_data'] = state_data
 
@@ -307,40 +318,106 @@ class Device(Telldus):
 
         return devices_data
 
-    def turn_on(self, device_id):
-        with THREADING_RLOCK:
-            device = self._find_device(device_id)
-            if device is not None:
-                for _i in range(int(self.config['telldus']['repeat_cmd'])):
-                    device.turn_on()
-                return True
-            return False
+    def _last_command(self, device):
+        # Asks telldus-core only for devices not in the state table yet
+        if self.states is not None:
+            state = self.states.get(device.id)
+            if state is not None:
+                return state[0]
+
+        method = device.device.last_sent_command(
+            const.TELLSTICK_TURNON
+            | const.TELLSTICK_TURNOFF
+            | const.TELLSTICK_DIM)
+
+        if self.states is not None:
+            value = None
+            if method == const.TELLSTICK_DIM:
+                # One more call for dimmers, the level is kept too
+                value = device.device.last_sent_value()
+            self.states.set(device.id, method, value)
+        return method
+
+    # received_at is the arrival of the MQTT command, for the command
+    # latency
+    def turn_on(self, device_id, received_at=None):
+        device = self._find_device(device_id)
+        if device is not None:
+            self._send(device, 'turn_on', received_at=received_at)
+            return True
+        return False
 
-    def turn_off(self, device_id):
-        with THREADING_RLOCK:
-            device = self._find_device(device_id)
-            if device is not None:
-                for _i in range(int(self.config['telldus']['repeat_cmd'])):
-                    device.turn_off()
-                return True
-            return False
+    def turn_off(self, device_id, received_at=None):
+        device = self._find_device(device_id)
+        if device is not None:
+            self._send(device, 'turn_off', received_at=received_at)
+            return True
+        return False
 
-    def dim(self, device_id, value):
+    def dim(self, device_id, value, received_at=None):
         if int(value) >= 0 and int(value) <= 255:
             device = self._find_device(device_id)
             if device is not None:
-                for _i in range(int(self.config['telldus']['repeat_cmd'])):
-                    device.dim(int(value))
+                self._send(device, 'dim', int(value), received_at)
                 return True
 
         logging.warning('Dim value "%d" not in range 0 - 255', int(value))
         return False
 
+    def send_group(self, device_ids, turn_on, name=None, on_complete=None,
+                   received_at=None):
+        # Switches many devices at once, dimmers are dimmed to 255 or 0
+        # like a single light. Devices sharing an address are sent once,
+        # the others are passed along as shared. Returns the devices found.
+        addresses = {}
+        found = []
+        for device_id in device_ids:
+            device = self._find_device(device_id)
+            if device is None or device.type is None:
+                continue
+            found.append(device)
+            addresses.setdefault(device.address, []).append(device)
+
+        members = []
+        for devices in addresses.values():
+            if devices[0].type == 'light':
+                action, value = 'dim', 255 if turn_on else 0
+            else:
+                action, value = 'turn_on' if turn_on else 'turn_off', None
+            members.append((devices[0], action, value, devices[1:]))
+
+        if self.scheduler is not None:
+            self.scheduler.submit_batch(members, name, on_complete,
+                                        received_at)
+            return found
+
+        with THREADING_RLOCK:
+            for _i in range(int(self.config['telldus']['repeat_cmd'])):
+                for device, action, value, _shared in members:
+                    self.transmit(device, action, value)
+        return found
+
+    def transmit(self, device, action, value=None):
+        # A single RF transmission, repeats are handled by the caller
+        if action == 'dim':
+            device.device.dim(value)
+        else:
+            getattr(device.device, action)()
+
+    def _send(self, device, action, value=None, received_at=None):
+        if self.scheduler is not None:
+            self.scheduler.submit(device, action, value, received_at)
+            return
+
+        with THREADING_RLOCK:
+            for _i in range(int(self.config['telldus']['repeat_cmd'])):
+                self.transmit(device, action, value)
+
     # def bell(self, device_id):
     #     device = self._find_device(device_id)
     #     if device is not None:
     #         for _i in range(int(self.config['telldus']['repeat_cmd'])):
-    #             device.bell()
+    #             device.device.bell()
     #         return True
     #     return False
 
@@ -348,7 +425,7 @@ class Device(Telldus):
     #     device = self._find_device(device_id)
     #     if device is not None:
     #         for _i in range(int(self.config['telldus']['repeat_cmd'])):
-    #             device.execute()
+    #             device.device.execute()
     #         return True
     #     return False
 
@@ -357,7 +434,7 @@ class Device(Telldus):
     #     device = self._find_device(device_id)
     #     if device is not None:
     #         for _i in range(int(self.config['telldus']['repeat_cmd'])):
-    #             device.up()
+    #             device.device.up()
     #         return True
     #     return False
 
@@ -365,7 +442,7 @@ class Device(Telldus):
     #     device = self._find_device(device_id)
     #     if device is not None:
     #         for _i in range(int(self.config['telldus']['repeat_cmd'])):
-    #             device.down()
+    #             device.device.down()
     #         return True
     #     return False
 
@@ -373,63 +450,86 @@ class Device(Telldus):
     #     device = self._find_device(device_id)
     #     if device is not None:
     #         for _i in range(int(self.config['telldus']['repeat_cmd'])):
-    #             device.stop()
+    #             device.device.stop()
     #         return True
     #     return False
 
+    def loaded(self, device_ids, address=False):
+        # True when the devices, and their addresses if asked for, can be
+        # used without calls to telldus-core
+        for device_id in device_ids:
+            device = self.registry.get(device_id)
+            if device is None or (address and not device.address_known):
+                return False
+        return True
+
+    def controller_ids(self):
+        # Controllers connected to telldusd, None when telldus-core is
+        # older than 2.1.2 and cannot list them
+        try:
+            return [str(controller.id)
+                    for controller in self.core.controllers()]
+        except (AttributeError, TelldusError):
+            return None
+
+    def load_addresses(self, device_ids):
+        for device_id in device_ids:
+            device = self.registry.get(device_id)
+            if device is not None:
+                device.address  # pylint: disable=pointless-statement
+
     def _find_device(self, device_id):
-        for device in self.core.devices():
-            if int(device.id) == int(device_id):
-                return device
+        device = self.registry.get(device_id)
+        if device is None:
+            device = self.registry.load(device_id)
+        if device is not None:
+            return device
         logging.warning('Device id "%d" not found', int(device_id))
         return None
 
 
 class Command(Telldus):
-    def __init__(self, core=None):
-        super().__init__(core=core)
-        self.command = None
-        self.serialized = None
-
+    # Stateless, raw events and MQTT threads may share one instance
     def get(self, raw_data):
+        command = self.serialize(raw_data)
+        if command is None:
+            return []
+        return self.command_data(command)
+
+    def command_data(self, command):
         # binary_sensor
         # https://www.home-assistant.io/integrations/binary_sensor/#device-class
         command_data = {}
         state_data = {}
-        sdata = self.serialize(raw_data)
 
         # Assume all raw "command" comming from raw are binary_sensors
         device_model = 'binary_sensor'
-        state_data[device_model] = sdata['method']
+        state_data[device_model] = command.method
         command_data['type'] = device_model
-        command_data['command'] = DotMap(sdata)
+        command_data['command'] = command
         command_data['state_data'] = state_data
 
-        self.command = [command_data]
-        return self.command
+        return [command_data]
+
+    def config_topic(self, command_id):
+        return '{}/binary_sensor/{}_telldus/binary_sensor/config'.format(
+            self.templates.config_topic, command_id)
+
+    def command_id(self, config_topic):
+        # Id of the binary sensor a config topic belongs to, None for
+        # topics of other entities
+        prefix, suffix = self.config_topic('\0').split('\0')
+        if config_topic.startswith(prefix) and \
+                config_topic.endswith(suffix) and \
+                len(config_topic) > len(prefix) + len(suffix):
+            return config_topic[len(prefix):-len(suffix)]
+        return None
+
+    def forget(self, command_id):
+        self.templates.forget(('command', str(command_id), 'binary_sensor'))
 
     def serialize(self, raw_data):
-        raw = {}
-
-        if 'command' not in raw_data:
-            return {}
-
-        for d in raw_data.split(';'):
-            _d = d.split(':')
-            if _d[0] and _d[1]:
-                if _d[0] == 'house':
-                    raw['id'] = _d[1]
-                elif _d[0] == 'code':
-                    raw['id'] = _d[1]
-                elif _d[0] == 'method':
-                    if _d[1] == 'turnoff':
-                        raw[_d[0]] = const.TELLSTICK_TURNOFF
-                    elif _d[1] == 'turnon':
-                        raw[_d[0]] = const.TELLSTICK_TURNON
-                    else:
-                        raw[_d[0]] = const.TELLSTICK_ERROR_METHOD_NOT_SUPPORTED
-                else:
-                    raw[_d[0]] = _d[1]
-
-        self.serialized = raw
-        return self.serialized
+        command = parse_raw(raw_data)
+        if isinstance(command, RawCommand):
+            return command
+        return None
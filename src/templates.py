@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+
+JSON = 'json'
+COMPACT = 'compact'
+PAYLOADS = (JSON, COMPACT)
+
+
+class EntityTemplates:
+    # Topics and serialized discovery config of one entity, signature holds
+    # the entity attributes they were built from.
+    __slots__ = ('signature', 'config_topic', 'state_topic', 'command_topic',
+                 'brightness', 'config_data')
+
+    def __init__(self, config_topic, state_topic, command_topic=None,
+                 brightness=None):
+        self.signature = None
+        self.config_topic = config_topic
+        self.state_topic = state_topic
+        self.command_topic = command_topic
+        self.brightness = brightness
+        self.config_data = None
+
+    def topics(self, state_data):
+        topics = {'config': {'topic': self.config_topic,
+                             'data': self.config_data},
+                  'state': {'topic': self.state_topic,
+                            'data': state_data}}
+        if self.command_topic is not None:
+            topics['command'] = {'topic': self.command_topic}
+            topics['brightness'] = dict(self.brightness)
+        return topics
+
+
+class TemplateCache:
+    # Topics of an entity never change during a run, they are formatted
+    # once and reused for every event. Discovery configs are rebuilt when
+    # the entity signature (name, model, ...) changes, state payloads only
+    # need the value encoded, as {"<type>": value} or with the compact
+    # payload format as the bare value.
+    MAX_ENTRIES = 10000
+
+    def __init__(self, config):
+        self.config_topic = config['home_assistant']['config_topic']
+        self.state_topic = config['home_assistant']['state_topic']
+        payload = config['mqtt']['payload']
+        if payload not in PAYLOADS:
+            raise ValueError('Unknown payload format "{}", use one of {}'
+                             .format(payload, ', '.join(PAYLOADS)))
+        self.compact = payload == COMPACT
+        self._entities = {}
+        self._topics = {}
+        self._prefixes = {}
+
+    def clear(self):
+        self._entities = {}
+        self._topics = {}
+        self._prefixes = {}
+
+    def forget(self, key):
+        self._entities.pop(key, None)
+
+    def entity(self, key, signature, build):
+        templates = self._entities.get(key)
+        if templates is None or templates.signature != signature:
+            templates = build()
+            templates.signature = signature
+            self._entities[key] = templates
+        return templates
+
+    def topic(self, type_id, model):
+        key = (str(type_id), model)
+        topic = self._topics.get(key)
+        if topic is None:
+            if model == 'light':
+                topic = '{}/{}/brightness/dim'.format(self.state_topic,
+                                                      type_id)
+            else:
+                topic = '{}/{}/{}/state'.format(self.state_topic, type_id,
+                                                model)
+            # Ids come from MQTT topics too, keep the cache bounded
+            if len(self._topics) >= self.MAX_ENTRIES:
+                self._topics = {}
+            self._topics[key] = topic
+        return topic
+
+    def value_template(self, type_string):
+        # Home Assistant template reading the value from a state payload
+        if self.compact:
+            return '{{ value }}'
+        return '{{ value_json.%s }}' % type_string
+
+    def state(self, state_data):
+        # state_data is {type_string: value}
+        if self.compact:
+            return self.data(*next(iter(state_data.items())))
+        return json.dumps(state_data, ensure_ascii=False)
+
+    def data(self, type_string, value):
+        if self.compact:
+            if isinstance(value, str):
+                return value
+            return json.dumps(value, ensure_ascii=False)
+
+        # Same output as json.dumps({type_string: value})
+        prefix = self._prefixes.get(type_string)
+        if prefix is None:
+            prefix = '{%s: ' % json.dumps(type_string, ensure_ascii=False)
+            self._prefixes[type_string] = prefix
+        return prefix + json.dumps(value, ensure_ascii=False) + '}'
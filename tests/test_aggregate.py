@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from src.aggregate import Accumulator, Aggregator
+
+
+def angle_difference(first, second):
+    difference = abs(first - second) % 360
+    return min(difference, 360 - difference)
+
+
+class AccumulatorTest(unittest.TestCase):
+    def test_statistics(self):
+        window = Accumulator(0.0)
+        for value in (3.0, 1.0, 2.0):
+            window.add(value)
+        self.assertEqual(window.summary(), {'mean': 2.0, 'min': 1.0,
+                                            'max': 3.0, 'last': 2.0,
+                                            'count': 3})
+
+    def test_circular_mean_across_north(self):
+        window = Accumulator(0.0)
+        for value in (350.0, 10.0):
+            window.add(value, circular=True)
+        self.assertAlmostEqual(
+            angle_difference(window.mean(circular=True), 0.0), 0.0)
+        self.assertAlmostEqual(window.mean(), 180.0)
+
+    def test_circular_mean(self):
+        window = Accumulator(0.0)
+        for value in (80.0, 90.0, 100.0):
+            window.add(value, circular=True)
+        self.assertAlmostEqual(window.mean(circular=True), 90.0)
+
+    def test_circular_mean_opposite(self):
+        # No mean direction, the last reading is used
+        window = Accumulator(0.0)
+        for value in (90.0, 270.0):
+            window.add(value, circular=True)
+        self.assertEqual(window.mean(circular=True), 270.0)
+
+
+class AggregatorTest(unittest.TestCase):
+    def test_not_configured(self):
+        aggregator = Aggregator({'windgust': {'window': 10}})
+        self.assertFalse(aggregator.add(1, 'temperature', '20'))
+        self.assertTrue(aggregator.active)
+        self.assertFalse(Aggregator().active)
+
+    def test_not_a_number(self):
+        aggregator = Aggregator({'temperature': {'window': 10}})
+        self.assertFalse(aggregator.add(1, 'temperature', 'a'))
+
+    def test_window(self):
+        aggregator = Aggregator({'windgust': {'window': 10}})
+        for now, value in ((0.0, '3'), (4.0, '7'), (8.0, '5')):
+            self.assertTrue(aggregator.add(1, 'windgust', value, now=now))
+        self.assertEqual(aggregator.expired(now=9.0), [])
+
+        (entity_id, type_string, state, summary,
+         settings), = aggregator.expired(now=10.0)
+        self.assertEqual((entity_id, type_string), ('1', 'windgust'))
+        # Gusts publish their peak by default
+        self.assertEqual(state, 7.0)
+        self.assertEqual(summary['mean'], 5.0)
+        self.assertEqual(settings['statistic'], 'max')
+        self.assertEqual(aggregator.expired(now=20.0), [])
+        self.assertEqual(aggregator.stats(), {'aggregated': 3,
+                                              'summaries': 1,
+                                              'windows': 0})
+
+    def test_wind_direction(self):
+        aggregator = Aggregator({'winddirection': {'window': 10}})
+        for value in ('340', '20'):
+            aggregator.add(1, 'winddirection', value, now=0.0)
+        (_entity_id, _type_string, state, _summary,
+         _settings), = aggregator.expired(now=10.0)
+        self.assertAlmostEqual(angle_difference(state, 0.0), 0.0)
+
+    def test_sensor_override(self):
+        aggregator = Aggregator(
+            {'temperature': {'window': 60}},
+            {'7': {'temperature': {'statistic': 'last',
+                                   'attributes': 'true'}}})
+        settings = aggregator.settings_for(7, 'temperature')
+        self.assertEqual(settings, {'window': 60.0, 'statistic': 'last',
+                                    'attributes': True})
+        self.assertEqual(aggregator.settings_for(1, 'temperature')
+                         ['statistic'], 'mean')
+
+    def test_unknown_statistic(self):
+        aggregator = Aggregator({'temperature': {'statistic': 'median'}})
+        with self.assertRaises(ValueError):
+            aggregator.add(1, 'temperature', '20')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+import types
+import unittest
+
+import tellcore.constants as const
+
+from dev.simulator import FakeTelldusCore
+from src.bridge import Bridge
+from src.config import load_config
+
+
+class RecordingPublisher:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, msg, *args, **kwargs):
+        # pylint: disable=unused-argument
+        self.published.append((topic, msg))
+
+
+class BridgeTest(unittest.TestCase):
+    def setUp(self):
+        config = load_config()
+        config['snapshot']['enabled'] = 'false'
+        self.core = FakeTelldusCore(sensors=5, devices=3)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.bridge = Bridge(config, self.core, loop)
+        self.addCleanup(self.bridge.executor.shutdown)
+        self.publisher = RecordingPublisher()
+        self.bridge.publisher = self.publisher
+
+    def states(self):
+        return [(topic, msg) for topic, msg in self.publisher.published
+                if not topic.startswith('homeassistant/')]
+
+    def test_load(self):
+        self.bridge.load()
+        topics = [topic for topic, _ in self.publisher.published]
+        self.assertIn('homeassistant/sensor/1_telldus/temperature/config',
+                      topics)
+        self.assertIn('homeassistant/switch/1_telldus/switch/config', topics)
+        self.assertIn(('telldus/1/switch/state', '{"switch": 2}'),
+                      self.states())
+
+    def test_load_wind_direction_degrees(self):
+        # The initial state is in degrees like the sensor events
+        sensor = self.core.sensors()[3]
+        sensor.values[const.TELLSTICK_WINDDIRECTION] = '202.5'
+        self.bridge.load()
+        self.assertIn(('telldus/4/winddirection/state',
+                       '{"winddirection": "202.5"}'), self.states())
+
+    def test_load_checks_controllers(self):
+        config = load_config()
+        config['snapshot']['enabled'] = 'false'
+        config['controllers']['devices'] = {1: [1], 3: [2]}
+        bridge = Bridge(config, self.core, self.bridge.loop)
+        self.addCleanup(bridge.executor.shutdown)
+        bridge.publisher = self.publisher
+        with self.assertLogs(level='WARNING') as logs:
+            bridge.load()
+        self.assertEqual(logs.output, [
+            'WARNING:root:Controller 3 in controllers devices is not '
+            'connected to telldusd',
+            'WARNING:root:Devices 3 are not listed under controllers '
+            'devices, their commands share the default queue'])
+
+    def test_sensor_event(self):
+        self.bridge.sensor_event('fineoffset', 'temperature', 1,
+                                 const.TELLSTICK_TEMPERATURE, '21.5', 0, 1)
+        self.assertIn(('telldus/1/temperature/state',
+                       '{"temperature": "21.5"}'), self.states())
+
+    def test_sensor_event_deduplicated(self):
+        # A repeated frame inside the dedup window is not published again
+        for _ in range(3):
+            self.bridge.sensor_event('fineoffset', 'temperature', 1,
+                                     const.TELLSTICK_TEMPERATURE, '21.5', 0,
+                                     1)
+        self.bridge.sensor_event('fineoffset', 'temperature', 1,
+                                 const.TELLSTICK_TEMPERATURE, '21.6', 0, 1)
+        self.assertEqual(self.states(),
+                         [('telldus/1/temperature/state',
+                           '{"temperature": "21.5"}'),
+                          ('telldus/1/temperature/state',
+                           '{"temperature": "21.6"}')])
+
+    def test_raw_event(self):
+        self.bridge.raw_event(
+            'class:command;protocol:arctech;model:selflearning;house:123;'
+            'unit:1;group:0;method:turnon;', 1, 1)
+        self.assertIn(
+            'homeassistant/binary_sensor/123_telldus/binary_sensor/config',
+            [topic for topic, _ in self.publisher.published])
+        self.assertEqual(self.states(), [('telldus/123/binary_sensor/state',
+                                          '{"binary_sensor": 1}')])
+
+    def test_raw_sensor_ignored(self):
+        self.bridge.raw_event(
+            'class:sensor;protocol:fineoffset;id:1;model:temperature;'
+            'temp:21.5;', 1, 1)
+        self.assertEqual(self.publisher.published, [])
+
+    def test_device_event(self):
+        self.bridge.load()
+        del self.publisher.published[:]
+        self.bridge.device_event(1, const.TELLSTICK_TURNON, '', 1)
+        self.assertEqual(self.states(), [('telldus/1/switch/state',
+                                          '{"switch": 1}')])
+        # The echo of the same state is not published again
+        self.bridge.device_event(1, const.TELLSTICK_TURNON, '', 1)
+        self.assertEqual(len(self.states()), 1)
+
+    def test_on_message(self):
+        self.bridge.load()
+        del self.publisher.published[:]
+        scheduler = self.bridge.d.scheduler
+        scheduler.start()
+        self.addCleanup(scheduler.stop, 5)
+
+        msg = types.SimpleNamespace(topic='telldus/1/switch/set',
+                                    payload=b'1')
+        self.bridge.on_message(None, None, msg)
+        device = self.core.devices()[0]
+        deadline = time.monotonic() + 5
+        while not device.transmissions and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(device.last_command, const.TELLSTICK_TURNON)
+        # Optimistic state, published before the transmission
+        self.assertEqual(self.states(), [('telldus/1/switch/state',
+                                          '{"switch": 1}')])
+
+    def test_command_latency_from_arrival(self):
+        # Commands are timed from the MQTT message, not from scheduling
+        self.bridge.load()
+        scheduler = self.bridge.d.scheduler
+        self.bridge.groups = {'living_room': [2, 3]}
+        self.bridge.handle_message(types.SimpleNamespace(
+            topic='telldus/1/switch/set', payload=b'1'), received_at=12.5)
+        self.bridge.handle_group_message(types.SimpleNamespace(
+            topic='telldus/group/living_room/set', payload=b'1'),
+            received_at=13.5)
+        # pylint: disable=protected-access
+        self.assertEqual(scheduler._pending[1].queued_at, 12.5)
+        self.assertEqual(scheduler._pending[2].queued_at, 13.5)
+
+    def test_on_message_not_a_device(self):
+        # Matches the set topic when no groups are configured
+        msg = types.SimpleNamespace(topic='telldus/group/all/set',
+                                    payload=b'1')
+        with self.assertLogs(level='WARNING'):
+            self.bridge.on_message(None, None, msg)
+        self.assertEqual(self.publisher.published, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import tempfile
+import unittest
+
+from src.discovery import DiscoveryCache
+
+
+class DiscoveryCacheTest(unittest.TestCase):
+    def test_changed(self):
+        cache = DiscoveryCache()
+        self.assertTrue(cache.changed('a/config', '{"name": "a"}'))
+        self.assertFalse(cache.changed('a/config', '{"name": "a"}'))
+        self.assertTrue(cache.changed('a/config', '{"name": "b"}'))
+        self.assertTrue(cache.changed('b/config', '{"name": "b"}'))
+        self.assertEqual(len(cache), 2)
+
+    def test_forget(self):
+        cache = DiscoveryCache()
+        cache.changed('a/config', '{}')
+        cache.forget('a/config')
+        self.assertTrue(cache.changed('a/config', '{}'))
+
+    def test_republish(self):
+        cache = DiscoveryCache()
+        cache.changed('a/config', '1')
+        cache.changed('b/config', '2')
+        cache.changed('a/config', '3')
+        published = []
+        with self.assertLogs(level='INFO'):
+            cache.republish(lambda topic, payload: published.append(
+                (topic, payload)))
+        self.assertEqual(published, [('a/config', '3'), ('b/config', '2')])
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'state', 'snapshot.json')
+
+    def test_save_and_load(self):
+        cache = DiscoveryCache(self.path)
+        cache.changed('a/config', '{"name": "a"}')
+        cache.state_changed('a/state', '{"switch": 1}')
+        self.assertTrue(cache.save())
+        # Nothing changed since
+        self.assertFalse(cache.save())
+
+        loaded = DiscoveryCache(self.path)
+        with self.assertLogs(level='INFO'):
+            self.assertTrue(loaded.load())
+        self.assertFalse(loaded.changed('a/config', '{"name": "a"}'))
+        self.assertFalse(loaded.state_changed('a/state', '{"switch": 1}'))
+        self.assertTrue(loaded.state_changed('a/state', '{"switch": 2}'))
+
+    def test_no_path(self):
+        cache = DiscoveryCache()
+        cache.changed('a/config', '{}')
+        self.assertFalse(cache.save())
+        self.assertFalse(cache.load())
+
+    def test_missing_file(self):
+        self.assertFalse(DiscoveryCache(self.path).load())
+
+    def test_unknown_version(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w', encoding='utf-8') as stream:
+            json.dump({'version': 0, 'configs': {}}, stream)
+        cache = DiscoveryCache(self.path)
+        with self.assertLogs(level='WARNING'):
+            self.assertFalse(cache.load())
+
+    def test_corrupt_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w', encoding='utf-8') as stream:
+            stream.write('{"version"')
+        cache = DiscoveryCache(self.path)
+        with self.assertLogs(level='WARNING'):
+            self.assertFalse(cache.load())
+
+    def test_write_failure(self):
+        # A file where the directory should be, the snapshot is written
+        # again on the next save
+        with open(os.path.dirname(self.path), 'w', encoding='utf-8'):
+            pass
+        cache = DiscoveryCache(self.path)
+        cache.changed('a/config', '{}')
+        with self.assertLogs(level='ERROR'):
+            self.assertFalse(cache.save())
+        with self.assertLogs(level='ERROR'):
+            self.assertFalse(cache.save())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from src.filters import Deduplicator, PublishFilter
+
+
+class DeduplicatorTest(unittest.TestCase):
+    def test_repeat_within_window_suppressed(self):
+        dedup = Deduplicator(1.0)
+        self.assertFalse(dedup.is_duplicate(1, 'k', '20', now=0.0))
+        self.assertTrue(dedup.is_duplicate(1, 'k', '20', now=0.5))
+        self.assertFalse(dedup.is_duplicate(1, 'k', '21', now=0.6))
+        self.assertEqual(dedup.stats(), {'forwarded': 2, 'suppressed': 1})
+
+    def test_window_starts_at_last_forwarded(self):
+        # A value repeated more often than the window is still forwarded
+        # once per window
+        dedup = Deduplicator(1.0)
+        forwarded = [now for now in (0.0, 0.4, 0.8, 1.2, 1.6, 2.0, 2.4)
+                     if not dedup.is_duplicate(1, 'k', '20', now=now)]
+        self.assertEqual(forwarded, [0.0, 1.2, 2.4])
+
+    def test_keys_are_independent(self):
+        dedup = Deduplicator(1.0)
+        self.assertFalse(dedup.is_duplicate(1, 'a', '20', now=0.0))
+        self.assertFalse(dedup.is_duplicate(1, 'b', '20', now=0.1))
+
+    def test_window_per_entity(self):
+        dedup = Deduplicator(1.0, windows={'2': 0, 3: 5})
+        self.assertFalse(dedup.is_duplicate(2, 'b', '1', now=0.0))
+        self.assertFalse(dedup.is_duplicate(2, 'b', '1', now=0.1))
+        self.assertFalse(dedup.is_duplicate('3', 'c', '1', now=0.0))
+        self.assertTrue(dedup.is_duplicate('3', 'c', '1', now=4.0))
+
+    def test_expired_entries_pruned(self):
+        dedup = Deduplicator(1.0)
+        for i in range(5):
+            dedup.is_duplicate(1, i, '20', now=i * 0.4)
+        # Only the keys forwarded within the last second are kept
+        self.assertEqual(list(dedup._seen), [2, 3, 4])
+
+    def test_max_entries(self):
+        dedup = Deduplicator(10.0)
+        dedup.MAX_ENTRIES = 2
+        for key in ('a', 'b', 'c'):
+            dedup.is_duplicate(1, key, '20', now=0.0)
+        self.assertEqual(list(dedup._seen), ['b', 'c'])
+        # A key moves to the back when it is forwarded again
+        dedup.is_duplicate(1, 'b', '21', now=1.0)
+        dedup.is_duplicate(1, 'd', '20', now=1.0)
+        self.assertEqual(list(dedup._seen), ['b', 'd'])
+
+
+class PublishFilterTest(unittest.TestCase):
+    def test_not_configured(self):
+        publish_filter = PublishFilter({'humidity': {'deadband': 5}})
+        for now in (0.0, 0.1):
+            self.assertTrue(publish_filter.should_publish(
+                1, 'temperature', '20', now=now))
+
+    def test_deadband(self):
+        publish_filter = PublishFilter({'temperature': {'deadband': 0.5}})
+        published = [value for value in ('20.0', '20.3', '20.6', '20.2',
+                                         '20.0')
+                     if publish_filter.should_publish(1, 'temperature',
+                                                      value, now=0.0)]
+        self.assertEqual(published, ['20.0', '20.6', '20.0'])
+        self.assertEqual(publish_filter.stats(),
+                         {'published': 3, 'filtered': 2})
+
+    def test_relative_deadband(self):
+        publish_filter = PublishFilter(
+            {'rainrate': {'relative_deadband': 0.1}})
+        self.assertTrue(publish_filter.should_publish(1, 'rainrate', '10'))
+        self.assertFalse(publish_filter.should_publish(1, 'rainrate', '11'))
+        self.assertTrue(publish_filter.should_publish(1, 'rainrate', '11.5'))
+
+    def test_min_interval(self):
+        publish_filter = PublishFilter({'temperature': {'min_interval': 10}})
+        self.assertTrue(publish_filter.should_publish(
+            1, 'temperature', '20', now=0.0))
+        self.assertFalse(publish_filter.should_publish(
+            1, 'temperature', '25', now=5.0))
+        self.assertTrue(publish_filter.should_publish(
+            1, 'temperature', '25', now=10.0))
+
+    def test_max_interval(self):
+        publish_filter = PublishFilter(
+            {'temperature': {'deadband': 1, 'max_interval': 60}})
+        self.assertTrue(publish_filter.should_publish(
+            1, 'temperature', '20', now=0.0))
+        self.assertFalse(publish_filter.should_publish(
+            1, 'temperature', '20', now=59.0))
+        self.assertTrue(publish_filter.should_publish(
+            1, 'temperature', '20', now=60.0))
+
+    def test_sensor_override(self):
+        publish_filter = PublishFilter(
+            {'temperature': {'deadband': 1}},
+            {'7': {'temperature': {'deadband': 0}}})
+        for sensor_id, expected in ((1, False), (7, True)):
+            publish_filter.should_publish(sensor_id, 'temperature', '20')
+            self.assertEqual(publish_filter.should_publish(
+                sensor_id, 'temperature', '20.5'), expected)
+
+    def test_not_a_number(self):
+        publish_filter = PublishFilter({'temperature': {'deadband': 1}})
+        self.assertTrue(publish_filter.should_publish(1, 'temperature', 'a'))
+        self.assertFalse(publish_filter.should_publish(1, 'temperature', 'a'))
+        self.assertTrue(publish_filter.should_publish(1, 'temperature', 'b'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from src.journal import Journal
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'spool', 'journal.db')
+
+    def open(self, maxsize=100):
+        journal = Journal(self.path, maxsize)
+        self.addCleanup(journal.close)
+        return journal
+
+    def test_replay_in_order(self):
+        journal = self.open()
+        journal.extend([('a', '1', True, 0.0), ('b', '1', False, 0.0)])
+        self.assertEqual([item[1:] for item in journal.peek(10)],
+                         [('a', '1', True), ('b', '1', False)])
+        self.assertEqual(len(journal), 2)
+
+    def test_latest_per_topic(self):
+        # A newer message replaces the row and moves it last
+        journal = self.open()
+        journal.extend([('a', '1', True, 0.0), ('b', '1', True, 0.0)])
+        journal.extend([('a', '2', True, 0.0)])
+        self.assertEqual([item[1:3] for item in journal.peek(10)],
+                         [('b', '1'), ('a', '2')])
+        self.assertEqual(len(journal), 2)
+
+    def test_remove(self):
+        journal = self.open()
+        journal.extend([('a', '1', True, 0.0), ('b', '1', True, 0.0),
+                        ('c', '1', True, 0.0)])
+        batch = journal.peek(2)
+        journal.remove(batch[-1][0])
+        self.assertEqual([item[1] for item in journal.peek(10)], ['c'])
+        self.assertEqual(journal.stats(), {'depth': 1, 'journaled': 3,
+                                           'replayed': 2, 'dropped': 0})
+        journal.remove(journal.peek(1)[0][0])
+        self.assertFalse(journal)
+
+    def test_full(self):
+        journal = self.open(maxsize=2)
+        with self.assertLogs(level='WARNING'):
+            journal.extend([('a', '1', True, 0.0), ('b', '1', True, 0.0),
+                            ('c', '1', True, 0.0)])
+        self.assertEqual([item[1] for item in journal.peek(10)], ['b', 'c'])
+        self.assertEqual(journal.dropped, 1)
+
+    def test_survives_restart(self):
+        journal = Journal(self.path)
+        journal.extend([('a', '1', True, 0.0)])
+        journal.close()
+
+        with self.assertLogs(level='INFO'):
+            journal = self.open()
+        self.assertEqual([item[1:] for item in journal.peek(10)],
+                         [('a', '1', True)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+import urllib.error
+import urllib.request
+
+from src.metrics import Counter, Histogram, Metrics, MetricsServer
+
+
+def samples(metric):
+    return dict(metric.samples())
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counter(self):
+        counter = Counter('events_total', 'Events', ('kind',))
+        self.assertEqual(samples(counter), {})
+        counter.inc('sensor')
+        counter.inc('sensor', amount=2)
+        counter.inc('raw')
+        self.assertEqual(samples(counter), {'events_total{kind="sensor"}': 3,
+                                            'events_total{kind="raw"}': 1})
+
+    def test_counter_without_labels(self):
+        self.assertEqual(samples(Counter('reconnects_total', 'Reconnects')),
+                         {'reconnects_total': 0})
+
+    def test_label_escaping(self):
+        counter = Counter('events_total', 'Events', ('kind',))
+        counter.inc('a"b\\c')
+        self.assertEqual(list(samples(counter)),
+                         ['events_total{kind="a\\"b\\\\c"}'])
+
+    def test_histogram(self):
+        histogram = Histogram('latency_seconds', 'Latency', (0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(samples(histogram),
+                         {'latency_seconds_bucket{le="0.1"}': 2,
+                          'latency_seconds_bucket{le="1"}': 3,
+                          'latency_seconds_bucket{le="+Inf"}': 4,
+                          'latency_seconds_sum': 2.65,
+                          'latency_seconds_count': 4})
+
+    def test_render(self):
+        metrics = Metrics()
+        metrics.events.inc('sensor')
+        metrics.callback('queue_depth', 'Waiting', lambda: 3)
+        metrics.callback('pending', 'Pending', lambda: {('1',): 2},
+                         ('controller',))
+        text = metrics.render()
+        self.assertIn('# TYPE telldus_events_total counter\n'
+                      'telldus_events_total{kind="sensor"} 1\n', text)
+        self.assertIn('# HELP queue_depth Waiting\n'
+                      '# TYPE queue_depth gauge\n'
+                      'queue_depth 3\n', text)
+        self.assertIn('pending{controller="1"} 2\n', text)
+
+    def test_failing_callback(self):
+        # Left out of the scrape, the other metrics are still rendered
+        metrics = Metrics()
+        metrics.callback('broken', 'Broken', lambda: 1 / 0)
+        text = metrics.render()
+        self.assertNotIn('broken', text)
+        self.assertIn('telldus_mqtt_reconnects_total 0\n', text)
+
+
+class MetricsServerTest(unittest.TestCase):
+    def test_scrape(self):
+        metrics = Metrics()
+        server = MetricsServer(metrics, '127.0.0.1', 0)
+        with self.assertLogs(level='INFO'):
+            server.start()
+        self.addCleanup(server.stop)
+        url = 'http://127.0.0.1:{}'.format(server.server.server_address[1])
+
+        with urllib.request.urlopen(url + '/metrics', timeout=5) as response:
+            self.assertEqual(response.headers['Content-Type'],
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.assertEqual(response.read().decode('utf-8'),
+                             metrics.render())
+
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            urllib.request.urlopen(url + '/other', timeout=5)
+        self.assertEqual(context.exception.code, 404)
+        context.exception.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+from src.pipeline import BLOCK, DROP_OLDEST, KEEP_LATEST, EventQueue
+
+
+def drain(queue):
+    items = []
+    while True:
+        item = queue.pop()
+        if item is None:
+            return items
+        items.append(item[:2])
+
+
+class EventQueueTest(unittest.TestCase):
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            EventQueue(policy='newest')
+
+    def test_keep_latest_replaces_in_place(self):
+        queue = EventQueue(policy=KEEP_LATEST)
+        queue.put('a', '1')
+        queue.put('b', '1')
+        queue.put('a', '2')
+        self.assertEqual(drain(queue), [('a', '2'), ('b', '1')])
+        self.assertEqual(queue.replaced, 1)
+
+    def test_keep_latest_drops_oldest_topic_when_full(self):
+        queue = EventQueue(maxsize=2, policy=KEEP_LATEST)
+        queue.put('a', '1')
+        queue.put('b', '1')
+        with self.assertLogs(level='WARNING'):
+            queue.put('c', '1')
+        self.assertEqual(drain(queue), [('b', '1'), ('c', '1')])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_drop_oldest_keeps_every_message(self):
+        queue = EventQueue(maxsize=2, policy=DROP_OLDEST)
+        queue.put('a', '1')
+        queue.put('a', '2')
+        with self.assertLogs(level='WARNING'):
+            queue.put('a', '3')
+        self.assertEqual(drain(queue), [('a', '2'), ('a', '3')])
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(queue.high_water, 2)
+
+    def test_block_drops_after_timeout(self):
+        queue = EventQueue(maxsize=1, policy=BLOCK, block_timeout=0.05)
+        queue.put('a', '1')
+        started = time.monotonic()
+        with self.assertLogs(level='WARNING'):
+            queue.put('b', '1')
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual(drain(queue), [('b', '1')])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_block_waits_for_room(self):
+        queue = EventQueue(maxsize=1, policy=BLOCK, block_timeout=5)
+        queue.put('a', '1')
+        timer = threading.Timer(0.05, queue.pop)
+        timer.start()
+        queue.put('b', '1')
+        timer.join()
+        self.assertEqual(drain(queue), [('b', '1')])
+        self.assertEqual(queue.dropped, 0)
+
+    def test_block_disabled_per_put(self):
+        queue = EventQueue(maxsize=1, policy=BLOCK, block_timeout=5)
+        queue.put('a', '1')
+        started = time.monotonic()
+        with self.assertLogs(level='WARNING'):
+            queue.put('b', '1', block=False)
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(drain(queue), [('b', '1')])
+
+    def test_queued_at(self):
+        queue = EventQueue()
+        queue.put('a', '1', retain=False, queued_at=12.5)
+        self.assertEqual(queue.pop(), ('a', '1', False, 12.5))
+
+    def test_requeue_first_in_line(self):
+        for policy in (KEEP_LATEST, DROP_OLDEST):
+            queue = EventQueue(policy=policy)
+            queue.put('a', '1')
+            queue.requeue('b', '1')
+            self.assertEqual(drain(queue), [('b', '1'), ('a', '1')])
+
+    def test_requeue_keep_latest_newer_wins(self):
+        queue = EventQueue(policy=KEEP_LATEST)
+        queue.put('a', '2')
+        queue.requeue('a', '1')
+        self.assertEqual(drain(queue), [('a', '2')])
+
+    def test_compact(self):
+        queue = EventQueue(policy=DROP_OLDEST)
+        for topic, msg in (('a', '1'), ('b', '1'), ('a', '2')):
+            queue.put(topic, msg)
+        self.assertEqual(queue.compact(), 1)
+        self.assertEqual(drain(queue), [('b', '1'), ('a', '2')])
+        self.assertEqual(queue.replaced, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from src.profiling import Profiler
+
+
+def work():
+    return sum(range(1000))
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_written(self):
+        profiler = Profiler(os.path.join(self.directory, 'profiles'),
+                            [work])
+        self.assertTrue(profiler.start())
+        self.assertFalse(profiler.start())
+        work()
+        with self.assertLogs(level='INFO'):
+            path = profiler.stop()
+        self.assertFalse(profiler.running)
+        self.assertTrue(os.path.exists(path))
+        self.assertIsNone(profiler.stop())
+
+    def test_write_failure_logged(self):
+        # A directory that cannot be created loses the profile only
+        blocker = os.path.join(self.directory, 'file')
+        with open(blocker, 'w', encoding='utf-8'):
+            pass
+        profiler = Profiler(os.path.join(blocker, 'profiles'))
+        profiler.start()
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(profiler.stop())
+        self.assertFalse(profiler.running)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from paho.mqtt import client as mqtt_client
+
+from src.pipeline import BLOCK, EventQueue
+from src.publisher import Publisher, TopicAliases
+
+
+class Client:
+    # Records what paho would put on the wire
+    def __init__(self):
+        self.published = []
+        self.rc = mqtt_client.MQTT_ERR_SUCCESS
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def publish(self, topic, msg, qos=0, retain=False, properties=None):
+        # pylint: disable=unused-argument
+        alias = None if properties is None else properties.TopicAlias
+        self.published.append((topic, alias))
+        return self.rc, len(self.published)
+
+
+class TopicAliasesTest(unittest.TestCase):
+    def test_alias_on_second_publish(self):
+        aliases = TopicAliases()
+        aliases.reset(10)
+        client = Client()
+        for _publish in range(3):
+            aliases.publish(client, 'telldus/1/temperature', '20')
+        self.assertEqual(client.published,
+                         [('telldus/1/temperature', None),
+                          ('telldus/1/temperature', 1),
+                          ('', 1)])
+
+    def test_maximum(self):
+        aliases = TopicAliases()
+        aliases.reset(1)
+        client = Client()
+        for topic in ('a', 'b', 'a', 'b', 'a', 'b'):
+            aliases.publish(client, topic, '1')
+        self.assertEqual(client.published, [('a', None), ('b', None),
+                                            ('a', 1), ('b', None),
+                                            ('', 1), ('b', None)])
+        self.assertEqual(len(aliases), 1)
+
+    def test_disabled(self):
+        aliases = TopicAliases()
+        client = Client()
+        for _publish in range(3):
+            aliases.publish(client, 'a', '1')
+        self.assertEqual(client.published, [('a', None)] * 3)
+
+    def test_failed_publish_frees_alias(self):
+        aliases = TopicAliases()
+        aliases.reset(1)
+        client = Client()
+        aliases.publish(client, 'a', '1')
+        client.rc = mqtt_client.MQTT_ERR_NO_CONN
+        aliases.publish(client, 'a', '1')
+        client.rc = mqtt_client.MQTT_ERR_SUCCESS
+        aliases.publish(client, 'a', '1')
+        self.assertEqual(client.published, [('a', None), ('a', 1), ('a', 1)])
+        self.assertEqual(len(aliases), 1)
+
+    def test_most_published_topics(self):
+        # The alias moves to the topic published most since the last
+        # rebalance
+        aliases = TopicAliases()
+        aliases.REBALANCE = 10
+        aliases.reset(1)
+        client = Client()
+        for topic in ['a'] * 2 + ['b'] * 8 + ['a', 'b']:
+            aliases.publish(client, topic, '1')
+        self.assertEqual(client.published,
+                         [('a', None), ('a', 1)] + [('b', None)] * 7
+                         + [('b', 1), ('a', None), ('', 1)])
+
+    def test_rebalance_keeps_alias_on_tie(self):
+        aliases = TopicAliases()
+        aliases.REBALANCE = 4
+        aliases.reset(1)
+        client = Client()
+        for topic in ('a', 'a', 'b', 'b', 'a', 'b'):
+            aliases.publish(client, topic, '1')
+        self.assertEqual(client.published[-2:], [('', 1), ('b', None)])
+
+    def test_reset(self):
+        # A new connection starts without aliases
+        aliases = TopicAliases()
+        aliases.reset(10)
+        client = Client()
+        for _publish in range(2):
+            aliases.publish(client, 'a', '1')
+        aliases.reset(10)
+        aliases.publish(client, 'a', '1')
+        self.assertEqual(client.published[-1], ('a', None))
+        self.assertEqual(len(aliases), 0)
+
+
+class PublisherTest(unittest.TestCase):
+    def test_published_on_callers_thread(self):
+        # No flush thread needed while the in-flight window has room
+        client = Client()
+        publisher = Publisher(client, max_inflight=2)
+        publisher.publish('a', '1')
+        self.assertEqual(client.published, [('a', None)])
+        self.assertEqual(publisher.depth(), 0)
+        self.assertEqual(publisher.inflight(), 1)
+
+    def test_queued_when_window_full(self):
+        client = Client()
+        publisher = Publisher(client, max_inflight=1)
+        for topic in ('a', 'b', 'c'):
+            publisher.publish(topic, '1')
+        self.assertEqual(client.published, [('a', None)])
+        self.assertEqual(publisher.depth(), 2)
+
+        # Nothing is sent before the window has room
+        self.assertEqual(publisher.flush(), 0)
+        client.on_publish(client, None, 1)
+        self.assertEqual(publisher.flush(), 1)
+        # Queued messages keep their order, a new one waits behind them
+        client.on_publish(client, None, 2)
+        publisher.publish('d', '1')
+        publisher.flush()
+        self.assertEqual(client.published, [('a', None), ('b', None),
+                                            ('c', None)])
+        self.assertEqual(publisher.depth(), 1)
+
+    def test_queued_while_disconnected(self):
+        client = Client()
+        client.connected = False
+        publisher = Publisher(client)
+        publisher.publish('a', '1')
+        self.assertEqual(client.published, [])
+        client.connected = True
+        publisher.on_connected()
+        publisher.flush()
+        self.assertEqual(client.published, [('a', None)])
+
+    def test_failed_publish_requeued(self):
+        client = Client()
+        client.rc = mqtt_client.MQTT_ERR_NO_CONN
+        publisher = Publisher(client)
+        with self.assertLogs(level='ERROR'):
+            publisher.publish('a', '1')
+        self.assertEqual(publisher.depth(), 1)
+        self.assertEqual(publisher.inflight(), 0)
+
+    def test_network_thread_never_blocks(self):
+        # The thread that reports messages as sent cannot wait for room
+        client = Client()
+        client.connected = False
+        queue = EventQueue(maxsize=1, policy=BLOCK, block_timeout=5)
+        publisher = Publisher(client, queue=queue)
+        publisher.on_connected()
+        publisher.publish('a', '1')
+        started = time.monotonic()
+        with self.assertLogs(level='WARNING'):
+            publisher.publish('b', '1')
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(publisher.depth(), 1)
+
+    def test_reconnect_resets_window(self):
+        client = Client()
+        publisher = Publisher(client, max_inflight=1)
+        publisher.publish('a', '1')
+        publisher.on_connected(reconnected=True)
+        # A late report for the old connection does not open the window
+        # further
+        client.on_publish(client, None, 1)
+        publisher.publish('b', '1')
+        publisher.publish('c', '1')
+        self.assertEqual(client.published, [('a', None), ('b', None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
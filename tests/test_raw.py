@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+import tellcore.constants as const
+
+from src.raw import RawCommand, RawSensor, parse_raw
+
+
+class ParseRawTest(unittest.TestCase):
+    def test_command(self):
+        self.assertEqual(
+            parse_raw('class:command;protocol:arctech;model:selflearning;'
+                      'house:123;unit:1;group:0;method:turnon;'),
+            RawCommand('arctech', 'selflearning', '123', '1', '0',
+                       const.TELLSTICK_TURNON))
+
+    def test_command_code(self):
+        command = parse_raw('class:command;protocol:sartano;model:codeswitch;'
+                            'code:0101010101;method:turnoff;')
+        self.assertEqual(command.id, '0101010101')
+        self.assertEqual(command.method, const.TELLSTICK_TURNOFF)
+
+    def test_command_unknown_method(self):
+        command = parse_raw('class:command;protocol:arctech;house:A;'
+                            'method:bell;')
+        self.assertEqual(command.method,
+                         const.TELLSTICK_ERROR_METHOD_NOT_SUPPORTED)
+
+    def test_command_missing_fields(self):
+        self.assertIsNone(parse_raw('class:command;protocol:arctech;'
+                                    'house:123;'))
+
+    def test_sensor(self):
+        self.assertEqual(
+            parse_raw('class:sensor;protocol:fineoffset;'
+                      'model:temperaturehumidity;id:135;humidity:40;'
+                      'temp:21.3;'),
+            RawSensor('fineoffset', 'temperaturehumidity', '135', '21.3',
+                      '40'))
+
+    def test_sensor_not_decoded(self):
+        self.assertIsNone(parse_raw('class:sensor;protocol:oregon;'
+                                    'model:0x1A2D;data:20BA000000;'))
+
+    def test_unknown_class(self):
+        self.assertIsNone(parse_raw('class:other;protocol:arctech;'))
+        self.assertIsNone(parse_raw(''))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from src.registry import RawRegistry
+
+
+class RawRegistryTest(unittest.TestCase):
+    def test_evicts_least_recently_seen(self):
+        registry = RawRegistry(maxsize=2)
+        registry.sighting('a', now=0.0)
+        registry.sighting('b', now=1.0)
+        # a is seen again, so b is the least recently seen
+        self.assertEqual(registry.sighting('a', now=2.0), (True, []))
+        self.assertEqual(registry.sighting('c', now=3.0), (True, ['b']))
+        self.assertIn('a', registry)
+        self.assertNotIn('b', registry)
+        self.assertEqual(registry.evicted, 1)
+
+    def test_add(self):
+        registry = RawRegistry(maxsize=1)
+        self.assertEqual(registry.add(1, now=0.0), [])
+        self.assertEqual(registry.add(2, now=1.0), ['1'])
+        self.assertIn(2, registry)
+
+    def test_expired(self):
+        registry = RawRegistry(expire=10)
+        registry.sighting('a', now=0.0)
+        registry.sighting('b', now=5.0)
+        self.assertEqual(registry.expired(now=9.0), [])
+        self.assertEqual(registry.expired(now=12.0), ['a'])
+        self.assertEqual(len(registry), 1)
+
+    def test_never_expires(self):
+        registry = RawRegistry(expire=0)
+        registry.sighting('a', now=0.0)
+        self.assertEqual(registry.expired(now=1e9), [])
+
+    def test_sightings(self):
+        registry = RawRegistry(sightings=3, window=10)
+        self.assertEqual(registry.sighting('a', now=0.0), (False, []))
+        self.assertEqual(registry.sighting('a', now=1.0), (False, []))
+        self.assertEqual(registry.sighting('a', now=2.0), (True, []))
+        self.assertIn('a', registry)
+
+    def test_sightings_outside_window(self):
+        registry = RawRegistry(sightings=2, window=10)
+        registry.sighting('a', now=0.0)
+        self.assertEqual(registry.sighting('a', now=20.0), (False, []))
+        self.assertEqual(registry.sighting('a', now=25.0), (True, []))
+        self.assertEqual(registry.stats()['rejected'], 2)
+
+    def test_allow_and_deny(self):
+        registry = RawRegistry(allow=[1, 2], deny=['2'])
+        self.assertTrue(registry.sighting(1)[0])
+        self.assertFalse(registry.sighting(2)[0])
+        self.assertFalse(registry.sighting(3)[0])
+        self.assertEqual(registry.rejected, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
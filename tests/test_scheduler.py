@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import types
+import unittest
+
+from src.scheduler import CommandScheduler, ControllerSchedulers
+
+
+def device(id_):
+    return types.SimpleNamespace(id=id_)
+
+
+class Recorder:
+    # transmit and on_complete for a scheduler, done is set once expected
+    # commands have completed
+    def __init__(self, expected, fail=()):
+        self.expected = expected
+        self.fail = set(fail)
+        self.sent = []
+        self.completed = []
+        self.done = threading.Event()
+
+    def transmit(self, device_, action, value):
+        if int(device_.id) in self.fail:
+            raise RuntimeError('transmit failed')
+        self.sent.append((device_.id, action, value))
+
+    def on_complete(self, command):
+        self.completed.append((command.device.id, command.value,
+                               command.sent))
+        if len(self.completed) == self.expected:
+            self.done.set()
+
+
+class CommandSchedulerTest(unittest.TestCase):
+    def run_scheduler(self, scheduler, recorder):
+        scheduler.start()
+        try:
+            self.assertTrue(recorder.done.wait(5))
+        finally:
+            scheduler.stop(5)
+
+    def test_round_robin_repeats(self):
+        recorder = Recorder(2)
+        scheduler = CommandScheduler(recorder.transmit, 2,
+                                     recorder.on_complete)
+        scheduler.submit(device(1), 'turn_on')
+        scheduler.submit(device(2), 'turn_off')
+        self.run_scheduler(scheduler, recorder)
+        self.assertEqual([sent[0] for sent in recorder.sent], [1, 2, 1, 2])
+
+    def test_coalescing(self):
+        recorder = Recorder(1)
+        scheduler = CommandScheduler(recorder.transmit, 2,
+                                     recorder.on_complete)
+        for value in (10, 20, 30):
+            scheduler.submit(device(1), 'dim', value)
+        self.assertEqual(scheduler.pending(), 1)
+        self.run_scheduler(scheduler, recorder)
+        self.assertEqual(recorder.sent, [(1, 'dim', 30), (1, 'dim', 30)])
+        self.assertEqual(scheduler.coalesced, 2)
+
+    def test_failure_keeps_running(self):
+        recorder = Recorder(2, fail=[1])
+        scheduler = CommandScheduler(recorder.transmit, 1,
+                                     recorder.on_complete)
+        scheduler.submit(device(1), 'turn_on')
+        scheduler.submit(device(2), 'turn_on')
+        with self.assertLogs(level='ERROR'):
+            self.run_scheduler(scheduler, recorder)
+        # Completed with nothing sent, so no state is confirmed
+        self.assertEqual(recorder.completed, [(1, None, 0), (2, None, 1)])
+        self.assertEqual(scheduler.failed, 1)
+
+    def test_batch(self):
+        recorder = Recorder(2)
+        batches = []
+        scheduler = CommandScheduler(recorder.transmit, 2,
+                                     recorder.on_complete)
+        batch = scheduler.submit_batch(
+            [(device(1), 'turn_on', None, ()),
+             (device(2), 'turn_on', None, [device(3)])],
+            'all', batches.append)
+        self.assertEqual(batch.remaining, 2)
+        self.assertIsNone(scheduler.submit_batch([]))
+        self.run_scheduler(scheduler, recorder)
+        self.assertEqual(batches, [batch])
+        self.assertEqual(batch.remaining, 0)
+        self.assertIsNotNone(batch.duration)
+
+    def test_batch_replaced(self):
+        # The group is complete when the command replacing its member has
+        # been sent, and a replaced command keeps its shared devices
+        recorder = Recorder(2)
+        batches = []
+        scheduler = CommandScheduler(recorder.transmit, 1,
+                                     recorder.on_complete)
+        batch = scheduler.submit_batch(
+            [(device(1), 'turn_on', None, [device(3)]),
+             (device(2), 'turn_on', None, ())],
+            'all', batches.append)
+        scheduler.submit(device(1), 'turn_off')
+        replacing = scheduler._pending[1]  # pylint: disable=protected-access
+        self.assertEqual([shared.id for shared in replacing.shared], [3])
+        self.assertEqual(replacing.batches, (batch,))
+
+        self.run_scheduler(scheduler, recorder)
+        self.assertEqual(batches, [batch])
+        self.assertIn((1, 'turn_off', None), recorder.sent)
+        self.assertNotIn((1, 'turn_on', None), recorder.sent)
+
+
+class ControllerSchedulersTest(unittest.TestCase):
+    def test_routes(self):
+        schedulers = ControllerSchedulers(lambda *args: None, 1,
+                                          {1: [1], 2: None})
+        schedulers.submit(device(1), 'turn_on')
+        schedulers.submit(device(2), 'turn_on')
+        schedulers.submit(device(3), 'turn_on')
+        self.assertEqual(schedulers.pending_by_controller(),
+                         {('default',): 2, ('1',): 1, ('2',): 0})
+        self.assertEqual(schedulers.pending(), 3)
+        self.assertEqual(schedulers.unrouted([1, 2, 3]), [2, 3])
+
+    def test_batch_split(self):
+        done = threading.Event()
+        schedulers = ControllerSchedulers(lambda *args: None, 1, {1: [1]})
+        batch = schedulers.submit_batch(
+            [(device(1), 'turn_on', None, ()),
+             (device(2), 'turn_on', None, ())],
+            'all', lambda _batch: done.set())
+        self.assertEqual(schedulers.pending_by_controller(),
+                         {('default',): 1, ('1',): 1})
+        schedulers.start()
+        try:
+            self.assertTrue(done.wait(5))
+        finally:
+            schedulers.stop(5)
+        self.assertEqual(batch.remaining, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+
+import tellcore.constants as const
+
+from src.states import DeviceStates, StateTable
+
+
+class StateTableTest(unittest.TestCase):
+    def test_snapshot(self):
+        table = StateTable('telldus')
+        table.update('telldus/135/temperature/state',
+                     '{"temperature": "21.3"}')
+        table.update('telldus/3/switch/state', '{"switch": 1}')
+        table.update('telldus/4/brightness/dim', '{"light": 128}')
+        table.update('telldus/3/switch/state', '{"switch": 2}')
+        self.assertEqual(json.loads(table.snapshot(now=1650000000.5)),
+                         {'time': 1650000000,
+                          'states': {'135/temperature': '21.3',
+                                     '3/switch': 2,
+                                     '4/brightness': 128}})
+        self.assertEqual(len(table), 3)
+
+    def test_other_topics_ignored(self):
+        table = StateTable('telldus')
+        table.update('telldus/135/temperature/attributes', '{"mean": 1}')
+        table.update('other/3/switch/state', '{"switch": 1}')
+        table.update('telldus/snapshot', '{}')
+        self.assertEqual(len(table), 0)
+
+    def test_plain_payload(self):
+        table = StateTable('telldus')
+        table.update('telldus/135/temperature/state', '21.3')
+        table.update('telldus/7/switch/state', 'on')
+        self.assertEqual(json.loads(table.snapshot())['states'],
+                         {'135/temperature': 21.3, '7/switch': 'on'})
+
+    def test_remove(self):
+        table = StateTable('telldus')
+        table.update('telldus/7/binary_sensor/state', '1')
+        table.remove('telldus/7/binary_sensor/state')
+        self.assertEqual(json.loads(table.snapshot())['states'], {})
+
+
+class DeviceStatesTest(unittest.TestCase):
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            DeviceStates('pessimistic')
+
+    def test_mode(self):
+        self.assertTrue(DeviceStates().optimistic)
+        self.assertFalse(DeviceStates('confirmed').optimistic)
+
+    def test_set_returns_changes(self):
+        states = DeviceStates()
+        self.assertEqual(states.set(1, const.TELLSTICK_TURNON),
+                         (const.TELLSTICK_TURNON, None))
+        self.assertIsNone(states.set('1', const.TELLSTICK_TURNON))
+        self.assertEqual(states.get('1'), (const.TELLSTICK_TURNON, None))
+        self.assertIsNone(states.get(2))
+
+    def test_dim_level(self):
+        # Only dims keep a value, as an int when it is a number
+        states = DeviceStates()
+        self.assertEqual(states.set(1, const.TELLSTICK_DIM, '128'),
+                         (const.TELLSTICK_DIM, 128))
+        self.assertIsNone(states.set(1, const.TELLSTICK_DIM, 128))
+        self.assertEqual(states.set(1, const.TELLSTICK_DIM, 'x'),
+                         (const.TELLSTICK_DIM, 'x'))
+        self.assertEqual(states.set(1, const.TELLSTICK_TURNOFF, '0'),
+                         (const.TELLSTICK_TURNOFF, None))
+        self.assertEqual(len(states), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
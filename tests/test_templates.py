@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+
+from src.templates import EntityTemplates, TemplateCache
+
+
+def config(payload='json'):
+    return {'home_assistant': {'config_topic': 'homeassistant',
+                               'state_topic': 'telldus'},
+            'mqtt': {'payload': payload}}
+
+
+class TemplateCacheTest(unittest.TestCase):
+    def test_topic(self):
+        cache = TemplateCache(config())
+        self.assertEqual(cache.topic(135, 'temperature'),
+                         'telldus/135/temperature/state')
+        self.assertEqual(cache.topic('2', 'light'),
+                         'telldus/2/brightness/dim')
+        self.assertIs(cache.topic(135, 'temperature'),
+                      cache.topic('135', 'temperature'))
+
+    def test_data(self):
+        # Same payload as json.dumps of the state dict
+        cache = TemplateCache(config())
+        for type_string, value in (('temperature', '21.3'),
+                                   ('switch', 1),
+                                   ('light', None),
+                                   ('name', 'kök "1"')):
+            self.assertEqual(cache.data(type_string, value),
+                             json.dumps({type_string: value},
+                                        ensure_ascii=False))
+
+    def test_entity(self):
+        # Rebuilt only when the signature changes
+        cache = TemplateCache(config())
+        builds = []
+
+        def build():
+            builds.append(1)
+            return EntityTemplates('config', 'state')
+
+        first = cache.entity(1, ('name', 'model'), build)
+        self.assertIs(cache.entity(1, ('name', 'model'), build), first)
+        self.assertIsNot(cache.entity(1, ('other', 'model'), build), first)
+        self.assertEqual(len(builds), 2)
+
+        cache.clear()
+        cache.entity(1, ('other', 'model'), build)
+        self.assertEqual(len(builds), 3)
+
+    def test_topics(self):
+        templates = EntityTemplates('config', 'state', 'command',
+                                    {'brightness': True})
+        templates.config_data = '{}'
+        self.assertEqual(templates.topics('{"light": 1}'),
+                         {'config': {'topic': 'config', 'data': '{}'},
+                          'state': {'topic': 'state',
+                                    'data': '{"light": 1}'},
+                          'command': {'topic': 'command'},
+                          'brightness': {'brightness': True}})
+
+
+class CompactPayloadTest(unittest.TestCase):
+    def test_unknown_payload(self):
+        with self.assertRaises(ValueError):
+            TemplateCache(config('xml'))
+
+    def test_compact(self):
+        cache = TemplateCache(config('compact'))
+        self.assertEqual(cache.data('temperature', '21.3'), '21.3')
+        self.assertEqual(cache.data('switch', 1), '1')
+        self.assertEqual(cache.state({'switch': 2}), '2')
+        self.assertEqual(cache.value_template('switch'), '{{ value }}')
+
+    def test_json(self):
+        cache = TemplateCache(config())
+        self.assertEqual(cache.state({'switch': 2}), '{"switch": 2}')
+        self.assertEqual(cache.value_template('switch'),
+                         '{{ value_json.switch }}')
+
+
+if __name__ == '__main__':
+    unittest.main()